@@ -0,0 +1,193 @@
+# ADMM solver for the same forward model as fista_spectral_cupy.py
+
+# Array operations go through a backend (fista_files/backends.py) chosen per solver:
+#   admm_spectral(h, mask, backend='numpy' | 'torch' | 'cupy')
+import math
+import numpy as np
+from fista_files.backends import get_backend
+
+"""
+Solves  min_v  ||mask * crop(h * v) - b||^2 + tau * ||D v||_1  subject to  v >= 0
+where D are the horizontal and vertical finite differences (anisotropic TV).
+
+The crop, TV and non-negativity terms are split off with the auxiliary variables
+    x = h * v,   u = D v,   w = v
+so every update is closed form: x and w elementwise, u a soft threshold, and v
+a single division in the Fourier domain by  mu1 |H|^2 + mu2 |D|^2 + mu3,
+which is precomputed once per PSF and set of penalties.
+"""
+
+class admm_spectral():
+    def __init__(self, h, mask, gray=False, backend='numpy', num_threads=None):
+        """
+        same construction interface as fista_spectral_numpy
+        backend: 'numpy', 'torch' (multithreaded CPU, num_threads) or 'cupy', or a backend instance
+        """
+        self.xp = get_backend(backend, num_threads=num_threads)
+        xp = self.xp
+        h = xp.asarray(h)
+        mask = xp.asarray(mask)
+
+        ## Initialize constants
+        self.DIMS0 = h.shape[0]  # Image Dimensions
+        self.DIMS1 = h.shape[1]  # Image Dimensions
+
+        self.spectral_channels = mask.shape[-1]  # Number of spectral channels
+        if gray is True:
+            self.spectral_channels =1  # Number of spectral channels
+
+        self.py = int((self.DIMS0)//2)    # Pad size
+        self.px = int((self.DIMS1)//2)    # Pad size
+        self.padded_shape = (self.DIMS0*2, self.DIMS1*2)
+
+        # Real FFT of point spread function, one per channel
+        self.H = xp.rfft2((xp.ifftshift(self.pad(h), axes = (0,1))), axes = (0,1))
+        self.Hconj = xp.conj(self.H)
+        self.H2 = xp.real(self.H*self.Hconj)
+        self.H2_mean = float(xp.sum(self.H2))/math.prod(self.H2.shape)
+
+        # Spectrum of D^T D, the periodic Laplacian
+        delta = np.zeros(self.padded_shape)
+        delta[0, 0] = 1
+        dx, dy = self.D(xp.asarray(delta))
+        self.D2 = xp.real(xp.rfft2(self.Dadj(dx, dy), axes = (0,1)))
+        self.D2 = xp.expand_dims(self.D2, 2)
+
+        self.mask = mask
+        # C^T C, the crop and mask on the padded grid
+        self.CtC = self.pad(mask*mask)
+
+        # Penalties, relative to the mean of |H|^2 so they do not depend on the PSF scale
+        self.mu1 = 1e-3      # x = h * v
+        self.mu2 = 1e-2      # u = D v
+        self.mu3 = 4e-2      # w = v
+        self.tau = 3e-3      # TV tuning parameter
+
+        # Residual balancing: a penalty is scaled by mu_step when its primal and
+        # dual residuals differ by more than resid_tol, so the defaults above only set
+        # the starting point. the denominators are then updated, which is elementwise.
+        self.autotune = True
+        self.resid_tol = 1.5
+        self.mu_step = 1.2
+
+        # Number of iterations of ADMM
+        self.iters = 50
+
+        self.show_recon_progress = False # Display the intermediate results
+        self.print_every = 20           # Sets how often to print the image
+
+        self.mu_cache = (None, None)    # denominators of the last starting penalties
+
+    # Fourier and elementwise denominators of the v and x updates for penalties MU
+    def denominators(self, mu):
+        mu1, mu2, mu3 = mu
+        return 1./(mu1*self.H2 + mu2*self.D2 + mu3), 1./(self.CtC + mu1)
+
+    # Residual balancing of one penalty
+    def balance(self, mu, primal, dual):
+        if primal > self.resid_tol*dual:
+            return mu*self.mu_step
+        if dual > self.resid_tol*primal:
+            return mu/self.mu_step
+        return mu
+
+    # Helper functions for forward model
+    def crop(self,x):
+        return x[self.py:-self.py, self.px:-self.px]
+
+    def pad(self,x):
+        if len(x.shape) == 2:
+            out = self.xp.pad(x, ([self.py, self.py], [self.px,self.px]))
+        elif len(x.shape) == 3:
+            out = self.xp.pad(x, ([self.py, self.py], [self.px,self.px], [0, 0]))
+        return out
+
+    # Periodic finite differences and their adjoint
+    def D(self, v):
+        xp = self.xp
+        return xp.roll(v, -1, 0) - v, xp.roll(v, -1, 1) - v
+
+    def Dadj(self, dx, dy):
+        xp = self.xp
+        return xp.roll(dx, 1, 0) - dx + xp.roll(dy, 1, 1) - dy
+
+    def soft_thresh(self, x, tau):
+        out = self.xp.nonneg(self.xp.abs(x)- tau)
+        out = out*self.xp.sign(x)
+        return out
+
+    def loss(self, Hv, v, inputs):
+        xp = self.xp
+        err = self.mask*self.crop(Hv) - inputs
+        dx, dy = self.D(v)
+        l = xp.norm(err)**2 + self.tau*(xp.sum(xp.abs(dx)) + xp.sum(xp.abs(dy)))
+        return float(l)
+
+    # Run ADMM, x0 is an optional starting point of the padded size
+    def run(self, inputs, x0=None):
+        xp = self.xp
+        inputs = xp.asarray(inputs)
+
+        mu1, mu2, mu3 = self.mu1*self.H2_mean, self.mu2*self.H2_mean, self.mu3*self.H2_mean
+        if self.mu_cache[0] != (mu1, mu2, mu3):
+            self.mu_cache = ((mu1, mu2, mu3), self.denominators((mu1, mu2, mu3)))
+        v_denom, x_denom = self.mu_cache[1]
+
+        Ctb = self.pad(self.mask*inputs)
+        shape = self.padded_shape + (max(self.spectral_channels, inputs.shape[-1]),)
+
+        # Initialize variables to zero or the starting point
+        v = xp.zeros(shape) if x0 is None else xp.copy(xp.asarray(x0))
+        Hv = xp.irfft2(self.H*xp.rfft2(v, axes = (0,1)), s = self.padded_shape, axes = (0,1))
+        dvx, dvy = self.D(v)
+        xi = xp.zeros(shape)                          # dual of x = h * v
+        eta_x, eta_y = xp.zeros(shape), xp.zeros(shape) # dual of u = D v
+        rho = xp.zeros(shape)                         # dual of w = v
+
+        llist = []
+        for i in range(0, self.iters):
+            # closed form updates of the split variables
+            ux = self.soft_thresh(dvx + eta_x/mu2, self.tau/mu2)
+            uy = self.soft_thresh(dvy + eta_y/mu2, self.tau/mu2)
+            x = (Ctb + xi + mu1*Hv)*x_denom
+            w = xp.nonneg(v + rho/mu3)
+
+            # v update, one division in the Fourier domain
+            r = (mu3*w - rho) + self.Dadj(mu2*ux - eta_x, mu2*uy - eta_y)
+            V = (xp.rfft2(r, axes = (0,1)) + self.Hconj*xp.rfft2(mu1*x - xi, axes = (0,1)))*v_denom
+            v_prev, Hv_prev, dvx_prev, dvy_prev = v, Hv, dvx, dvy
+            v = xp.irfft2(V, s = self.padded_shape, axes = (0,1))
+            Hv = xp.irfft2(self.H*V, s = self.padded_shape, axes = (0,1))
+            dvx, dvy = self.D(v)
+
+            # dual updates
+            xi = xi + mu1*(Hv - x)
+            eta_x = eta_x + mu2*(dvx - ux)
+            eta_y = eta_y + mu2*(dvy - uy)
+            rho = rho + mu3*(v - w)
+
+            if self.autotune:
+                mu = (self.balance(mu1, float(xp.norm(Hv - x)), mu1*float(xp.norm(Hv - Hv_prev))),
+                      self.balance(mu2, float(xp.norm(dvx - ux) + xp.norm(dvy - uy)), mu2*float(xp.norm(dvx - dvx_prev) + xp.norm(dvy - dvy_prev))),
+                      self.balance(mu3, float(xp.norm(v - w)), mu3*float(xp.norm(v - v_prev))))
+                if mu != (mu1, mu2, mu3):
+                    mu1, mu2, mu3 = mu
+                    v_denom, x_denom = self.denominators(mu)
+
+            l = self.loss(Hv, v, inputs)
+            llist.append(l)
+
+            # Print out the intermediate results and the loss
+            if self.show_recon_progress==True and i%self.print_every == 0:
+                import matplotlib.pyplot as plt # only needed for progress plots
+                print('iteration: ', i, ' loss: ', l)
+                out_img = xp.to_numpy(self.crop(v)).squeeze()
+                plt.figure(figsize = (9,3))
+                plt.subplot(1,2,1), plt.imshow(np.clip((out_img/np.max(out_img)),0,1)); plt.title('Reconstruction')
+                plt.subplot(1,2,2), plt.plot(llist); plt.title('Loss')
+                plt.show()
+
+        v = xp.nonneg(v)
+        xout = xp.to_numpy(self.crop(v))
+        xnocrop = xp.to_numpy(v).copy()
+        return [xout, xnocrop], llist
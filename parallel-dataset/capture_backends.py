@@ -0,0 +1,377 @@
+import os
+import time
+import numpy as np
+
+"""
+Backends for capture_display.py.
+
+CAPTURE_BACKEND selects the camera source:
+- "pylon": Basler cameras through pypylon (default)
+- "sim": simulated cameras that photograph the composed display surface,
+         lensless imagers through a synthetic PSF convolution
+
+DISPLAY_BACKEND selects the display:
+- "desktop": fullscreen on a real monitor (default)
+- "headless": offscreen SDL dummy driver of size HEADLESS_SIZE
+
+Both are read from environment variables of the same name, e.g.
+
+    CAPTURE_BACKEND=sim DISPLAY_BACKEND=headless python3 capture_display.py 100 0 /tmp/dest /path/to/source/ 1
+
+The simulated backend only implements the subset of the pylon API used by
+capture_display_helpers and capture_burst.
+"""
+
+CAPTURE_BACKEND = os.environ.get("CAPTURE_BACKEND", "pylon")
+DISPLAY_BACKEND = os.environ.get("DISPLAY_BACKEND", "desktop")
+HEADLESS_SIZE = (1920, 1080)
+
+SENSOR_SHAPE = (1200, 1920) # daA1920-uc (h, w)
+SIM_SCALE = 4               # lensless convolution is simulated at SENSOR_SHAPE // SIM_SCALE
+SIM_REF_EXPOSURE = 25000    # exposure time (us) at which a white display reads full scale
+SIM_CLOCK_DRIFT = float(os.environ.get("SIM_CLOCK_DRIFT", 0)) # ppm, simulated camera clocks run off by up to this
+
+def load_pylon(backend=CAPTURE_BACKEND):
+    """
+    returns the pylon module for BACKEND
+    """
+    if backend == "sim":
+        return SimulatedPylon
+    from pypylon import pylon
+    return pylon
+
+def init_headless_display(size=HEADLESS_SIZE):
+    """
+    switches SDL to the offscreen dummy driver. must run before pg.init().
+    """
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    return size
+
+def display_region(pos, dim, crop_dim, crop_pos, display_dim):
+    """
+    screen coordinates (x, y, w, h) of an image placed at POS with crop DIM on the
+    crop surface, after the crop surface is rescaled to DISPLAY_DIM at CROP_POS.
+    """
+    sx = display_dim[0] / crop_dim[0]
+    sy = display_dim[1] / crop_dim[1]
+    return (int(crop_pos[0] + pos[0]*sx), int(crop_pos[1] + pos[1]*sy), int(dim[2]*sx), int(dim[3]*sy))
+
+def synthetic_psf(shape, num_points, seed):
+    """
+    caustic-like PSF: NUM_POINTS random foci blurred by a small gaussian, unit sum.
+    few points behave like a multi-focal lenslet array, many like a diffuser.
+    """
+    rng = np.random.default_rng(seed)
+    psf = np.zeros(shape, dtype=np.float32)
+    ys = rng.integers(shape[0]//4, 3*shape[0]//4, num_points)
+    xs = rng.integers(shape[1]//4, 3*shape[1]//4, num_points)
+    np.add.at(psf, (ys, xs), rng.uniform(0.5, 1, num_points).astype(np.float32))
+
+    fy = np.fft.fftfreq(shape[0])[:, None]
+    fx = np.fft.rfftfreq(shape[1])[None, :]
+    blur = np.exp(-2 * (np.pi * 1.5)**2 * (fx**2 + fy**2))
+    psf = np.fft.irfft2(np.fft.rfft2(psf) * blur, s=shape)
+    psf = np.maximum(psf, 0)
+    return (psf / psf.sum()).astype(np.float32)
+
+class SimParameter():
+    """
+    stand-in for a genicam node. supports Value, GetValue, SetValue and Execute.
+    """
+    def __init__(self, value=None):
+        self.Value = value
+
+    def GetValue(self):
+        return self.Value
+
+    def SetValue(self, value):
+        self.Value = value
+
+    def Execute(self):
+        pass
+
+    def __eq__(self, other):
+        return self.Value == (other.Value if isinstance(other, SimParameter) else other)
+
+class SimDeviceInfo():
+    def __init__(self, serial):
+        self.serial = serial
+
+    def GetSerialNumber(self):
+        return self.serial
+
+    def GetModelName(self):
+        return "Simulated daA1920-uc"
+
+class SimGrabResult():
+    def __init__(self, context, array, timestamp=0, valid=True):
+        self.context = context
+        self.array = array
+        self.TimeStamp = timestamp
+        self.valid = valid
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.Release()
+
+    def GetCameraContext(self):
+        return self.context
+
+    def IsValid(self):
+        return self.valid
+
+    def GrabSucceeded(self):
+        return self.array is not None
+
+    def GetArray(self):
+        return self.array
+
+    def Release(self):
+        pass
+
+class SimCamera():
+    """
+    simulated camera that photographs a region of the current display surface.
+    the camera is configured through SimulatedPylon.configure() by serial number.
+    """
+    def __init__(self):
+        object.__setattr__(self, "_params", {})
+        self.ExposureTime = SIM_REF_EXPOSURE
+        self.Gain = 0.0
+        self.PixelFormat = "RGB8"
+        self.DeviceInfo = None
+        self.view = None
+        self.context = None
+        self.grabbing = False
+        self.clock_offset = np.random.default_rng().uniform(0, 1e3) # camera clock minus host clock, seconds
+        self.clock_rate = 1 + np.random.default_rng().uniform(-1, 1)*SIM_CLOCK_DRIFT*1e-6
+        self.next_frame = 0.0
+
+    def __getattr__(self, name):
+        # any other genicam node is accepted and stored
+        params = object.__getattribute__(self, "_params")
+        if name not in params:
+            params[name] = SimParameter()
+        return params[name]
+
+    def __setattr__(self, name, value):
+        params = object.__getattribute__(self, "_params")
+        if name[0].isupper() and name != "DeviceInfo":
+            if name not in params:
+                params[name] = SimParameter()
+            params[name].Value = value.Value if isinstance(value, SimParameter) else value
+        else:
+            object.__setattr__(self, name, value)
+
+    def Attach(self, device):
+        self.DeviceInfo = device
+        self.view = SimulatedPylon.views.get(device.GetSerialNumber())
+
+    def SetCameraContext(self, idx):
+        self.context = idx
+
+    def GetCameraContext(self):
+        return self.context
+
+    def Open(self):
+        pass
+
+    def Close(self):
+        pass
+
+    def StartGrabbing(self, strategy=None):
+        self.grabbing = True
+
+    def StopGrabbing(self):
+        self.grabbing = False
+
+    def IsGrabbing(self):
+        return self.grabbing
+
+    @property
+    def TimestampLatchValue(self):
+        # the camera clock in nanoseconds, latched whenever it is read
+        return SimParameter(int(self.camera_clock(time.monotonic()) * 1e9))
+
+    def camera_clock(self, t):
+        """
+        camera clock at host time T, seconds
+        """
+        return t*self.clock_rate + self.clock_offset
+
+    def frame_period(self):
+        """
+        seconds between frames when grabbing continuously
+        """
+        period = self.ExposureTime.Value / 1e6
+        if self.AcquisitionFrameRateEnable.Value:
+            period = max(period, 1 / self.AcquisitionFrameRate.Value)
+        return period
+
+    def RetrieveResult(self, timeout=1000):
+        import pygame as pg
+        surface = pg.display.get_surface()
+        if surface is None or self.view is None:
+            return SimGrabResult(self.context, None)
+        screen = pg.surfarray.pixels3d(surface).transpose(1, 0, 2)
+        signal = self.view.render(screen)
+        scale = self.ExposureTime.Value / SIM_REF_EXPOSURE * 10**(self.Gain.Value / 20)
+        pixel_format = self.PixelFormat.Value
+        if pixel_format.startswith("Bayer"):
+            # raw mosaic, one color sample per pixel at the format's bit depth
+            from fista_files.image_io import BAYER_PATTERNS
+            full_scale = 4095 if pixel_format.endswith("12") else 255
+            signal = np.clip(signal * scale * full_scale / 255, 0, full_scale)
+            frame = np.empty(signal.shape[:2], dtype=np.uint16 if full_scale > 255 else np.uint8)
+            for (y, x), code in zip(((0, 0), (0, 1), (1, 0), (1, 1)), BAYER_PATTERNS[pixel_format[5:7]][0]):
+                frame[y::2, x::2] = signal[y::2, x::2, code]
+            return SimGrabResult(self.context, frame)
+        frame = np.clip(signal * scale, 0, 255).astype(np.uint8)
+        if pixel_format.startswith("Mono"):
+            frame = frame.mean(axis=2).astype(np.uint8)
+        return SimGrabResult(self.context, frame)
+
+class SimView():
+    """
+    what a simulated camera sees: a display REGION (x, y, w, h) resampled to the
+    sensor, optionally convolved with PSF at SENSOR_SHAPE // SIM_SCALE.
+    """
+    def __init__(self, region, psf=None):
+        self.region = region
+        sim_shape = (SENSOR_SHAPE[0] // SIM_SCALE, SENSOR_SHAPE[1] // SIM_SCALE)
+        shape = sim_shape if psf is not None else SENSOR_SHAPE
+        x, y, w, h = region
+        # nearest neighbour sampling indices from the display region
+        self.rows = y + (np.arange(shape[0]) * h // shape[0])
+        self.cols = x + (np.arange(shape[1]) * w // shape[1])
+        self.H = None
+        if psf is not None:
+            self.H = np.fft.rfft2(np.fft.ifftshift(psf))[..., None]
+
+    def render(self, screen):
+        img = screen[np.ix_(self.rows, self.cols)].astype(np.float32)
+        if self.H is None:
+            return img
+        # circular convolution with a unit sum PSF keeps the mean brightness of the scene
+        meas = np.fft.irfft2(np.fft.rfft2(img, axes=(0, 1)) * self.H, s=img.shape[:2], axes=(0, 1))
+        return np.repeat(np.repeat(meas, SIM_SCALE, axis=0), SIM_SCALE, axis=1)
+
+class SimImage():
+    """
+    stand-in for pylon.PylonImage
+    """
+    def __init__(self):
+        self.array = None
+
+    def AttachGrabResultBuffer(self, res):
+        self.array = res.GetArray()
+
+    def GetArray(self):
+        return self.array
+
+    def Save(self, fmt, filename):
+        from PIL import Image
+        Image.fromarray(self.array).save(filename)
+
+    def Release(self):
+        self.array = None
+
+class SimTlFactory():
+    _instance = None
+
+    @classmethod
+    def GetInstance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def EnumerateDevices(self):
+        return [SimDeviceInfo(serial) for serial in SimulatedPylon.views]
+
+    def CreateDevice(self, device):
+        return device
+
+class SimInstantCameraArray(list):
+    def __init__(self, num_cameras):
+        super().__init__(SimCamera() for _ in range(num_cameras))
+
+    def Open(self):
+        pass
+
+    def Close(self):
+        pass
+
+    def StartGrabbing(self, strategy=None):
+        now = time.monotonic()
+        for cam in self:
+            cam.StartGrabbing(strategy)
+            cam.next_frame = now + cam.frame_period()
+
+    def StopGrabbing(self):
+        for cam in self:
+            cam.StopGrabbing()
+
+    def IsGrabbing(self):
+        return any(cam.IsGrabbing() for cam in self)
+
+    def RetrieveResult(self, timeout=1000, timeout_handling=None):
+        """
+        next frame of the free running cameras: the camera whose exposure ends first renders
+        the display, waiting up to TIMEOUT ms for it. rendering takes real time, so the
+        simulated frame rates are limited by the CPU. the timestamp is the exposure start
+        on the camera clock, as on Basler cameras.
+        """
+        cam = min((c for c in self if c.grabbing), key=lambda c: c.next_frame)
+        wait = cam.next_frame - time.monotonic()
+        if wait > timeout / 1000:
+            time.sleep(timeout / 1000)
+            return SimGrabResult(None, None, valid=False)
+        time.sleep(max(wait, 0))
+        res = cam.RetrieveResult()
+        now = time.monotonic()
+        res.TimeStamp = int(cam.camera_clock(now - cam.ExposureTime.Value / 1e6) * 1e9)
+        cam.next_frame = now + cam.frame_period()
+        return res
+
+def rig_sim_views(rig):
+    """
+    simulated views for every camera in RIG, keyed by serial number.
+    lensless imagers see their display region through a synthetic PSF, few foci
+    for lenslet imagers and many for diffusers. ground truth cameras see the
+    whole rescaled crop surface.
+    """
+    crop_dim, display_dim, crop_pos = (rig["display"][k] for k in ("crop_dim", "display_dim", "crop_pos"))
+    sim_shape = (SENSOR_SHAPE[0] // SIM_SCALE, SENSOR_SHAPE[1] // SIM_SCALE)
+    views = {}
+    for idx, cam in enumerate(rig["cameras"]):
+        if cam["role"] == "lensless":
+            region = display_region(cam["display_pos"], cam["display_crop"], crop_dim, crop_pos, display_dim)
+            num_points = cam.get("sim_psf_points", 2000 if "diffuser" in cam["name"].lower() else 30)
+            views[cam["serial"]] = SimView(region, synthetic_psf(sim_shape, num_points, seed=idx))
+        else:
+            views[cam["serial"]] = SimView((crop_pos[0], crop_pos[1], display_dim[0], display_dim[1]))
+    return views
+
+class SimulatedPylon():
+    """
+    module-like namespace mirroring the parts of pypylon.pylon used for capture
+    """
+    GrabStrategy_OneByOne = 0
+    GrabStrategy_LatestImageOnly = 1
+    ImageFileFormat_Tiff = 0
+    TimeoutHandling_Return = 0
+
+    TlFactory = SimTlFactory
+    InstantCameraArray = SimInstantCameraArray
+    PylonImage = SimImage
+
+    views = {}
+
+    @classmethod
+    def configure(cls, views):
+        """
+        VIEWS: {serial number: SimView} for every simulated camera
+        """
+        cls.views = dict(views)
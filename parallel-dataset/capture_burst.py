@@ -0,0 +1,422 @@
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from capture_backends import load_pylon
+from fista_files.image_io import map_tiff, read_image, write_tiff
+from rig_config import RIG_FILE, load_rig, display_regions
+
+"""
+Burst acquisition for capture_display.py.
+
+Instead of settling the display and grabbing once per image, the cameras grab
+continuously while the display steps through the source images, holding each
+for a hold time derived from the camera frame periods. Every display frame
+carries a fiducial: FIDUCIAL_BITS cells encoding the image index, with the
+complement of each bit in the row below, drawn in a corner of the crop
+surface that no lensless imager is shown. Frames are written to SUB_DIR/burst
+with their exposure start (camera timestamps converted to the host clock) and
+matched to images afterwards. Camera clocks drift against the host by tens of
+ppm, which over a long burst exceeds BURST_MARGIN, so every camera clock is
+latched against the host clock every RELATCH_INTERVAL seconds. The latches are
+journaled and matching converts the camera timestamps with the offset
+interpolated between them. Burst mode needs camera timestamps and does not
+start if a camera cannot latch its clock.
+
+- ground truth frames are decoded. a frame is consistent when every bit
+  differs clearly from its complement, a frame exposed across a display
+  change shows a mix of two codes and is dropped
+- the consistent ground truth frames of an index bracket the time the display
+  showed it. lensless imagers cannot read the code through their PSF, their
+  frames belong to an index when the whole exposure lies within its bracket,
+  shrunk by BURST_MARGIN for the display refresh and timestamp jitter
+- one frame per camera and index is kept, moved to the usual
+  {imager}/img_{i}_cam_{id}.tiff. indices a camera has no valid frame for are
+  reported as missing and can be captured again with START
+
+The hold time is chosen so that every camera gets at least one frame within
+the bracket of every index. It is set by the slowest camera, e.g. the 80 ms
+exposure of the RML imager in rig.json gives about 0.3 s per image.
+
+The decoder assumes the ground truth camera frames the displayed crop surface,
+like capture_integrity.py. If it does not, set "crop_view" (x, y, w, h), the
+pixels of the crop surface in its frames, on the ground truth camera entry of
+the rig file.
+
+Matching runs at the end of a burst capture. To run it again:
+
+USAGE:
+    python3 capture_burst.py DESTINATION SUB_DIR [RIG]
+"""
+
+## FIDUCIAL
+FIDUCIAL_BITS = 20      # image indices modulo 2**20
+FIDUCIAL_CELL = 40      # cell size on the crop surface, pixels
+FIDUCIAL_INSET = 20     # distance from the corner of the crop surface
+MIN_CONSISTENCY = 0.9   # weakest over mean bit contrast, rejects frames mixing two codes by more than about 5%
+MIN_CONTRAST = 0.5      # (white - black) / white of the code cells, rejects frames without a code
+
+## TIMING, SECONDS
+BURST_MARGIN = 0.02     # display refresh and timestamp jitter, frames this close to a display change are not used
+DISPLAY_LATENCY = 0.05  # from pg.display.flip() until the display shows the new frame
+BURST_WARMUP = 1.0      # grab time before the first image, to measure the camera frame periods
+TIMESTAMP_TICK = 1e-9   # camera timestamp unit, nanoseconds on Basler USB3 cameras
+RELATCH_INTERVAL = 10.0 # seconds between clock latches, 50 ppm drift adds 0.5 ms in between
+
+BURST_DIR = "burst"
+QUEUE_SIZE = 256        # frames waiting to be written
+KEEP_ALL_FRAMES = False # keep SUB_DIR/burst after matching instead of deleting the unused frames
+
+def fiducial_rect(rig, bits=FIDUCIAL_BITS, cell=FIDUCIAL_CELL, inset=FIDUCIAL_INSET):
+    """
+    (x, y, w, h) of the fiducial on the crop surface, in the first corner
+    (bottom left, bottom right, top left, top right) that no lensless imager is shown in,
+    or at "fiducial_pos" of the rig's display section
+    """
+    crop_w, crop_h = rig["display"]["crop_dim"]
+    w, h = bits*cell, 2*cell
+    if "fiducial_pos" in rig["display"]:
+        return (*rig["display"]["fiducial_pos"], w, h)
+    corners = [(inset, crop_h - inset - h), (crop_w - inset - w, crop_h - inset - h), (inset, inset), (crop_w - inset - w, inset)]
+    for x, y in corners:
+        free = all(x + w <= px or px + dim[2] <= x or y + h <= py or py + dim[3] <= y for (px, py), dim in display_regions(rig))
+        if free and x >= 0 and y >= 0:
+            return (x, y, w, h)
+    raise ValueError("No corner of the crop surface is free for the fiducial, set fiducial_pos in the rig file.")
+
+def fiducial_cells(index, bits=FIDUCIAL_BITS):
+    """
+    (2, bits) cells of INDEX, 1 is white. the bits of the index, least significant first, above their complement
+    """
+    code = (index >> np.arange(bits)) & 1
+    return np.stack([code, 1 - code])
+
+def draw_fiducial(screen, index, rect):
+    """
+    draws the fiducial of INDEX over RECT (x, y, w, h) in screen coordinates
+    """
+    import pygame as pg
+    cells = fiducial_cells(index)
+    x, y, w, h = rect
+    cw, ch = w / cells.shape[1], h / cells.shape[0]
+    pg.draw.rect(screen, (0, 0, 0), pg.Rect(rect))
+    for r, c in zip(*np.nonzero(cells)):
+        left, top = round(x + c*cw), round(y + r*ch)
+        pg.draw.rect(screen, (255, 255, 255), pg.Rect(left, top, round(x + (c + 1)*cw) - left, round(y + (r + 1)*ch) - top))
+
+def frame_rect(rect, crop_dim, shape, crop_view=None):
+    """
+    RECT on the crop surface in the pixels of a ground truth frame of SHAPE, which shows
+    the crop surface at CROP_VIEW (x, y, w, h), the whole frame by default
+    """
+    vx, vy, vw, vh = crop_view if crop_view else (0, 0, shape[1], shape[0])
+    sx, sy = vw / crop_dim[0], vh / crop_dim[1]
+    return (vx + rect[0]*sx, vy + rect[1]*sy, rect[2]*sx, rect[3]*sy)
+
+def decode_fiducial(frame, rect, bits=FIDUCIAL_BITS):
+    """
+    (index, consistency) of the fiducial at RECT (x, y, w, h) of FRAME, index None when
+    the code is missing or mixed. only the central third of every cell is read.
+    """
+    x, y, w, h = rect
+    cw, ch = w / bits, h / 2
+    means = np.empty((2, bits))
+    for r in range(2):
+        y0, y1 = int(y + (r + 1/3)*ch), int(np.ceil(y + (r + 2/3)*ch))
+        for c in range(bits):
+            x0, x1 = int(x + (c + 1/3)*cw), int(np.ceil(x + (c + 2/3)*cw))
+            means[r, c] = np.mean(frame[y0:y1, x0:x1], dtype=np.float64)
+    diff = means[0] - means[1]
+    contrast = np.abs(diff)
+    white = np.maximum(means[0], means[1]).mean()
+    if white <= 0 or contrast.mean() < MIN_CONTRAST*white:
+        return None, 0.0
+    consistency = float(contrast.min() / contrast.mean())
+    if consistency < MIN_CONSISTENCY:
+        return None, consistency
+    return int(np.sum((diff > 0) << np.arange(bits))), consistency
+
+def burst_hold(periods, exposures, gt_cameras, margin=BURST_MARGIN, latency=DISPLAY_LATENCY):
+    """
+    display time per image, seconds, for frame PERIODS and EXPOSURES of every camera.
+    the first and last whole ground truth frame of an image can each lose a frame period,
+    and what is left must hold a whole frame of every camera within BURST_MARGIN
+    """
+    gt_period = max(periods[c] for c in gt_cameras)
+    return latency + 2*gt_period + 2*margin + max(p + e for p, e in zip(periods, exposures))
+
+class BurstWriter(threading.Thread):
+    """
+    background stage that writes burst frames and their journal entries, so
+    retrieval only waits for the disk once QUEUE_SIZE frames are pending
+    """
+    def __init__(self, directory, bayer=None):
+        super().__init__(daemon=True)
+        self.directory = directory
+        self.bayer = bayer
+        self.journal = open(f"{directory}/journal.jsonl", 'a')
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.written = 0
+        self.start()
+
+    def submit(self, entry, frame=None):
+        """
+        queues a journal ENTRY, and FRAME to be written to entry["file"]
+        """
+        self.queue.put((entry, frame))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            entry, frame = item
+            try:
+                if frame is not None:
+                    write_tiff(entry["file"], frame, cfa=self.bayer)
+                    self.written += 1
+                self.journal.write(json.dumps(entry) + "\n")
+            except Exception as e:
+                print(f"Burst write failed for {entry}: {e}")
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        self.journal.close()
+
+class BurstGrabber():
+    """
+    continuous grab of every camera of CAM_ARRAY into SUB_DIR/burst.
+
+    call displayed() after each display change and grab() until the hold time is
+    over, then close(). frame_rate caps the frame rate of every camera, None for free running.
+    """
+    def __init__(self, cam_array, sub_dir, rig, exposure_times, bayer=None, frame_rate=None, warmup=BURST_WARMUP):
+        self.py = load_pylon() # only needed for grabbing, matching runs without pypylon
+        self.cam_array = cam_array
+        self.directory = f"{sub_dir}/{BURST_DIR}"
+        self.rig = rig
+        self.exposures = [e / 1e6 for e in exposure_times]
+        self.failed = []
+        self.frames = 0
+        self.offsets = {} # camera context: host minus camera clock at the last latch, seconds
+        for cam in rig["cameras"]:
+            os.makedirs(f"{self.directory}/{cam['path']}", exist_ok=True)
+
+        for cam in cam_array:
+            cam.MaxNumBuffer.Value = 32 # frames waiting for retrieval while the display is composed
+            if frame_rate:
+                cam.AcquisitionFrameRateEnable.Value = True
+                cam.AcquisitionFrameRate.Value = frame_rate
+
+        self.writer = BurstWriter(self.directory, bayer)
+        failed = self.latch()
+        if failed:
+            self.writer.close()
+            raise RuntimeError(f"Cannot latch the clock of camera(s) {failed}, burst mode needs camera timestamps. Set BURST = False.")
+        cam_array.StartGrabbing(self.py.GrabStrategy_OneByOne)
+        self.periods = self.measure_periods(warmup, frame_rate)
+        gt_cameras = [idx for idx, cam in enumerate(rig["cameras"]) if cam["role"] == "ground_truth"]
+        self.hold = burst_hold(self.periods, self.exposures, gt_cameras)
+        print("Burst frame periods (s): ", [round(p, 4) for p in self.periods], f"hold {self.hold:.3f}s per image")
+
+    def latch(self):
+        """
+        latches the clock of every camera against the host clock, updates the offsets and
+        journals the pair of times. returns the camera contexts whose latch failed, their
+        previous offset is kept
+        """
+        failed = []
+        for cam in self.cam_array:
+            ctx = cam.GetCameraContext()
+            try:
+                before = time.monotonic()
+                cam.TimestampLatch.Execute()
+                ticks = cam.TimestampLatchValue.Value
+                host = (before + time.monotonic()) / 2
+            except Exception as e:
+                print(f"Timestamp latch failed for camera {ctx}: {e}")
+                failed.append(ctx)
+                continue
+            self.offsets[ctx] = host - ticks*TIMESTAMP_TICK
+            self.writer.submit({"latch": ctx, "ticks": ticks, "host": host})
+        self.latched = time.monotonic()
+        return failed
+
+    def retrieve(self, timeout):
+        """
+        (camera context, exposure start on the host clock, frame, camera timestamp) of the next frame,
+        None on timeout
+        """
+        with self.cam_array.RetrieveResult(max(int(timeout*1000), 0), self.py.TimeoutHandling_Return) as res:
+            if not res.IsValid():
+                return None
+            cam_id = res.GetCameraContext()
+            if not res.GrabSucceeded():
+                self.failed.append(cam_id)
+                return cam_id, None, None, None
+            return cam_id, res.TimeStamp*TIMESTAMP_TICK + self.offsets[cam_id], res.GetArray(), res.TimeStamp
+
+    def measure_periods(self, duration, frame_rate=None):
+        """
+        median frame period of every camera over DURATION seconds of grabbing, the frames are dropped
+        """
+        starts = {idx: [] for idx in range(len(self.rig["cameras"]))}
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            got = self.retrieve(end - time.monotonic())
+            if got is not None and got[1] is not None:
+                starts[got[0]].append(got[1])
+        periods = []
+        for idx, exposure in enumerate(self.exposures):
+            nominal = max(exposure, 1/frame_rate if frame_rate else 0)
+            measured = np.median(np.diff(starts[idx])) if len(starts[idx]) > 2 else 0
+            periods.append(float(max(nominal, measured)))
+        return periods
+
+    def displayed(self, index, filename):
+        """
+        records that the display was asked to show INDEX, and latches the camera clocks
+        again every RELATCH_INTERVAL seconds
+        """
+        if time.monotonic() - self.latched > RELATCH_INTERVAL:
+            self.latch()
+        self.writer.submit({"display": index, "source": filename, "t": time.monotonic()})
+
+    def grab(self, until):
+        """
+        writes every frame retrieved until host time UNTIL
+        """
+        while True:
+            remaining = until - time.monotonic()
+            if remaining <= 0:
+                break
+            got = self.retrieve(remaining)
+            if got is None or got[2] is None:
+                continue
+            cam_id, start, frame, ticks = got
+            cam_path = self.rig["cameras"][cam_id]["path"]
+            filename = f"{self.directory}/{cam_path}/frame_{self.frames}_cam_{cam_id}.tiff"
+            self.writer.submit({"camera": cam_id, "file": filename, "start": start, "ticks": ticks, "exposure": self.exposures[cam_id]}, frame)
+            self.frames += 1
+
+    def close(self):
+        self.latch() # brackets the last frames
+        self.cam_array.StopGrabbing()
+        self.writer.close()
+
+def read_journal(directory):
+    displays, frames, latches = [], [], []
+    with open(f"{directory}/journal.jsonl") as journal:
+        for line in journal:
+            entry = json.loads(line)
+            (displays if "display" in entry else latches if "latch" in entry else frames).append(entry)
+    return displays, frames, latches
+
+def host_times(frames, latches):
+    """
+    sets the exposure start of FRAMES from their camera timestamps, with the host minus camera
+    clock offset interpolated between the LATCHES of their camera, which follows the clock drift.
+    frames journaled without timestamps keep the start recorded at retrieval
+    """
+    by_camera = {}
+    for latch in sorted(latches, key=lambda l: l["ticks"]):
+        by_camera.setdefault(latch["latch"], []).append((latch["ticks"], latch["host"] - latch["ticks"]*TIMESTAMP_TICK))
+    for e in frames:
+        if e.get("ticks") is not None and e["camera"] in by_camera:
+            ticks, offsets = zip(*by_camera[e["camera"]])
+            e["start"] = e["ticks"]*TIMESTAMP_TICK + float(np.interp(e["ticks"], ticks, offsets))
+
+def match_burst(sub_dir, rig, qa=None, pyramid=None, keep_all=KEEP_ALL_FRAMES, num_readers=8):
+    """
+    keeps one frame per camera for every displayed index of the burst in SUB_DIR, see above.
+    kept frames are handed to the QA and pyramid stages if given.
+    returns a summary with the (index, camera context) pairs without a valid frame.
+    """
+    directory = f"{sub_dir}/{BURST_DIR}"
+    displays, frames, latches = read_journal(directory)
+    host_times(frames, latches)
+    shown = {d["display"] for d in displays}
+    rect = fiducial_rect(rig)
+    crop_dim = rig["display"]["crop_dim"]
+    gt_cameras = [idx for idx, cam in enumerate(rig["cameras"]) if cam["role"] == "ground_truth"]
+
+    # indices wrap around at 2**FIDUCIAL_BITS, the displayed one is the match
+    by_code = {i % 2**FIDUCIAL_BITS: i for i in sorted(shown)}
+
+    def decode(entry):
+        frame = map_tiff(entry["file"])
+        if frame is None:
+            frame = read_image(entry["file"])
+        code, consistency = decode_fiducial(frame, frame_rect(rect, crop_dim, frame.shape, rig["cameras"][entry["camera"]].get("crop_view")))
+        return by_code.get(code), consistency
+
+    gt_frames = [e for e in frames if e["camera"] in gt_cameras]
+    with ThreadPoolExecutor(num_readers) as pool:
+        for entry, (index, consistency) in zip(gt_frames, pool.map(decode, gt_frames)):
+            entry["index"], entry["consistency"] = index, consistency
+
+    # time each index was shown, bracketed by its consistent ground truth frames,
+    # and the most consistent frame of every ground truth camera
+    brackets, kept = {}, {}
+    for e in gt_frames:
+        if e["index"] is None:
+            continue
+        t0, t1 = brackets.get(e["index"], (np.inf, -np.inf))
+        brackets[e["index"]] = (min(t0, e["start"]), max(t1, e["start"] + e["exposure"]))
+        key = (e["index"], e["camera"])
+        if key not in kept or e["consistency"] > kept[key]["consistency"]:
+            kept[key] = e
+
+    # lensless frames within each bracket, the one closest to its middle
+    for idx, cam in enumerate(rig["cameras"]):
+        if idx in gt_cameras:
+            continue
+        cam_frames = sorted((e for e in frames if e["camera"] == idx), key=lambda e: e["start"])
+        starts = np.array([e["start"] for e in cam_frames])
+        exposure = cam_frames[0]["exposure"] if cam_frames else 0
+        for index, (t0, t1) in brackets.items():
+            lo = np.searchsorted(starts, t0 + BURST_MARGIN, 'left')
+            hi = np.searchsorted(starts, t1 - BURST_MARGIN - exposure, 'right')
+            if lo < hi:
+                middle = (t0 + t1 - exposure) / 2
+                kept[(index, idx)] = cam_frames[lo + np.argmin(np.abs(starts[lo:hi] - middle))]
+    missing = [(index, idx) for index in sorted(shown) for idx in range(len(rig["cameras"])) if (index, idx) not in kept]
+
+    for (index, idx), entry in sorted(kept.items()):
+        filename = f"{sub_dir}/{rig['cameras'][idx]['path']}/img_{index}_cam_{idx}.tiff"
+        # frames stay in the burst directory when it is kept, so matching can run again
+        (shutil.copyfile if keep_all else os.replace)(entry["file"], filename)
+        if qa is not None or pyramid is not None:
+            frame = np.array(map_tiff(filename))
+            if pyramid is not None:
+                pyramid.submit(filename, frame)
+            if qa is not None:
+                qa.submit(index, idx, filename, frame)
+    if not keep_all:
+        shutil.rmtree(directory)
+
+    summary = {
+        "Frames": len(frames),
+        "Decoded Ground Truth Frames": sum(e["index"] is not None for e in gt_frames),
+        "Images": len(shown),
+        "Kept": len(kept),
+        "Missing": missing,
+    }
+    print(f"Burst: kept {len(kept)} of {len(frames)} frames for {len(shown)} images, {len(missing)} missing")
+    return summary
+
+def main(args):
+    DESTINATION, SUB_DIR = args[1], args[1] + args[2]
+    RIG = load_rig(args[3] if len(args) > 3 else RIG_FILE)
+    summary = match_burst(SUB_DIR, RIG)
+    for index, idx in summary["Missing"]:
+        print(f"Missing: image {index} of {RIG['cameras'][idx]['name']}")
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,107 +1,31 @@
-from pypylon import pylon as py
 import numpy as np
 import os
 import sys
+import time
 import datetime, pytz
 import pygame as pg
 from time import sleep
 import json
 
 from capture_display_helpers import *
+from capture_backends import CAPTURE_BACKEND, DISPLAY_BACKEND, SimulatedPylon, rig_sim_views
+from rig_config import RIG_FILE, load_rig, display_regions
+from capture_qa import FrameQA
+from capture_pyramid import PyramidWriter
+from capture_burst import BurstGrabber, fiducial_rect, match_burst
+from fista_files.image_io import bayer_pattern
+from display_cache import DisplayFrameCache, layout_key
+from capture_status import CaptureStatus, Notifier
+from source_manifest import load_manifest
 
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-
-# Add after other global variables
-# Email Configuration
+# E-MAIL NOTIFICATIONS, sent from a background thread at NOTIFY_MILESTONES and at the end (capture_status.py)
 SENDER_EMAIL = "TODO"  # Replace with your email
 SENDER_PASSWORD = "TODO"   # Replace with your app password
 RECIPIENT_EMAIL = "TODO"  # Replace with recipient email
-
-def send_notification_email(start_time, status="success", error_msg=None, num_images=None, source_path=None):
-    """Send email notification about script status
-    
-    Args:
-        start_time: Script start time
-        status: 'success' or 'error'
-        error_msg: Error message if status is 'error'
-        num_images: Number of images processed
-        source_path: Source directory path
-    """
-    end_time = datetime.datetime.now(tz=pytz.timezone('US/Pacific'))
-    duration = end_time - start_time
-    
-    message = MIMEMultipart()
-    message["From"] = SENDER_EMAIL
-    message["To"] = RECIPIENT_EMAIL
-    
-    if status == "success":
-        message["Subject"] = "Image Capture Complete"
-        body = f"""
-        Image capture process has completed successfully!
-        
-        Start time: {start_time}
-        End time: {end_time}
-        Duration: {duration}
-        Images processed: {num_images}
-        Source path: {source_path}
-        Destination: {DESTINATION}
-        """
-    else:
-        message["Subject"] = "⚠️ Image Capture Error"
-        body = f"""
-        Image capture process encountered an error!
-        
-        Start time: {start_time}
-        Error time: {end_time}
-        Duration before error: {duration}
-        Error message: {error_msg}
-        """
-    
-    message.attach(MIMEText(body, "plain"))
-    
-    try:
-        server = smtplib.SMTP("smtp.gmail.com", 587)
-        server.starttls()
-        server.login(SENDER_EMAIL, SENDER_PASSWORD)
-        server.send_message(message)
-        server.quit()
-        print("Notification email sent successfully")
-    except Exception as e:
-        print(f"Failed to send email: {str(e)}")
-    end_time = datetime.datetime.now(tz=pytz.timezone('US/Pacific'))
-    duration = end_time - start_time
-    
-    message = MIMEMultipart()
-    message["From"] = SENDER_EMAIL
-    message["To"] = RECIPIENT_EMAIL
-    message["Subject"] = "Image Capture Complete"
-    
-    body = f"""
-    Image capture process has completed!
-    
-    Start time: {start_time}
-    End time: {end_time}
-    Duration: {duration}
-    Images processed: {num_images}
-    Source path: {source_path}
-    Destination: {DESTINATION}
-    """
-    
-    message.attach(MIMEText(body, "plain"))
-    
-    try:
-        server = smtplib.SMTP("smtp.gmail.com", 587)
-        server.starttls()
-        server.login(SENDER_EMAIL, SENDER_PASSWORD)
-        server.send_message(message)
-        server.quit()
-        print("Completion email sent successfully")
-    except Exception as e:
-        print(f"Failed to send email: {str(e)}")
-
-
+SMTP_HOST = "smtp.gmail.com"
+SMTP_PORT = 587
+SMTP_STARTTLS = True # False for a local test server such as aiosmtpd
+NOTIFY_MILESTONES = (0.25, 0.5, 0.75) # fractions of the capture
 
 """
 NUM_IMG: total num imgs
@@ -110,12 +34,24 @@ NUM_CAMERAS: total num cameras
 frames_to_grab: num frames each camera grabs
 frame_counts: array storing frame counts of each camera
 
+cameras, exposure times, output directories and display regions are read
+from the rig file (rig.json by default). with the default rig:
 0: diffuser
 1: rml
 2: ground truth
 
-python3 capture_display.py END START DESTINATION SOURCE DISPLAY &>
+python3 capture_display.py END START DESTINATION SOURCE DISPLAY [RIG] &>
 """
+notifier = Notifier(SENDER_EMAIL, SENDER_PASSWORD, RECIPIENT_EMAIL, host=SMTP_HOST, port=SMTP_PORT, starttls=SMTP_STARTTLS)
+status = None
+
+def notify_error(error_msg):
+    if status is not None:
+        status.close("error", error_msg)
+    else:
+        notifier.notify("⚠️ Image Capture Error", f"Start time: {START_TIME}\nError message: {error_msg}")
+    notifier.close()
+
 try:
     log = True
 
@@ -123,8 +59,34 @@ try:
     START_TIME = datetime.datetime.now(tz=pytz.timezone('US/Pacific'))
     DATETIME = START_TIME.strftime('%d-%m-%Y_%H.%M.%S')
 
-    SERIAL_ARR = ['40270065', '40270083', '40412531'] # replace with your camera serial numbers
+    # "RGB8", or "BayerRG8" / "BayerRG12" to store the raw mosaic, a third of the bandwidth and disk
+    # of RGB8, binned 2x2 to RGB in preprocessing (see fista_files/image_io.py)
     CAPTURE_FORMAT = "RGB8"
+    BAYER = bayer_pattern(CAPTURE_FORMAT)
+
+    ## QA
+    QA = True # per-frame exposure and saturation QA, written to journal.jsonl
+    ADAPTIVE_EXPOSURE = False # nudge exposure times between images based on QA
+
+    ## PYRAMID
+    # area downsampled copies of every frame in {imager}/x4/ and {imager}/x8/, written in the background, None to disable
+    PYRAMID_LEVELS = (4, 8)
+
+    ## BURST
+    # cameras grab continuously while each image is shown for a hold time set by the slowest camera.
+    # display frames carry a code of their index and frames are matched to images afterwards, see capture_burst.py
+    BURST = False
+    BURST_FRAME_RATE = None # frame rate cap of every camera in burst mode, None for free running
+
+    ## STATUS
+    # images/s, ETA, failures and stage latencies in DESTINATION/status.json, also served on
+    # http://localhost:STATUS_PORT/ if set, e.g. 8765
+    STATUS_PORT = None
+
+    ## DISPLAY FRAME CACHE
+    # composed frames are reused across runs with the same source images and layout, None to disable
+    DISPLAY_CACHE_DIR = os.path.expanduser("~/.cache/parallel-dataset/display_frames")
+    DISPLAY_CACHE_MAX_GB = 50
 
     ## PATH VARIABLES
     ARGS = sys.argv
@@ -134,17 +96,36 @@ try:
     DISPLAY = int(ARGS[5]) if ARGS[5] else 1 # 1 is external monitor, 0 is laptop screen, 0 if debug
     DISPLAY_MODE = pg.FULLSCREEN #pg.RESIZABLE 
 
-    PATH_ARR = set_up_directories_and_log(log, DESTINATION)
+    ## RIG
+    # serial numbers, exposure times, output directories and display regions of every camera
+    RIG = load_rig(ARGS[6] if len(ARGS) > 6 else RIG_FILE)
+
+    PATH_ARR = set_up_directories_and_log(log, DESTINATION, RIG)
+
+    # CROP POSITIONING x, y, see rig.json to calibrate
+    crop_dim = tuple(RIG["display"]["crop_dim"])
+    display_dim = tuple(RIG["display"]["display_dim"])
+    crop_pos = tuple(RIG["display"]["crop_pos"])
+    regions = display_regions(RIG)
+
+    # SETTLE TIMES, SECONDS
+    DISPLAY_SETTLE = 0.5 # reset time between images, 0.5s = 500ms
+    GRAB_SETTLE = 0.2    # delay between starting to grab and retrieving a frame
+    if CAPTURE_BACKEND == "sim":
+        # simulated cameras see the display immediately, run at full speed
+        DISPLAY_SETTLE = GRAB_SETTLE = 0
 
     ## CAMERA VARIABLES
-    NUM_CAMERAS = 3
+    SERIAL_ARR = [cam["serial"] for cam in RIG["cameras"]]
+    NUM_CAMERAS = len(SERIAL_ARR)
     NUM_IMG = int(ARGS[1])
     start_idx = int(ARGS[2])
-    frame_counts = [0]*NUM_CAMERAS if NUM_CAMERAS > 1 else [0] * 3
+    frame_counts = [0]*NUM_CAMERAS
     # max = 80ms, min = 1.5ms
-    ## DISPLAY
-    # DC, RML, GT
-    exposure_times = [25000, 80000, 18000] 
+    exposure_times = [cam["exposure"] for cam in RIG["cameras"]]
+
+    if CAPTURE_BACKEND == "sim":
+        SimulatedPylon.configure(rig_sim_views(RIG))
 
     img = py.PylonImage()
 
@@ -162,59 +143,142 @@ try:
     set_color_space(cam_array)
 
     ## Metadata
-    metadata = init_metadata(DATETIME, DESTINATION, SOURCE, NUM_IMG, start_idx, CAPTURE_FORMAT, exposure_times)
+    metadata = init_metadata(DATETIME, DESTINATION, SOURCE, NUM_IMG, start_idx, CAPTURE_FORMAT, exposure_times, RIG)
+
+    assert not (BURST and ADAPTIVE_EXPOSURE), "Exposure times are fixed during a burst."
+    qa = None
+    if QA:
+        bit_depth = 12 if "12" in CAPTURE_FORMAT else 8
+        qa = FrameQA(f"{DESTINATION}/journal.jsonl", exposure_times, bit_depth=bit_depth, adaptive=ADAPTIVE_EXPOSURE)
+    pyramid = PyramidWriter(PYRAMID_LEVELS, bayer=BAYER) if PYRAMID_LEVELS else None
 
     ## INIT DISPLAY
-    screen = init_display(display=DISPLAY, mode=DISPLAY_MODE)
+    screen = init_display(display=DISPLAY, mode=DISPLAY_MODE, headless=DISPLAY_BACKEND == "headless")
+
+    # image order from the source manifest (source_manifest.py), so indices stay the same across runs
+    manifest = load_manifest(SOURCE)
+    if manifest is not None:
+        source_imgs = manifest.filenames()
+        changes = manifest.check()
+        if changes["added"] or changes["removed"]:
+            print(f"Source changed since it was indexed: {len(changes['added'])} added, {len(changes['removed'])} removed. "
+                  "Run source_manifest.py SOURCE --update to index the new images")
+        metadata["Source Manifest"] = manifest.path
+        metadata["Source Changes"] = {"Added": len(changes["added"]), "Removed": changes["removed"], "Modified": []}
+    else:
+        # natural sorting for source images so deterministic
+        print("No source manifest, listing SOURCE. Run source_manifest.py SOURCE once to skip this")
+        source_imgs = filter_sort_images(SOURCE, FORMAT_LST)
+
+    cache = None
+    if DISPLAY_CACHE_DIR:
+        layout = layout_key(crop_dim, display_dim, regions)
+        cache = DisplayFrameCache(DISPLAY_CACHE_DIR, layout, max_bytes=DISPLAY_CACHE_MAX_GB * 2**30)
+
+    # only images are displayed. removed files have no filename in the manifest
+    indices = [i for i in range(start_idx, NUM_IMG)
+               if source_imgs[i] is not None and any([fmt in source_imgs[i] for fmt in FORMAT_LST])]
+    if len(indices) < NUM_IMG - start_idx:
+        print(f"Skipping {NUM_IMG - start_idx - len(indices)} missing or non-image entries of SOURCE")
 
-    # natural sorting for source images so deterministic
-    source_imgs = filter_sort_images(SOURCE, FORMAT_LST)
+    queues = {name: stage.queue for name, stage in (("qa", qa), ("pyramid", pyramid)) if stage is not None}
+    status = CaptureStatus(f"{DESTINATION}/status.json", len(indices), [cam["name"] for cam in RIG["cameras"]], START_TIME,
+                           notifier=notifier, milestones=NOTIFY_MILESTONES, port=STATUS_PORT, queues=queues,
+                           details={"Source path": SOURCE, "Destination": DESTINATION})
+
+    burst = None
+    if BURST:
+        # starts grabbing, the frame periods are measured on the black screen
+        fiducial = fiducial_rect(RIG)
+        burst = BurstGrabber(cam_array, DESTINATION, RIG, exposure_times, bayer=BAYER, frame_rate=BURST_FRAME_RATE)
+        metadata["Burst Hold"] = burst.hold
 
     ## GRAB LOOP
     # Loop over each image in source
-    for i in range(start_idx, NUM_IMG):
+    for i in indices:
         filename = source_imgs[i]
-        
-        #checks if file is an image. if not, skip
-        if not any([fmt in filename for fmt in FORMAT_LST]):
-            continue
+
+        # composed frames are cached by content when it is known to be unchanged
+        cache_key = None
+        if manifest is not None:
+            if manifest.changed(i):
+                print(f"Source image {filename} was modified since it was indexed")
+                metadata["Source Changes"]["Modified"].append(i)
+            else:
+                cache_key = manifest[i]["sha1"]
         
         for event in pg.event.get():
             if event.type == pg.QUIT or event.type == pg.KEYDOWN:
+                if cache is not None:
+                    cache.save()
                 pg.quit()
+                status.close("stopped", "Stopped from the display")
+                notifier.close()
                 raise SystemExit
         
-        # CROP POSITIONING x, y
-        crop_dim = (1100, 1100)
-        display_dim = (900, 900)
-        rml_pos = (730, 60)
-        dc_pos = (30, 165)
-        crop_pos = (75, 0)
-        dc_dim = (100, 0, 300, 300)
-        rml_dim = (100, 0, 300, 300)
         print("Index: ", i)
-        display_images(screen, SOURCE, filename, crop_dim, crop_pos, display_dim, rml_pos, dc_pos, dc_dim, rml_dim)
-        sleep(0.5) # SECONDS. Reset time between images, 0.5s = 500ms
+        if burst is not None:
+            started = time.monotonic()
+            display_images(screen, SOURCE, filename, crop_dim, crop_pos, display_dim, cache=cache, regions=regions, fiducial=(i, fiducial), cache_key=cache_key)
+            shown = time.monotonic()
+            status.stage("display", shown - started)
+            burst.displayed(i, filename)
+            # frames are written in the background and matched to images after the loop
+            burst.grab(until=shown + burst.hold)
+            status.stage("grab", time.monotonic() - shown)
+            status.image_done(i, [burst.failed.count(c) for c in range(NUM_CAMERAS)])
+            continue
+
+        started = time.monotonic()
+        display_images(screen, SOURCE, filename, crop_dim, crop_pos, display_dim, cache=cache, regions=regions, cache_key=cache_key)
+        status.stage("display", time.monotonic() - started)
+        sleep(DISPLAY_SETTLE)
+
+        # Grab from all cameras in parallel, includes one GRAB_SETTLE sleep
+        started = time.monotonic()
+        _ = capture(cam_array, img, i, PATH_ARR, frame_counts, metadata, timeout=1000, qa=qa, settle=GRAB_SETTLE, pyramid=pyramid, bayer=BAYER)
+        status.stage("capture", time.monotonic() - started)
+        status.image_done(i, [status.done + 1 - count for count in frame_counts])
 
-        # Loop over camera array to capture images, includes 200ms sleep between captures
-        _ = capture(cam_array, img, i, PATH_ARR, frame_counts, metadata, timeout=1000)
+        # apply exposure changes between images, never during a grab
+        if qa is not None and ADAPTIVE_EXPOSURE:
+            for cam_id, exposure_time in qa.exposure_updates().items():
+                set_exposure_for_context(cam_array, cam_id, exposure_time)
+                qa.exposure_applied(cam_id, exposure_time)
 
+    if burst is not None:
+        burst.close()
     cam_array.Close()
+    if burst is not None:
+        metadata["Burst"] = match_burst(DESTINATION, RIG, qa=qa, pyramid=pyramid)
+        metadata["Burst"]["Failed Grabs"] = len(burst.failed)
+    if cache is not None:
+        cache.save()
     pg.quit()
+    if pyramid is not None:
+        pyramid.close()
+        metadata["Pyramid Levels"] = list(PYRAMID_LEVELS)
+    if qa is not None:
+        qa.close()
+        metadata["Flagged Frames"] = qa.flagged
+        metadata["Exposure Changes"] = qa.exposure_changes
     with open(f'{DESTINATION}/metadata.json', 'w', encoding='utf-8') as f:
         json.dump(metadata, f, ensure_ascii=False, indent=4)
 
+    duration = (datetime.datetime.now(tz=pytz.timezone('US/Pacific')) - START_TIME).total_seconds()
+    print(f"Captured {len(indices)} images in {duration:.1f}s ({len(indices) / duration:.2f} images/s)")
     print("Capture Successful: "+ SOURCE)
-    send_notification_email(START_TIME, "success", num_images=NUM_IMG, source_path=SOURCE)
+    status.close()
+    notifier.close()
 
 except KeyboardInterrupt:
     error_msg = "Script interrupted by user (KeyboardInterrupt)"
-    send_notification_email(START_TIME, "error", error_msg)
+    notify_error(error_msg)
     raise
 
 except Exception as e:
     error_msg = f"Unexpected error: {str(e)}"
-    send_notification_email(START_TIME, "error", error_msg)
+    notify_error(error_msg)
     raise
 
 sys.stdout.close()
\ No newline at end of file
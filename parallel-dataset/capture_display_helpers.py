@@ -1,26 +1,28 @@
 import os
 import sys
-from pypylon import pylon as py
 import pygame as pg
 import numpy as np
 from natsort import natsorted
 from time import sleep
+from capture_backends import load_pylon, init_headless_display, display_region
+from capture_burst import draw_fiducial
+from source_manifest import FORMAT_LST
+from fista_files.image_io import write_tiff
 
-FORMAT_LST = ['.tiff', '.jpg', '.png']
+py = load_pylon()
 
-def set_up_directories_and_log(log, DESTINATION):
+def set_up_directories_and_log(log, DESTINATION, rig=None):
     """
     sets up output directories and log file if log==True
+    one directory per camera in RIG, the default rig is diffuser, rml, ground_truth.
+    returns the directories indexed by camera context.
     """
-    GT_PATH = f"{DESTINATION}/ground_truth"
-    RML_PATH = f"{DESTINATION}/rml"
-    DC_PATH = f"{DESTINATION}/diffuser"
-    PATH_ARR = [DC_PATH, RML_PATH, GT_PATH]
+    sub_dirs = [cam["path"] for cam in rig["cameras"]] if rig else ["diffuser", "rml", "ground_truth"]
+    PATH_ARR = [f"{DESTINATION}/{sub_dir}" for sub_dir in sub_dirs]
 
     os.makedirs(DESTINATION)
-    os.makedirs(GT_PATH)
-    os.makedirs(RML_PATH)
-    os.makedirs(DC_PATH)
+    for path in PATH_ARR:
+        os.makedirs(path)
 
     if log:
         ## SET UP LOGGING
@@ -31,7 +33,7 @@ def set_up_directories_and_log(log, DESTINATION):
 def create_camera_env(NUM_CAMERAS, SERIAL_ARR, index=None):
     """
     sets up basler pylon camera environment.
-    defines camera indicies:
+    the camera context of each camera is its index in SERIAL_ARR, for the default rig:
     - 0 = Diffuser
     - 1 = RML
     - 2 = Ground Truth
@@ -50,8 +52,12 @@ def create_camera_env(NUM_CAMERAS, SERIAL_ARR, index=None):
         for cam in cam_array:
             cam.Attach(tlf.CreateDevice(devices[index]))
     else:
-        for idx, cam in enumerate(cam_array):
-            cam.Attach(tlf.CreateDevice(devices[idx]))
+        # attach the devices listed in SERIAL_ARR, in that order
+        by_serial = {d.GetSerialNumber(): d for d in devices}
+        for serial in SERIAL_ARR:
+            assert serial in by_serial, f"Camera {serial} not detected."
+        for serial, cam in zip(SERIAL_ARR, cam_array):
+            cam.Attach(tlf.CreateDevice(by_serial[serial]))
 
     # store a unique number for each camera to identify the incoming images
     for _, cam in enumerate(cam_array):
@@ -59,15 +65,8 @@ def create_camera_env(NUM_CAMERAS, SERIAL_ARR, index=None):
         if index != None and len(SERIAL_ARR) == 1:
             # NOTE: this first if-statement is for using just ONE camera.
             idx = index 
-        elif camera_serial == SERIAL_ARR[0]:
-            idx = 0
-            # cam.Name = f"Diffuser"
-        elif camera_serial == SERIAL_ARR[1]:
-            idx = 1
-            # cam.Name = f"RML"
-        elif camera_serial == SERIAL_ARR[2]:
-            idx = 2
-            # cam.Name = f"Ground Truth"
+        else:
+            idx = SERIAL_ARR.index(camera_serial)
         cam.SetCameraContext(idx)
         
         print(f"Set context {idx} for camera {camera_serial}.")
@@ -154,11 +153,26 @@ def set_color_space(cam_array):
         cam.BslColorSpace.Value = "Off"
         print(f"Color space correction is {cam.BslColorSpace.Value} for camera {idx}")
 
-def init_metadata(DATETIME, DESTINATION, SOURCE, NUM_IMG, start_idx, CAPTURE_FORMAT, exposure_times):
+def init_metadata(DATETIME, DESTINATION, SOURCE, NUM_IMG, start_idx, CAPTURE_FORMAT, exposure_times, rig=None):
     """
     initialise metadata information.
     this will be saved as a dictionary later.
+    with a RIG, every camera gets an entry under its name and the rig itself is stored.
     """
+    if rig:
+        metadata = {
+            "Acquisition Date/Time: ": DATETIME,
+            "Destination Data Path": DESTINATION,
+            "Source Image Path": SOURCE,
+            "Number of Images": NUM_IMG,
+            "Image Start Index": start_idx,
+            "Capture Format": CAPTURE_FORMAT,
+        }
+        for cam, exposure in zip(rig["cameras"], exposure_times):
+            metadata[cam["name"]] = {"Exposure": exposure, "Serial": cam["serial"], "Role": cam["role"]}
+        metadata["Rig"] = rig
+        metadata["Failed Images"] = []
+        return metadata
     
     metadata = {
         "Acquisition Date/Time: ": DATETIME,
@@ -208,18 +222,33 @@ def set_exposure_times(cam_array, exposure_times):
         print(f"set Exposuretime {idx} for camera {camera_serial} as {exposure_times[idx]}")
         cam.ExposureTime = exposure_times[idx]
 
-def init_display(display=1, mode=pg.FULLSCREEN, flip=False):
+def set_exposure_for_context(cam_array, cam_id, exposure_time):
+    """
+    sets the exposure time of the camera with context CAM_ID
+    """
+    for cam in cam_array:
+        if cam.GetCameraContext() == cam_id:
+            print(f"set Exposuretime for camera {cam_id} as {exposure_time}")
+            cam.ExposureTime = exposure_time
+
+def init_display(display=1, mode=pg.FULLSCREEN, flip=False, headless=False):
     """
     initalise display surface for displaying images
 
     Recall that display=1 is external monitor, 0 is laptop screen
     Set display dims to be that of the EXTERNAL MONITOR so it stays CONSISTENT across devices.
+    headless=True draws to an offscreen surface of HEADLESS_SIZE instead.
     """
 
-    pg.init()
+    if headless:
+        width, height = init_headless_display()
+        pg.init()
+        display, mode = 0, 0
+    else:
+        pg.init()
 
-    screen_sizes = pg.display.get_desktop_sizes() 
-    width, height = screen_sizes[1] if len(screen_sizes) > 1 else screen_sizes[0]
+        screen_sizes = pg.display.get_desktop_sizes() 
+        width, height = screen_sizes[1] if len(screen_sizes) > 1 else screen_sizes[0]
     print(f"Screen Size: {width} x {height}")
 
     # Creates a canvas the same size as the display. Everything drawn to this canvas.
@@ -231,53 +260,69 @@ def init_display(display=1, mode=pg.FULLSCREEN, flip=False):
     
     return screen
 
-def capture(cam_array, img, i, PATH_ARR, frame_counts, metadata, timeout=1000):
+def capture(cam_array, img, i, PATH_ARR, frame_counts, metadata, timeout=1000, qa=None, settle=0.2, pyramid=None, bayer=None):
     """
     main image capture loop.
+    all cameras start grabbing together and share one settle delay, so the
+    exposures of every camera overlap instead of running back to back.
+
+    qa: optional FrameQA stage. if given, frame statistics are computed on its
+        background thread instead of in this loop and max values are not returned.
+    pyramid: optional PyramidWriter stage, writes downsampled copies of each frame on its background thread
+    bayer: Bayer pattern of a raw capture format (see image_io.bayer_pattern). raw frames are
+           written uncompressed with their CFA pattern, one sample per pixel, and demosaiced downstream
+    settle: delay in seconds between starting to grab and retrieving the frames
     """
     max_vals = []
     for cam in cam_array:
         cam.StartGrabbing(py.GrabStrategy_LatestImageOnly) # exposure delay = 46ms
-        sleep(0.2) # 200ms delay
+    sleep(settle) # 200ms delay by default
+
+    for cam in cam_array:
         with cam.RetrieveResult(timeout) as res:
             cam_id = res.GetCameraContext()
             img_nr = frame_counts[cam_id]
+            cam_path = PATH_ARR[cam_id]
+            filename = f"{cam_path}/img_{i}_cam_{cam_id}.tiff"
             
             if res.GrabSucceeded():
-                cam_path = PATH_ARR[cam_id]
                 frame_counts[cam_id] += 1
 
                 print(f"Captured Image #{img_nr} using Cam #{cam_id}", '\n')
 
                 img.AttachGrabResultBuffer(res)
-                # print maximum value of image
                 array_value = img.GetArray()
-                print(f"Max value: {np.max(array_value)}, Min value: {np.min(array_value)}, Mean value: {np.mean(array_value)}")
                 
                 # save image
-                filename = f"{cam_path}/img_{i}_cam_{cam_id}.tiff"
-                img.Save(py.ImageFileFormat_Tiff, filename)
+                if bayer is not None:
+                    write_tiff(filename, array_value, cfa=bayer)
+                else:
+                    img.Save(py.ImageFileFormat_Tiff, filename)
                 img.Release()
-                max_vals.append(np.max(array_value))
+
+                if pyramid is not None:
+                    pyramid.submit(filename, array_value)
+                if qa is not None:
+                    qa.submit(i, cam_id, filename, array_value)
+                else:
+                    # print maximum value of image
+                    print(f"Max value: {np.max(array_value)}, Min value: {np.min(array_value)}, Mean value: {np.mean(array_value)}")
+                    max_vals.append(np.max(array_value))
             else:
                 print(f"Failed: Image #{img_nr} of Cam #{cam_id}")
                 metadata["Failed Images"].append(( "Image: " + str(img_nr), filename, "Camera: " + str(cam_id)))
+
+    for cam in cam_array:
         cam.StopGrabbing()
     return max_vals
 
-def display_images(screen, SOURCE, filename, crop_dim=(1100, 1100), crop_pos=(75, 0), display_dim=(900, 900), rml_pos=(730, 60), dc_pos=(30, 165), dc_dim=(100, 0, 300, 300), rml_dim=(100, 0, 300, 300)):
-    """"
-    places two images on display for RML and diffuser
+def compose_display_frame(image, crop_dim=(1100, 1100), display_dim=(900, 900), regions=(((30, 165), (100, 0, 300, 300)), ((730, 60), (100, 0, 300, 300)))):
+    """
+    composes the crop surface for the lensless imagers from IMAGE and rescales it to DISPLAY_DIM.
+    returns the surface that is blitted onto the display.
 
-    crop_dim: dimensions of crop surface
-    display_dim: dimensions of display surface
-    rml_pos: position of rml image on crop surface
-    dc_pos: position of diffusercam image on crop surface
-    crop_pos: position of crop surface on display surface
+    regions: (pos, dim) for each lensless imager, default is diffuser then rml
     """
-    screen.fill("black")
-    print("Displaying: ", SOURCE + filename)
-    image = pg.image.load(SOURCE + filename)
     img_size = image.get_size() # (width,height)
     print(f"Image Size: {img_size}")
 
@@ -289,14 +334,45 @@ def display_images(screen, SOURCE, filename, crop_dim=(1100, 1100), crop_pos=(75
     if img_size[0] < img_size[1]:
         image = pg.transform.flip(image, True , False)
 
-    # Crop the images to RML_DIM
-    # Place on the crop surface at RML_POS for upper left-hand corner
+    # Crop the images to each DIM
+    # Place on the crop surface at each POS for upper left-hand corner
     # Ex: (image, (top left corner of image), (square positions and dimensions of image))
-    crop.blits(((image, dc_pos, dc_dim), (image, rml_pos, rml_dim)))
+    crop.blits([(image, pos, dim) for pos, dim in regions])
+
+    # Rescale the crop surfqace to DISPLAY_DIM
+    return pg.transform.scale(crop, display_dim)
 
-    # Rescale the crop surfqace to DISPLAY_DIM at CROP_POS on the display
+def display_images(screen, SOURCE, filename, crop_dim=(1100, 1100), crop_pos=(75, 0), display_dim=(900, 900), rml_pos=(730, 60), dc_pos=(30, 165), dc_dim=(100, 0, 300, 300), rml_dim=(100, 0, 300, 300), cache=None, regions=None, fiducial=None, cache_key=None):
+    """"
+    places two images on display for RML and diffuser
+
+    crop_dim: dimensions of crop surface
+    display_dim: dimensions of display surface
+    rml_pos: position of rml image on crop surface
+    dc_pos: position of diffusercam image on crop surface
+    crop_pos: position of crop surface on display surface
+    cache: optional DisplayFrameCache built for the same layout
+    cache_key: optional content hash of the image from the source manifest, the cache key
+    regions: optional (pos, dim) for every lensless imager, replaces the rml and dc positions
+    fiducial: optional (index, (x, y, w, h) on the crop surface), draws the burst fiducial of index there
+    """
+    if regions is None:
+        regions = ((dc_pos, dc_dim), (rml_pos, rml_dim))
+    screen.fill("black")
+    print("Displaying: ", SOURCE + filename)
+    frame = cache.get(SOURCE + filename, key=cache_key) if cache is not None else None
+    if frame is None:
+        image = pg.image.load(SOURCE + filename)
+        frame = compose_display_frame(image, crop_dim, display_dim, regions)
+        if cache is not None:
+            cache.put(SOURCE + filename, frame, key=cache_key)
+
+    # Place the rescaled crop surface at CROP_POS on the display
     # Remember, this is in display coordinates.
-    screen.blit(pg.transform.scale(crop, display_dim), crop_pos)
+    screen.blit(frame, crop_pos)
+    if fiducial is not None:
+        index, (x, y, w, h) = fiducial
+        draw_fiducial(screen, index, display_region((x, y), (0, 0, w, h), crop_dim, crop_pos, display_dim))
     pg.display.flip()
 
 def display_single_image(screen, SOURCE, filename, crop_dim=(1100, 1100), crop_pos=(75, 0), display_dim=(900, 900), rml_pos=(730, 60), dc_pos=(30, 165), dc_dim=(100, 0, 300, 300), rml_dim=(100, 0, 300, 300), camera=0):
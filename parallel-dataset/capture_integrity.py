@@ -0,0 +1,213 @@
+import os
+import sys
+import json
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from fista_files.image_io import read_image
+from evaluation import image_index
+from rig_config import RIG_FILE, load_rig, display_regions
+from reconstruction_online import DirectoryFollower, FILE_SETTLE
+from source_manifest import FORMAT_LST, load_manifest
+
+"""
+Finds stale, duplicated and out-of-order frames in a capture.
+
+Every frame is reduced to a THUMB_SHAPE grayscale thumbnail (from the x8
+pyramid copy when the capture wrote one). Thumbnails of a camera have the
+camera's mean thumbnail subtracted, which removes what all frames share (the
+PSF pattern of a lensless imager, the display border), and are normalized, so
+every comparison is a dot product over the whole capture at once:
+- any camera: a frame that correlates above DUPLICATE_CORR with the previous
+  or next index of the same camera is a duplicate, e.g. the camera grabbed
+  before the display changed, or a buffered frame was returned
+- ground truth cameras: the frame is also correlated with the expected display
+  frames of the source images within SEARCH indices, composed from the rig
+  layout like display_images() does. a frame that matches another index better
+  by MARGIN is out of order, one that matches its own image below
+  MIN_SOURCE_CORR is flagged as a mismatch
+
+Flags are written to SUB_DIR/integrity.json. With --follow, the capture is
+checked again every POLL_INTERVAL seconds while it runs, and new flags are
+printed as they appear. Stops once the capture has written metadata.json.
+
+USAGE:
+    python3 capture_integrity.py DESTINATION SUB_DIR SOURCE [RIG] [--follow]
+"""
+
+THUMB_SHAPE = (24, 24)   # the ground truth camera sees the square display frame stretched over the sensor
+DUPLICATE_CORR = 0.98
+MIN_SOURCE_CORR = 0.3
+MARGIN = 0.05
+SEARCH = 2               # source indices on either side compared with each ground truth frame
+SOURCE_FACTOR = 4        # source images are decoded at reduced size
+NUM_READERS = 8
+POLL_INTERVAL = 2.0
+
+def thumbnail(image, shape=THUMB_SHAPE):
+    import cv2
+    image = np.asarray(image, dtype=np.float32)
+    if image.ndim == 3:
+        image = image[..., :3].mean(axis=2)
+    return cv2.resize(image, (shape[1], shape[0]), interpolation=cv2.INTER_AREA)
+
+def frame_thumbnail(path, shape=THUMB_SHAPE):
+    return thumbnail(read_image(path, factor=8), shape)
+
+def source_thumbnail(path, rig, shape=THUMB_SHAPE, factor=SOURCE_FACTOR):
+    """
+    thumbnail of the display frame compose_display_frame() builds from the source image at PATH,
+    a black one for images removed from the source
+    """
+    if path is None:
+        return np.zeros(shape, dtype=np.float32)
+    image = np.asarray(read_image(path, factor=factor), dtype=np.float32)
+    if image.ndim == 2:
+        image = image[..., None]
+    if image.shape[1] < image.shape[0]:
+        image = image[:, ::-1] # vertical images are flipped, as on the display
+    crop_dim = rig["display"]["crop_dim"]
+    canvas = np.zeros((crop_dim[1] // factor, crop_dim[0] // factor, image.shape[2]), dtype=np.float32)
+    for (px, py), (x, y, w, h) in display_regions(rig):
+        px, py, x, y, w, h = (v // factor for v in (px, py, x, y, w, h))
+        patch = image[y:y + h, x:x + w]
+        patch = patch[:canvas.shape[0] - py, :canvas.shape[1] - px]
+        canvas[py:py + patch.shape[0], px:px + patch.shape[1]] = patch
+    return thumbnail(canvas, shape)
+
+def normalize(thumbs):
+    """
+    (frames, pixels) of THUMBS with the mean thumbnail subtracted, zero mean and unit norm per frame
+    """
+    t = thumbs.reshape(len(thumbs), -1)
+    t = t - t.mean(axis=0, keepdims=True)
+    t = t - t.mean(axis=1, keepdims=True)
+    return t / np.maximum(np.linalg.norm(t, axis=1, keepdims=True), 1e-12)
+
+def check_camera(indices, thumbs, cam_name):
+    """
+    duplicate flags of one camera, frames sorted by index
+    """
+    flags = []
+    if len(indices) < 2:
+        return flags
+    t = normalize(thumbs)
+    corr = np.sum(t[1:]*t[:-1], axis=1) # correlation of each frame with the previous one
+    consecutive = np.diff(indices) == 1
+    for k in np.flatnonzero((corr > DUPLICATE_CORR) & consecutive):
+        flags.append({"camera": cam_name, "index": int(indices[k + 1]), "flag": "duplicate",
+                      "of": int(indices[k]), "corr": round(float(corr[k]), 4)})
+    return flags
+
+def check_ground_truth(indices, thumbs, source_thumbs, num_sources, cam_name):
+    """
+    out of order and mismatch flags of a ground truth camera against SOURCE_THUMBS,
+    {source index: thumbnail} holding at least the indices within SEARCH of INDICES
+    """
+    flags = []
+    t = normalize(thumbs)
+    offsets = np.arange(-SEARCH, SEARCH + 1)
+    candidates = np.asarray(indices)[:, None] + offsets[None, :]
+    valid = (candidates >= 0) & (candidates < num_sources)
+    needed = sorted(set(candidates[valid].tolist()))
+    s = normalize(np.stack([source_thumbs[i] for i in needed])) if needed else np.zeros((1, t.shape[1]))
+    rows = np.clip(np.searchsorted(needed, candidates), 0, len(s) - 1)
+    # (frames, offsets) correlations with the expected frames around each index
+    corr = np.einsum('fp,fop->fo', t, s[rows])
+    corr[~valid] = -np.inf
+    own = corr[:, SEARCH]
+    best = np.argmax(corr, axis=1)
+    for k, index in enumerate(indices):
+        if best[k] != SEARCH and corr[k, best[k]] > own[k] + MARGIN:
+            flags.append({"camera": cam_name, "index": int(index), "flag": "out_of_order",
+                          "matches": int(candidates[k, best[k]]), "corr": round(float(corr[k, best[k]]), 4), "own_corr": round(float(own[k]), 4)})
+        elif own[k] < MIN_SOURCE_CORR:
+            flags.append({"camera": cam_name, "index": int(index), "flag": "mismatch", "own_corr": round(float(own[k]), 4)})
+    return flags
+
+class IntegrityChecker():
+    """
+    thumbnails of the frames of SUB_DIR and of the SOURCE images, loaded once and kept,
+    so a running capture can be checked again as it grows. source thumbnails are only
+    built for the indices within SEARCH of a captured ground truth frame
+    """
+    def __init__(self, sub_dir, source, rig, settle=0):
+        """
+        settle: seconds a frame must be unchanged before it is read, for a running capture
+        """
+        self.rig = rig
+        self.cameras = {idx: cam for idx, cam in enumerate(rig["cameras"])}
+        self.follower = DirectoryFollower({idx: f"{sub_dir}/{cam['path']}" for idx, cam in self.cameras.items()}, settle=settle)
+        self.thumbs = {idx: {} for idx in self.cameras} # camera context: {index: thumbnail}
+        self.pool = ThreadPoolExecutor(NUM_READERS)
+
+        # the capture's image order, from the source manifest if there is one
+        manifest = load_manifest(source)
+        if manifest is not None:
+            names = manifest.filenames()
+        else:
+            from natsort import natsorted
+            names = natsorted([p for p in os.listdir(source) if any(fmt in p for fmt in FORMAT_LST) and not p.startswith('.')])
+        self.source_paths = [os.path.join(source, name) if name else None for name in names]
+        self.source_thumbs = {} # source index: thumbnail
+
+    def update(self, settle=None):
+        """
+        loads the thumbnails of new frames, returns their number.
+        SETTLE overrides the settle time of the follower, 0 once the capture is done
+        """
+        new = self.follower.poll(settle)
+        thumbs = self.pool.map(frame_thumbnail, [path for _, path in new])
+        needed = set()
+        for (ctx, path), thumb in zip(new, thumbs):
+            index = image_index(path)
+            self.thumbs[ctx][index] = thumb
+            if self.cameras[ctx]["role"] == "ground_truth":
+                needed.update(range(max(index - SEARCH, 0), min(index + SEARCH + 1, len(self.source_paths))))
+        needed = sorted(needed - set(self.source_thumbs))
+        thumbs = self.pool.map(lambda i: source_thumbnail(self.source_paths[i], self.rig), needed)
+        self.source_thumbs.update(zip(needed, thumbs))
+        return len(new)
+
+    def check(self):
+        flags = []
+        for ctx, cam in self.cameras.items():
+            if not self.thumbs[ctx]:
+                continue
+            indices = sorted(self.thumbs[ctx])
+            thumbs = np.stack([self.thumbs[ctx][i] for i in indices])
+            flags += check_camera(indices, thumbs, cam["name"])
+            if cam["role"] == "ground_truth":
+                flags += check_ground_truth(indices, thumbs, self.source_thumbs, len(self.source_paths), cam["name"])
+        return flags
+
+def main(args):
+    follow = '--follow' in args
+    args = [a for a in args if a != '--follow']
+    DESTINATION, SUB_DIR, SOURCE = args[1], args[1] + args[2], args[3]
+    RIG = load_rig(args[4] if len(args) > 4 else RIG_FILE)
+
+    checker = IntegrityChecker(SUB_DIR, SOURCE, RIG, settle=FILE_SETTLE if follow else 0)
+    start = time.time()
+    reported = set()
+    while True:
+        capture_done = os.path.exists(f"{SUB_DIR}/metadata.json")
+        # metadata.json is written after the last frame, so no file is still being written
+        new = checker.update(settle=0 if capture_done else None)
+        flags = checker.check()
+        for flag in flags:
+            key = (flag["camera"], flag["index"], flag["flag"])
+            if key not in reported:
+                reported.add(key)
+                print("Flagged: ", flag)
+        if not follow or (capture_done and not new):
+            break
+        time.sleep(POLL_INTERVAL)
+
+    frames = sum(len(t) for t in checker.thumbs.values())
+    with open(f"{SUB_DIR}/integrity.json", 'w') as out:
+        json.dump({"frames": frames, "flags": flags}, out, indent=4)
+    print(f"Checked {frames} frames in {time.time() - start:.1f}s, {len(flags)} flagged, see {SUB_DIR}/integrity.json")
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,86 @@
+import os
+import queue
+import threading
+import numpy as np
+from fista_files.image_io import bin_bayer, downsample_area, pyramid_path, write_tiff
+
+"""
+Reduced-resolution copies of every captured frame for capture_display.py.
+
+Each frame is area downsampled by LEVELS (4 and 8 by default) on a background
+thread, so the grab loop only pays for a queue put, and the copies are written
+next to the full resolution frame as {imager}/x4/img_*.tiff and
+{imager}/x8/img_*.tiff. Coarser levels are computed from the finest one, so
+the full frame is only read once. read_image() (fista_files/image_io.py) picks
+the smallest level that divides the requested factor on its own, e.g.
+preprocessing at f=8 reads the x8 copy instead of the full frame.
+
+Copies are stored as float32 block means, not rounded to the frame's dtype:
+the mean of an 8x8 block carries 1/64 DN of precision that dark lensless
+measurements need, and read_image() returns the same values whether or not
+a copy exists. Each level is 1/16 or 1/64 of the frame's pixels.
+
+Raw Bayer frames are binned 2x2 to RGB first, so their copies are RGB images
+and are read like the copies of an RGB capture.
+
+Copies are written to a temporary name and renamed, so a reader never sees a
+partial file.
+"""
+
+PYRAMID_LEVELS = (4, 8)
+
+class PyramidWriter(threading.Thread):
+    """
+    background pyramid stage. call submit() from the grab loop and close() when done.
+
+    levels: downsample factors, each a multiple of the previous one
+    bayer: Bayer pattern of raw (rows, cols) frames, None for RGB or mono frames
+    """
+    def __init__(self, levels=PYRAMID_LEVELS, bayer=None):
+        super().__init__(daemon=True)
+        self.levels = sorted(levels)
+        self.bayer = bayer
+        assert bayer is None or self.levels[0] % 2 == 0, "Pyramid levels of raw frames must be even."
+        assert all(b % a == 0 for a, b in zip(self.levels, self.levels[1:])), "Each pyramid level must divide the next."
+        self.queue = queue.Queue(maxsize=32)
+        self.written = 0
+        self.failed = []
+        self.start()
+
+    def submit(self, filename, frame):
+        """
+        queues a frame saved at FILENAME. FRAME must not be reused by the caller.
+        """
+        self.queue.put((filename, frame))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self.process(*item)
+            except Exception as e:
+                print(f"Pyramid failed for {item[0]}: {e}")
+                self.failed.append(item[0])
+
+    def process(self, filename, frame):
+        reduced, factor = frame, 1
+        if self.bayer is not None and frame.ndim == 2:
+            reduced, factor = bin_bayer(frame, self.bayer), 2
+        for level in self.levels:
+            reduced = downsample_area(reduced, level // factor)
+            factor = level
+            out = pyramid_path(filename, level)
+            os.makedirs(os.path.dirname(out), exist_ok=True)
+            tmp = out + '.tmp'
+            write_tiff(tmp, reduced.astype(np.float32, copy=False))
+            os.replace(tmp, out)
+        self.written += 1
+
+    def close(self):
+        """
+        writes the remaining frames.
+        """
+        self.queue.put(None)
+        self.join()
@@ -0,0 +1,188 @@
+import json
+import queue
+import threading
+import numpy as np
+
+"""
+Per-frame exposure and saturation QA for capture_display.py.
+
+Frames are handed to a background thread so the grab loop only pays for a
+queue put. Every frame gets one histogram pass, and all statistics (max, min,
+mean, saturation, clipped channels, percentiles) are read off that histogram.
+Results are appended to DESTINATION/journal.jsonl, one JSON object per frame.
+"""
+
+# default thresholds for flagging frames
+QA_THRESHOLDS = {
+    "max_saturated_fraction": 0.001, # fraction of saturated values in a frame
+    "max_clipped_channels": 0,       # channels that contain any saturated value
+    "min_p99": 0.05,                 # 99th percentile as a fraction of full scale
+}
+
+# closed-loop exposure settings, exposure in microseconds
+EXPOSURE_BOUNDS = (1500, 80000) # max = 80ms, min = 1.5ms
+EXPOSURE_TARGET = 0.85          # target 99th percentile as a fraction of full scale
+EXPOSURE_MAX_STEP = 1.25        # max multiplicative change between two images
+
+HIST_SUMMARY_BINS = 16
+
+def frame_histogram(frame, bit_depth=8):
+    """
+    per-channel histogram of FRAME in a single bincount.
+    returns an array of shape (channels, 2**bit_depth).
+    """
+    levels = 2**bit_depth
+    frame = frame.reshape(frame.shape[0], frame.shape[1], -1)
+    channels = frame.shape[-1]
+    if channels == 1:
+        return np.bincount(frame.ravel(), minlength=levels)[None, :levels]
+    offsets = np.arange(channels, dtype=np.int32) * levels
+    values = frame.astype(np.int32) + offsets
+    return np.bincount(values.ravel(), minlength=channels*levels).reshape(channels, levels)
+
+def frame_stats(hist):
+    """
+    computes QA statistics from a per-channel histogram.
+    all values are derived from HIST so the frame is only read once.
+    """
+    channels, levels = hist.shape
+    total = hist.sum(axis=1)
+    values = np.arange(levels)
+    nonzero = hist > 0
+
+    # highest and lowest occupied bin per channel
+    ch_max = levels - 1 - np.argmax(nonzero[:, ::-1], axis=1)
+    ch_min = np.argmax(nonzero, axis=1)
+    mean = (hist @ values).sum() / total.sum()
+
+    saturated = hist[:, -1]
+    cdf = np.cumsum(hist.sum(axis=0)) / total.sum()
+    p1, p50, p99 = np.searchsorted(cdf, [0.01, 0.5, 0.99])
+
+    # coarse histogram summary for the journal
+    summary = hist.reshape(channels, HIST_SUMMARY_BINS, -1).sum(axis=2) / total[:, None]
+
+    return {
+        "max": int(ch_max.max()),
+        "min": int(ch_min.min()),
+        "mean": float(mean),
+        "saturated_fraction": float(saturated.sum() / total.sum()),
+        "clipped_channels": int(np.count_nonzero(saturated)),
+        "p1": int(p1),
+        "p50": int(p50),
+        "p99": int(p99),
+        "histogram": np.round(summary, 4).tolist(),
+    }
+
+def check_thresholds(stats, full_scale, thresholds=QA_THRESHOLDS):
+    """
+    returns a list of flags for the thresholds STATS violates.
+    """
+    flags = []
+    if stats["saturated_fraction"] > thresholds["max_saturated_fraction"]:
+        flags.append("saturated")
+    if stats["clipped_channels"] > thresholds["max_clipped_channels"]:
+        flags.append("clipped")
+    if stats["p99"] < thresholds["min_p99"] * full_scale:
+        flags.append("underexposed")
+    return flags
+
+def suggest_exposure(stats, exposure, full_scale, bounds=EXPOSURE_BOUNDS, target=EXPOSURE_TARGET, max_step=EXPOSURE_MAX_STEP):
+    """
+    nudges EXPOSURE so the 99th percentile moves towards TARGET * full scale.
+    the change is limited to MAX_STEP per image and clamped to BOUNDS.
+    saturated frames are always stepped down since p99 underestimates clipping.
+    """
+    if stats["clipped_channels"] > 0:
+        factor = 1 / max_step
+    else:
+        factor = target * full_scale / max(stats["p99"], 1)
+        factor = min(max(factor, 1 / max_step), max_step)
+    new_exposure = min(max(exposure * factor, bounds[0]), bounds[1])
+    return int(round(new_exposure))
+
+class FrameQA(threading.Thread):
+    """
+    background QA stage. call submit() from the grab loop and close() when done.
+
+    journal_path: path of the jsonl journal
+    exposure_times: exposure time set on each camera, indexed by camera context. call
+                    exposure_applied() once a suggestion is set on the camera
+    adaptive: if True, exposure suggestions are collected for exposure_updates()
+    """
+    def __init__(self, journal_path, exposure_times, bit_depth=8, thresholds=QA_THRESHOLDS, adaptive=False, bounds=EXPOSURE_BOUNDS):
+        super().__init__(daemon=True)
+        self.queue = queue.Queue(maxsize=32)
+        self.journal = open(journal_path, 'a')
+        self.exposure_times = list(exposure_times)
+        self.bit_depth = bit_depth
+        self.full_scale = 2**bit_depth - 1
+        self.thresholds = thresholds
+        self.adaptive = adaptive
+        self.bounds = bounds
+
+        self.flagged = []
+        self.exposure_changes = []
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.start()
+
+    def submit(self, index, cam_id, filename, frame, exposure=None):
+        """
+        queues a frame for QA. FRAME must not be reused by the caller.
+        EXPOSURE is the exposure time the frame was taken at, the one set on the camera by default
+        """
+        exposure = self.exposure_times[cam_id] if exposure is None else exposure
+        self.queue.put((index, cam_id, filename, frame, exposure))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self.process(*item)
+
+    def process(self, index, cam_id, filename, frame, exposure):
+        stats = frame_stats(frame_histogram(frame, self.bit_depth))
+        flags = check_thresholds(stats, self.full_scale, self.thresholds)
+        print(f"QA img {index} cam {cam_id}: max {stats['max']}, min {stats['min']}, mean {stats['mean']:.2f}, saturated {stats['saturated_fraction']:.4f}, flags {flags}")
+
+        entry = {"index": index, "camera": cam_id, "file": filename, "exposure": exposure, "qa": stats, "flags": flags}
+        if flags:
+            self.flagged.append((index, cam_id, filename, flags))
+
+        # suggestions start from the exposure of this frame, so frames queued before a change
+        # was applied suggest the same value instead of stepping again
+        if self.adaptive:
+            new_exposure = suggest_exposure(stats, exposure, self.full_scale, self.bounds)
+            if new_exposure != exposure:
+                with self._lock:
+                    self._pending[cam_id] = new_exposure
+                self.exposure_changes.append((index, cam_id, exposure, new_exposure))
+                entry["next_exposure"] = new_exposure
+
+        self.journal.write(json.dumps(entry) + '\n')
+        self.journal.flush()
+
+    def exposure_updates(self):
+        """
+        returns and clears {camera context: exposure time} suggested since the last call.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def exposure_applied(self, cam_id, exposure):
+        """
+        records that EXPOSURE is now set on the camera with context CAM_ID, frames submitted
+        from now on are journaled with it
+        """
+        self.exposure_times[cam_id] = exposure
+
+    def close(self):
+        """
+        processes the remaining frames and closes the journal.
+        """
+        self.queue.put(None)
+        self.join()
+        self.journal.close()
@@ -0,0 +1,254 @@
+import os
+import json
+import time
+import queue
+import datetime
+import threading
+import collections
+import smtplib
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+
+"""
+Live progress of a capture for capture_display.py.
+
+CaptureStatus keeps throughput (images/s overall and over the last
+RATE_WINDOW images), the ETA, per-camera grab failures, the latency of every
+stage of the grab loop and the backlog of the background stages. A background
+thread rewrites DESTINATION/status.json every STATUS_INTERVAL seconds
+(written to a temporary name and renamed, so readers never see a partial
+file), and with a port the same JSON is served over HTTP:
+
+    curl http://localhost:8765/
+
+The grab loop only records numbers under a lock, nothing is written or sent
+from it.
+
+Notifier sends e-mails from its own thread, at MILESTONES fractions of the
+capture and when it ends or fails. Messages are queued without blocking, and
+dropped if the queue is full, so a slow or unreachable SMTP server never
+stalls acquisition. Any SMTP server works, e.g. a local stand-in for testing:
+
+    python3 -m aiosmtpd -n -l localhost:8025   # then SMTP_HOST = "localhost", SMTP_PORT = 8025, SMTP_STARTTLS = False
+"""
+
+STATUS_INTERVAL = 10.0   # seconds between rewrites of status.json
+RATE_WINDOW = 50         # recent images for the current rate, ETA and stage latencies
+NOTIFY_MILESTONES = (0.25, 0.5, 0.75)
+SMTP_TIMEOUT = 30        # seconds, per connection attempt
+
+class Notifier(threading.Thread):
+    """
+    background e-mail sender. notify() queues a message and returns immediately.
+    messages are only sent when SENDER and RECIPIENT are set.
+    """
+    def __init__(self, sender, password, recipient, host="smtp.gmail.com", port=587, starttls=True, timeout=SMTP_TIMEOUT):
+        super().__init__(daemon=True)
+        self.sender = sender
+        self.password = password
+        self.recipient = recipient
+        self.host = host
+        self.port = port
+        self.starttls = starttls
+        self.timeout = timeout
+        self.enabled = all(v and v != "TODO" for v in (sender, recipient))
+        self.queue = queue.Queue(maxsize=16)
+        self.sent = 0
+        self.failed = 0
+        if not self.enabled:
+            print("E-mail notifications are off, set SENDER_EMAIL and RECIPIENT_EMAIL to enable them")
+        self.start()
+
+    def notify(self, subject, body):
+        if not self.enabled:
+            return
+        try:
+            self.queue.put_nowait((subject, body))
+        except queue.Full:
+            print(f"Notification dropped, queue full: {subject}")
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self.send(*item)
+                self.sent += 1
+                print(f"Notification sent: {item[0]}")
+            except Exception as e:
+                self.failed += 1
+                print(f"Failed to send email: {e}")
+
+    def send(self, subject, body):
+        message = MIMEMultipart()
+        message["From"] = self.sender
+        message["To"] = self.recipient
+        message["Subject"] = subject
+        message.attach(MIMEText(body, "plain"))
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as server:
+            if self.starttls:
+                server.starttls()
+            if self.password and self.password != "TODO":
+                server.login(self.sender, self.password)
+            server.send_message(message)
+
+    def close(self, timeout=2*SMTP_TIMEOUT):
+        """
+        sends the queued messages, waiting at most TIMEOUT seconds
+        """
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.join(timeout)
+
+class CaptureStatus(threading.Thread):
+    """
+    progress of a capture of TOTAL images with CAMERAS (names by camera context).
+
+    call stage() with the duration of every step of the grab loop and image_done() after
+    every image, then close(). START_TIME is the (timezone aware) start of the capture,
+    used in notifications. QUEUES: {name: queue.Queue} of background stages, their backlog is reported.
+    DETAILS: {label: value} added to notifications, e.g. the source and destination paths
+    """
+    def __init__(self, path, total, cameras, start_time, notifier=None, milestones=NOTIFY_MILESTONES, port=None, queues=None, details=None, interval=STATUS_INTERVAL):
+        super().__init__(daemon=True)
+        self.path = path
+        self.total = total
+        self.cameras = list(cameras)
+        self.start_time = start_time
+        self.notifier = notifier
+        self.milestones = sorted(milestones)
+        self.queues = queues or {}
+        self.details = details or {}
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+        self.started = time.monotonic()
+        self.done = 0
+        self.last_index = None
+        self.failures = [0]*len(self.cameras)
+        self.finished = collections.deque(maxlen=RATE_WINDOW + 1) # completion times of recent images
+        self.stages = {} # name: deque of recent durations
+        self.state = "running"
+        self.error = None
+
+        self.server = None
+        if port:
+            self.server = self.serve(port)
+        self.start()
+
+    def stage(self, name, seconds):
+        with self.lock:
+            self.stages.setdefault(name, collections.deque(maxlen=RATE_WINDOW)).append(seconds)
+
+    def image_done(self, index, failures=None):
+        """
+        FAILURES: grab failures so far of every camera context
+        """
+        with self.lock:
+            before = self.done / self.total if self.total else 1
+            self.done += 1
+            self.last_index = index
+            self.finished.append(time.monotonic())
+            if failures is not None:
+                self.failures = list(failures)
+            after = self.done / self.total if self.total else 1
+        for milestone in self.milestones:
+            if before < milestone <= after and self.notifier is not None:
+                self.notifier.notify(f"Image Capture {milestone:.0%} Complete", self.report())
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.started
+            rate = self.done / elapsed if elapsed > 0 else 0.0
+            recent = rate
+            if len(self.finished) > 1:
+                recent = (len(self.finished) - 1) / max(self.finished[-1] - self.finished[0], 1e-9)
+            remaining = self.total - self.done
+            return {
+                "state": self.state,
+                "error": self.error,
+                "images_done": self.done,
+                "images_total": self.total,
+                "last_index": self.last_index,
+                "elapsed_s": round(elapsed, 1),
+                "images_per_s": round(rate, 3),
+                "recent_images_per_s": round(recent, 3),
+                "eta_s": round(remaining / recent, 1) if recent > 0 else None,
+                "failures": dict(zip(self.cameras, self.failures)),
+                "stage_latency_s": {name: {"last": round(d[-1], 4), "mean": round(sum(d) / len(d), 4), "max": round(max(d), 4)}
+                                    for name, d in self.stages.items() if d},
+                "backlog": {name: q.qsize() for name, q in self.queues.items()},
+                "updated": time.time(),
+            }
+
+    def report(self):
+        """
+        plain text summary for notifications
+        """
+        s = self.snapshot()
+        eta = f"{s['eta_s'] / 3600:.1f} h" if s["eta_s"] is not None else "unknown"
+        failures = ", ".join(f"{name}: {n}" for name, n in s["failures"].items())
+        end = [] if s["state"] == "running" else [f"End time: {datetime.datetime.now(tz=self.start_time.tzinfo)}"]
+        return "\n".join([f"Start time: {self.start_time}"] + end + [
+            f"Images: {s['images_done']} / {s['images_total']} (last index {s['last_index']})",
+            f"Elapsed: {s['elapsed_s'] / 3600:.2f} h",
+            f"Rate: {s['images_per_s']:.2f} images/s, recently {s['recent_images_per_s']:.2f} images/s",
+            f"ETA: {eta}",
+            f"Failed grabs: {failures}",
+        ] + [f"{label}: {value}" for label, value in self.details.items()] + ([f"Error message: {s['error']}"] if s["error"] else []))
+
+    def write(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as out:
+            json.dump(self.snapshot(), out, indent=4)
+        os.replace(tmp, self.path)
+
+    def serve(self, port, host="127.0.0.1"):
+        """
+        serves the snapshot as JSON on HOST:PORT from a daemon thread
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        status = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(status.snapshot(), indent=4).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass # requests would otherwise go to the capture log
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Capture status on http://{host}:{port}/")
+        return server
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except Exception as e:
+                print(f"Status write failed: {e}")
+
+    def close(self, state="done", error=None):
+        """
+        writes the final status and queues the completion or error notification
+        """
+        with self.lock:
+            self.state, self.error = state, error
+        self.stopped.set()
+        self.join()
+        self.write()
+        if self.server is not None:
+            self.server.shutdown()
+        if self.notifier is not None:
+            subject = {"done": "Image Capture Complete", "stopped": "Image Capture Stopped"}.get(state, "⚠️ Image Capture Error")
+            self.notifier.notify(subject, self.report())
@@ -0,0 +1,64 @@
+import os
+import sys
+import subprocess
+
+"""
+Import-time budget for the modules loaded by short lived reconstruction workers.
+
+Each module is imported in a fresh interpreter with `python -X importtime`.
+The check fails if the cumulative import time (best of RUNS) is over budget,
+or if a heavy optional dependency is pulled in at import time.
+
+USAGE:
+    python3 check_import_time.py
+"""
+
+RUNS = 3
+
+# module: (directory added to sys.path, budget in ms)
+IMPORT_BUDGETS = {
+    "fista_spectral_cupy": (".", 250),
+    "admm_spectral": (".", 250),
+    "fista_files.helper_functions": (".", 250),
+    "apply_homography": ("homography", 250),
+}
+
+# only allowed once a plotting or optional path is used
+FORBIDDEN_IMPORTS = ["matplotlib", "torch", "kornia", "skimage", "cv2", "natsort", "cupy"]
+
+def import_time(module, path):
+    """
+    returns (cumulative import time of MODULE in ms, top level packages imported with it)
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    code = f"import sys; sys.path.insert(0, {os.path.join(root, path)!r}); import {module}"
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, check=True, cwd=root).stderr
+
+    total, packages = None, set()
+    for line in out.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue # header
+        packages.add(name.strip().split(".")[0])
+        if name.strip() == module and not name[1:].startswith(" "):
+            total = int(cumulative) / 1000
+    return total, packages
+
+def main():
+    failed = False
+    for module, (path, budget) in IMPORT_BUDGETS.items():
+        runs = [import_time(module, path) for _ in range(RUNS)]
+        best = min(t for t, _ in runs)
+        heavy = sorted(set(FORBIDDEN_IMPORTS) & runs[0][1])
+
+        status = "ok"
+        if best > budget or heavy:
+            status = "FAIL"
+            failed = True
+        print(f"{status:4} {module}: {best:.1f} ms (budget {budget} ms)" + (f", imports {', '.join(heavy)}" if heavy else ""))
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import sys
+import time
+import numpy as np
+from recon_helpers import FISTA_PARAMS, ADMM_PARAMS
+import fista_spectral_cupy as FSC
+from admm_spectral import admm_spectral
+
+"""
+Time-to-quality comparison of the FISTA and ADMM solvers, and of FISTA with
+support-sized padding (fista_support) against the default full padding.
+
+Each solver is run for increasing iteration counts and its wall clock time and
+PSNR against a reference are printed. The reference is REFERENCE, an image
+aligned with the reconstruction (e.g. a warped ground truth), or else a
+REFERENCE_ITERS iteration FISTA solve. Without arguments, a synthetic scene is
+measured through a synthetic PSF and the scene itself is the reference.
+
+USAGE:
+    python3 compare_solvers.py [PSF IMG [REFERENCE]]
+"""
+
+f = 8 # downsample factor
+grayscale = False
+backend = 'numpy'
+num_threads = None
+
+CHECKPOINTS = {
+    'fista': [25, 50, 100, 200],
+    'fista_support': [25, 50, 100, 200],
+    'admm': [10, 25, 50, 100, 200],
+}
+REFERENCE_ITERS = 1000
+SYNTHETIC_SHAPE = (150, 240)
+
+def psnr(x, ref):
+    x = x / np.max(x)
+    ref = ref / np.max(ref)
+    return 10*np.log10(1 / np.mean((x - ref)**2))
+
+def synthetic_data(shape=SYNTHETIC_SHAPE, seed=0):
+    """
+    returns psf, measurement, mask and the scene for a smooth random scene
+    seen through a diffuser-like synthetic PSF, with 1% noise
+    """
+    import scipy.ndimage
+    from capture_backends import synthetic_psf
+    rng = np.random.default_rng(seed)
+    psf = synthetic_psf(shape, 200, seed)[..., None].astype(np.float64)
+    psf = psf / np.linalg.norm(psf)
+
+    scene = scipy.ndimage.gaussian_filter(rng.random(shape), 3)[..., None]
+    scene = (scene - scene.min()) / (scene.max() - scene.min())
+    fista = FSC.fista_spectral_numpy(psf, np.ones(psf.shape))
+    meas = fista.Hfor(fista.pad(scene))
+    meas = meas + 0.01*np.max(meas)*rng.standard_normal(meas.shape)
+    return psf, meas / np.max(meas), np.ones(psf.shape), scene
+
+def make_solver(name, psf, mask, iters):
+    if name in ('fista', 'fista_support'):
+        padding = 'support' if name == 'fista_support' else 'full'
+        solver, params = FSC.fista_spectral_numpy(psf, mask, gray=grayscale, backend=backend, num_threads=num_threads, padding=padding), FISTA_PARAMS
+    else:
+        solver, params = admm_spectral(psf, mask, gray=grayscale, backend=backend, num_threads=num_threads), ADMM_PARAMS
+    for key, value in params.items():
+        setattr(solver, key, value)
+    solver.iters = iters
+    return solver
+
+def time_to_quality(name, psf, mask, meas, reference):
+    """
+    [(iterations, seconds, PSNR)] of solver NAME at every checkpoint.
+    the solver is built once, as in reconstruction.py, so set-up is not timed.
+    """
+    solver = make_solver(name, psf, mask, 1)
+    rows = []
+    for iters in CHECKPOINTS[name]:
+        solver.iters = iters
+        start = time.time()
+        out, _ = solver.run(meas)
+        rows.append((iters, time.time() - start, psnr(out[0], reference)))
+    return rows
+
+def main(args):
+    if len(args) > 2:
+        from fista_files.helper_functions import preprocess
+        from fista_files.image_io import read_image
+        psf, meas, mask = preprocess(args[1], args[2], f, gray_image=grayscale)
+        channels = slice(None) if grayscale else slice(1, 2)
+        psf, meas, mask = psf[:,:,channels], meas[:,:,channels], mask[:,:,channels]
+        if len(args) > 3:
+            reference = read_image(args[3], dtype=np.float64)
+            reference = reference[:,:,1:2] if reference.ndim == 3 else reference[..., None]
+            print("Reference: ", args[3])
+        else:
+            print(f"Reference: FISTA, {REFERENCE_ITERS} iterations")
+            reference = make_solver('fista', psf, mask, REFERENCE_ITERS).run(meas)[0][0]
+    else:
+        print("Reference: synthetic scene")
+        psf, meas, mask, reference = synthetic_data()
+
+    results = {name: time_to_quality(name, psf, mask, meas, reference) for name in CHECKPOINTS}
+
+    print(f"{'solver':14}{'iters':>8}{'time (s)':>10}{'PSNR (dB)':>11}")
+    for name, rows in results.items():
+        for iters, seconds, quality in rows:
+            print(f"{name:14}{iters:8d}{seconds:10.2f}{quality:11.2f}")
+
+    # support-sized padding should lose no quality against full padding
+    full, support = (make_solver(name, psf, mask, 1).padded_shape for name in ('fista', 'fista_support'))
+    loss = max(a[2] - b[2] for a, b in zip(results['fista'], results['fista_support']))
+    print(f"Padded size: full {full}, support {support}, largest PSNR loss {loss:.2f} dB")
+
+    # time each solver needs to reach the final FISTA quality
+    target = results['fista'][-1][2]
+    print(f"Time to reach {target:.2f} dB (FISTA, {results['fista'][-1][0]} iterations):")
+    for name, rows in results.items():
+        reached = [seconds for _, seconds, quality in rows if quality >= target - 0.1]
+        print(f"  {name}: " + (f"{reached[0]:.2f}s" if reached else "not reached"))
+
+if __name__ == "__main__":
+    main(sys.argv)
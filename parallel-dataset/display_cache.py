@@ -0,0 +1,155 @@
+import os
+import json
+import mmap
+import time
+import hashlib
+import pygame as pg
+
+"""
+Cache of fully composed display frames for capture_display.py.
+
+Each frame is the scaled crop surface that display_images() blits to the
+screen, stored as raw RGB bytes in its own file so later runs can memory-map
+it and blit without decoding the source image. Entries are keyed by the
+source file (path, size and mtime), or by its content hash when the source
+has a manifest, and the whole cache is tied to one display
+layout: if the layout changes, every stored frame is dropped. Least recently
+used frames are evicted once the cache grows past max_bytes.
+
+The index is only written every INDEX_SAVE_EVERY puts, so after a crash the
+directory can hold frames the index does not know. They are deleted on load,
+and index entries whose file is gone are dropped, so total_bytes matches the
+directory.
+"""
+
+INDEX_NAME = "index.json"
+INDEX_SAVE_EVERY = 100 # puts between index writes
+
+def layout_key(crop_dim, display_dim, regions):
+    """
+    hash of the parameters that change the composed frame.
+    regions is the (pos, dim) of every lensless imager on the crop surface.
+    crop_pos is left out since it only moves the frame on the screen.
+    """
+    layout = [list(crop_dim), list(display_dim)] + [[list(pos), list(dim)] for pos, dim in regions]
+    return hashlib.sha1(json.dumps(layout).encode()).hexdigest()
+
+class DisplayFrameCache():
+    def __init__(self, cache_dir, layout, max_bytes=50 * 2**30):
+        """
+        cache_dir: directory holding the frames and index
+        layout: key returned by layout_key()
+        max_bytes: eviction threshold for the total size of stored frames
+        """
+        self.cache_dir = cache_dir
+        self.layout = layout
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.entries = {}
+        index_path = os.path.join(cache_dir, INDEX_NAME)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+            if index["layout"] == layout:
+                self.entries = index["entries"]
+            else:
+                print("Display layout changed, clearing display frame cache")
+                self.clear()
+        self.reconcile()
+        self.puts = 0
+
+    def frame_files(self):
+        """
+        names of the frame files in the cache directory, indexed or not
+        """
+        return [name for name in os.listdir(self.cache_dir)
+                if len(name) == 40 and all(c in "0123456789abcdef" for c in name)]
+
+    def reconcile(self):
+        """
+        deletes frame files missing from the index, e.g. written after the last index
+        save of a run that crashed, and drops entries whose file is gone
+        """
+        files = set(self.frame_files())
+        unknown = files - set(self.entries)
+        for key in unknown:
+            self._remove(key)
+        if unknown:
+            print(f"Removed {len(unknown)} display frames missing from the cache index")
+        self.entries = {key: e for key, e in self.entries.items() if key in files}
+        self.total_bytes = sum(e["bytes"] for e in self.entries.values())
+        self.evict()
+
+    def key(self, path):
+        st = os.stat(path)
+        return hashlib.sha1(f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}".encode()).hexdigest()
+
+    def get(self, path, key=None):
+        """
+        returns the cached frame for the source image at PATH as a surface backed
+        by a memory map of the cache file, or None on a miss.
+        key: optional content hash of the image (see source_manifest.py), used instead of path, size and mtime
+        """
+        key = key or self.key(path)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        frame_path = os.path.join(self.cache_dir, key)
+        try:
+            with open(frame_path, 'rb') as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            del self.entries[key]
+            self.total_bytes -= entry["bytes"]
+            return None
+        entry["last_used"] = time.time()
+        return pg.image.frombuffer(buf, tuple(entry["size"]), "RGB")
+
+    def put(self, path, frame, key=None):
+        """
+        stores the composed FRAME for the source image at PATH.
+        """
+        key = key or self.key(path)
+        data = pg.image.tobytes(frame, "RGB")
+        with open(os.path.join(self.cache_dir, key), 'wb') as f:
+            f.write(data)
+        if key in self.entries:
+            self.total_bytes -= self.entries[key]["bytes"]
+        self.entries[key] = {"size": list(frame.get_size()), "bytes": len(data), "last_used": time.time()}
+        self.total_bytes += len(data)
+
+        self.evict()
+        self.puts += 1
+        if self.puts % INDEX_SAVE_EVERY == 0:
+            self.save()
+
+    def evict(self):
+        """
+        removes least recently used frames until the cache fits in max_bytes.
+        """
+        if self.total_bytes <= self.max_bytes:
+            return
+        for key in sorted(self.entries, key=lambda k: self.entries[k]["last_used"]):
+            if self.total_bytes <= self.max_bytes:
+                break
+            self.total_bytes -= self.entries.pop(key)["bytes"]
+            self._remove(key)
+
+    def clear(self):
+        for key in self.frame_files():
+            self._remove(key)
+        self.entries = {}
+        self.total_bytes = 0
+
+    def save(self):
+        index_path = os.path.join(self.cache_dir, INDEX_NAME)
+        with open(index_path + ".tmp", 'w') as f:
+            json.dump({"layout": self.layout, "entries": self.entries}, f)
+        os.replace(index_path + ".tmp", index_path)
+
+    def _remove(self, key):
+        try:
+            os.remove(os.path.join(self.cache_dir, key))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,138 @@
+import os
+import re
+import sys
+import csv
+import json
+import time
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from fista_files.image_io import read_image
+import metrics
+
+"""
+Scores warped reconstructions against their ground truth.
+
+Reconstructions and ground truth images are paired by index (img_{i}_...),
+e.g. the warped_reconned_img_{i}_cam_0.tiff files of apply_homography.py
+against ground_truth/img_{i}_cam_2.tiff. Pairs are read in batches of
+BATCH_SIZE by a pool of reader threads, the next batch is read while the
+current one is scored. Ground truth is resized to the reconstruction, both
+are cropped to CROP (rows, cols) and normalized to a maximum of 1, and MSE,
+PSNR and SSIM (metrics.py) are computed for the whole batch at once.
+
+Writes one row per pair to OUTPUT.csv and the mean, median, standard
+deviation, min and max of every metric to OUTPUT.json.
+
+USAGE:
+    python3 evaluation.py --recon_dir WARPED_RECON_DIR --gt_dir GT_DIR [--crop 25:127,63:165] [--output evaluation]
+"""
+
+BATCH_SIZE = 256
+NUM_READERS = 8   # reader threads, decoding releases the GIL
+CROP = None       # e.g. '25:127,63:165', the region of the warped reconstruction covered by the ground truth
+
+def image_index(path):
+    match = re.search(r'img_(\d+)_', os.path.basename(path))
+    return int(match.group(1)) if match else None
+
+def pair_images(recon_dir, gt_dir):
+    """
+    [(index, reconstruction path, ground truth path)] of the indices found in both directories
+    """
+    def by_index(directory):
+        return {image_index(p): os.path.join(directory, p) for p in os.listdir(directory)
+                if image_index(p) is not None and p.endswith(('.tiff', '.tif', '.png', '.jpg', '.npy'))}
+    recons, gts = by_index(recon_dir), by_index(gt_dir)
+    missing = len(set(recons) - set(gts))
+    if missing:
+        print(f"{missing} reconstructions have no ground truth and are skipped")
+    return [(i, recons[i], gts[i]) for i in sorted(set(recons) & set(gts))]
+
+def parse_crop(crop):
+    """
+    '25:127,63:165' to (slice(25, 127), slice(63, 165)), None to no crop
+    """
+    if not crop:
+        return (slice(None), slice(None))
+    return tuple(slice(*[int(v) if v else None for v in part.split(':')]) for part in crop.split(','))
+
+def load_pair(recon_path, gt_path, crop, gray):
+    recon = read_image(recon_path, dtype=np.float32)
+    gt = read_image(gt_path, shape=recon.shape[:2], dtype=np.float32)
+    recon = recon[..., None] if recon.ndim == 2 else recon[..., :3]
+    gt = gt[..., None] if gt.ndim == 2 else gt[..., :3]
+    if gray or recon.shape[2] == 1:
+        # single channel reconstructions are green only, both sides keep the green channel
+        recon = recon[..., 1:2] if recon.shape[2] == 3 else recon
+        gt = gt[..., 1:2] if gt.shape[2] == 3 else gt
+    return recon[crop], gt[crop]
+
+def batches(pairs, crop, gray=False, batch_size=BATCH_SIZE, num_readers=NUM_READERS):
+    """
+    yields (pairs, reconstructions, ground truth) batches, reading the next batch in the background
+    """
+    with ThreadPoolExecutor(num_readers) as pool:
+        def submit(chunk):
+            return chunk, [pool.submit(load_pair, r, g, crop, gray) for _, r, g in chunk]
+        chunks = [pairs[i:i + batch_size] for i in range(0, len(pairs), batch_size)]
+        pending = submit(chunks[0]) if chunks else None
+        for k in range(len(chunks)):
+            chunk, futures = pending
+            if k + 1 < len(chunks):
+                pending = submit(chunks[k + 1])
+            loaded = [fut.result() for fut in futures]
+            yield chunk, np.stack([r for r, _ in loaded]), np.stack([g for _, g in loaded])
+
+def evaluate(pairs, crop, gray=False, backend='numpy', batch_size=BATCH_SIZE):
+    """
+    {metric: per pair values} for PAIRS
+    """
+    scores = {name: [] for name in metrics.METRICS}
+    done = 0
+    start = time.time()
+    for chunk, recons, gts in batches(pairs, crop, gray, batch_size):
+        recons, gts = metrics.normalize_max(recons), metrics.normalize_max(gts)
+        scores["mse"].append(metrics.mse(recons, gts))
+        scores["psnr"].append(metrics.psnr(recons, gts))
+        scores["ssim"].append(metrics.ssim(recons, gts, backend=backend))
+        done += len(chunk)
+        print(f"Scored {done}/{len(pairs)} pairs ({done / (time.time() - start):.0f} pairs/s)")
+    return {name: np.concatenate(values) if values else np.zeros(0) for name, values in scores.items()}
+
+def summarize(scores):
+    return {name: {"mean": float(np.mean(v)), "median": float(np.median(v)), "std": float(np.std(v)),
+                   "min": float(np.min(v)), "max": float(np.max(v))} for name, v in scores.items() if len(v)}
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Score warped reconstructions against ground truth.")
+    parser.add_argument("--recon_dir", type=str, required=True, help="Directory of warped reconstructions.")
+    parser.add_argument("--gt_dir", type=str, required=True, help="Directory of ground truth images.")
+    parser.add_argument("--crop", type=str, default=CROP, help="rows,cols slices, e.g. 25:127,63:165.")
+    parser.add_argument("--gray", action='store_true', help="Compare the green channel only.")
+    parser.add_argument("--backend", type=str, default='numpy', help="SSIM backend, 'numpy' or 'torch'.")
+    parser.add_argument("--batch_size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--output", type=str, default="evaluation", help="Prefix of the .csv and .json results.")
+    args = parser.parse_args(args[1:])
+
+    pairs = pair_images(args.recon_dir, args.gt_dir)
+    print(f"Evaluating {len(pairs)} pairs")
+    start = time.time()
+    scores = evaluate(pairs, parse_crop(args.crop), args.gray, args.backend, args.batch_size)
+
+    with open(f"{args.output}.csv", 'w', newline='') as out:
+        writer = csv.writer(out)
+        writer.writerow(["index", "reconstruction", "ground_truth"] + list(scores))
+        for k, (index, recon, gt) in enumerate(pairs):
+            writer.writerow([index, recon, gt] + [float(scores[name][k]) for name in scores])
+    summary = dict(summarize(scores), pairs=len(pairs), crop=args.crop)
+    with open(f"{args.output}.json", 'w') as out:
+        json.dump(summary, out, indent=4)
+
+    for name in scores:
+        if name in summary:
+            print(f"{name}: mean {summary[name]['mean']:.4f}, median {summary[name]['median']:.4f}, std {summary[name]['std']:.4f}")
+    print(f"Evaluated {len(pairs)} pairs in {time.time() - start:.1f}s, results in {args.output}.csv and {args.output}.json")
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,202 @@
+# Array backends for the FISTA solver
+import numpy
+
+"""
+Every backend exposes the same small set of NumPy-style operations used by
+fista_spectral_numpy and tv_approx_haar, so a solver can run on:
+- 'numpy': NumPy on the CPU (default, float64)
+- 'torch': PyTorch on the CPU, multithreaded FFTs and elementwise ops (float32)
+- 'cupy': CuPy on the GPU (float64)
+
+Backends are selected per solver instance with get_backend(name). FFTs are
+batched over every axis that is not transformed, so channels are solved in
+one call. On the numpy backend the FFTs come from scipy.fft, which spreads a
+batch over num_threads workers.
+"""
+
+class ArrayModuleBackend():
+    """
+    backend for array modules with a NumPy compatible API (NumPy and CuPy)
+    """
+    def __init__(self, xp, name, fft=None, fft_kwargs=None):
+        self.xp = xp
+        self.name = name
+        self.fft = fft if fft is not None else xp.fft
+        self.fft_kwargs = fft_kwargs if fft_kwargs is not None else {}
+
+    def asarray(self, x):
+        return self.xp.asarray(x)
+
+    def to_numpy(self, x):
+        return self.xp.asnumpy(x) if self.name == 'cupy' else numpy.asarray(x)
+
+    def fft2(self, x, axes=(0, 1)):
+        return self.fft.fft2(x, axes=axes, **self.fft_kwargs)
+
+    def ifft2(self, x, axes=(0, 1)):
+        return self.fft.ifft2(x, axes=axes, **self.fft_kwargs)
+
+    def rfft2(self, x, axes=(0, 1)):
+        return self.fft.rfft2(x, axes=axes, **self.fft_kwargs)
+
+    def irfft2(self, x, s, axes=(0, 1)):
+        return self.fft.irfft2(x, s=s, axes=axes, **self.fft_kwargs)
+
+    def ifftshift(self, x, axes=(0, 1)):
+        return self.xp.fft.ifftshift(x, axes=axes)
+
+    def real(self, x):
+        return self.xp.real(x)
+
+    def conj(self, x):
+        return self.xp.conj(x)
+
+    def abs(self, x):
+        return self.xp.abs(x)
+
+    def sign(self, x):
+        return self.xp.sign(x)
+
+    def sqrt(self, x):
+        return self.xp.sqrt(x)
+
+    def nonneg(self, x):
+        return self.xp.maximum(x, 0)
+
+    def sum(self, x, axis=None):
+        return self.xp.sum(x, axis=axis)
+
+    def max(self, x, axis=None):
+        return self.xp.max(x, axis=axis)
+
+    def norm(self, x):
+        return self.xp.linalg.norm(x.ravel())
+
+    def zeros(self, shape):
+        return self.xp.zeros(shape)
+
+    def zeros_like(self, x):
+        return self.xp.zeros_like(x)
+
+    def copy(self, x):
+        return self.xp.copy(x)
+
+    def randn(self, shape):
+        return self.xp.random.randn(*shape)
+
+    def expand_dims(self, x, axis):
+        return self.xp.expand_dims(x, axis)
+
+    def stack(self, arrays, axis):
+        return self.xp.stack(arrays, axis=axis)
+
+    def roll(self, x, shift, axis):
+        return self.xp.roll(x, shift, axis=axis)
+
+    def pad(self, x, pad_width):
+        return self.xp.pad(x, pad_width, mode='constant')
+
+class TorchBackend():
+    """
+    PyTorch CPU backend. num_threads sets the intra-op thread pool, None keeps torch's default.
+    """
+    def __init__(self, num_threads=None, dtype=None, device='cpu'):
+        import torch
+        self.torch = torch
+        self.name = 'torch'
+        self.dtype = dtype if dtype is not None else torch.float32
+        self.device = device
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+    def asarray(self, x):
+        return self.torch.as_tensor(numpy.asarray(x), dtype=self.dtype, device=self.device)
+
+    def to_numpy(self, x):
+        return x.detach().cpu().numpy()
+
+    def fft2(self, x, axes=(0, 1)):
+        return self.torch.fft.fft2(x, dim=axes)
+
+    def ifft2(self, x, axes=(0, 1)):
+        return self.torch.fft.ifft2(x, dim=axes)
+
+    def rfft2(self, x, axes=(0, 1)):
+        return self.torch.fft.rfft2(x, dim=axes)
+
+    def irfft2(self, x, s, axes=(0, 1)):
+        return self.torch.fft.irfft2(x, s=s, dim=axes)
+
+    def ifftshift(self, x, axes=(0, 1)):
+        return self.torch.fft.ifftshift(x, dim=axes)
+
+    def real(self, x):
+        return self.torch.real(x) if x.is_complex() else x
+
+    def conj(self, x):
+        return self.torch.conj(x)
+
+    def abs(self, x):
+        return self.torch.abs(x)
+
+    def sign(self, x):
+        return self.torch.sign(x)
+
+    def sqrt(self, x):
+        return self.torch.sqrt(x)
+
+    def nonneg(self, x):
+        return self.torch.relu(x)
+
+    def sum(self, x, axis=None):
+        return self.torch.sum(x) if axis is None else self.torch.sum(x, dim=axis)
+
+    def max(self, x, axis=None):
+        return self.torch.amax(x) if axis is None else self.torch.amax(x, dim=axis)
+
+    def norm(self, x):
+        return self.torch.linalg.vector_norm(x)
+
+    def zeros(self, shape):
+        return self.torch.zeros(shape, dtype=self.dtype, device=self.device)
+
+    def zeros_like(self, x):
+        return self.torch.zeros_like(x)
+
+    def copy(self, x):
+        return x.clone()
+
+    def randn(self, shape):
+        return self.torch.randn(shape, dtype=self.dtype, device=self.device)
+
+    def expand_dims(self, x, axis):
+        return x.unsqueeze(axis)
+
+    def stack(self, arrays, axis):
+        return self.torch.stack(arrays, dim=axis)
+
+    def roll(self, x, shift, axis):
+        return self.torch.roll(x, shift, dims=axis)
+
+    def pad(self, x, pad_width):
+        out = self.torch.zeros([n + a + b for n, (a, b) in zip(x.shape, pad_width)], dtype=x.dtype, device=x.device)
+        out[tuple(slice(a, a + n) for n, (a, _) in zip(x.shape, pad_width))] = x
+        return out
+
+def get_backend(backend='numpy', num_threads=None):
+    """
+    returns the backend called BACKEND, or BACKEND itself if it already is one.
+    num_threads sets the FFT workers for numpy and the thread pool for torch.
+    None keeps the library default: one worker for numpy, all cores for torch.
+    """
+    if not isinstance(backend, str):
+        return backend
+    if backend == 'numpy':
+        import scipy.fft
+        return ArrayModuleBackend(numpy, 'numpy', fft=scipy.fft, fft_kwargs={'workers': num_threads})
+    if backend == 'cupy':
+        import cupy
+        return ArrayModuleBackend(cupy, 'cupy')
+    if backend == 'torch':
+        return TorchBackend(num_threads=num_threads)
+    raise ValueError(f"Unknown backend {backend}, options: 'numpy', 'torch', 'cupy'")
@@ -1,71 +1,77 @@
 # LK file to help read in images clearly, 2/21/2023
-import matplotlib.pyplot as plt
-import cv2
 import numpy as np
+from fista_files.image_io import read_image
 
 """
 Our current helper functions.
 2024
-"""
-
-def preprocess(psfname, imgname, f=8, gray_image=False, gray_psf=False):
 
-    if psfname[-3:] == 'npy':
-        psf0 = np.load(psfname)
-    else:
-        psf0 = plt.imread(psfname)
-
-    if imgname[-3:] == 'npy':
-        img = np.load(imgname)
-    else:
-        img = plt.imread(imgname)
-    
+cv2, matplotlib and PIL are imported inside the functions that use them to keep
+imports fast for short lived batch workers.
+"""
 
-    if gray_image and not gray_psf: # convert PSF to grayscale
-        psf = psf0[:, :, 1]
+def preprocess_psf(psfname, f=8, gray_image=False):
+    """
+    background subtracts, downsamples and normalizes a PSF.
+    returns psf, mask and the background and size needed by preprocess_image(),
+    so the PSF only has to be processed once for every measurement of an imager.
+    """
+    # stored dtype, memory-mapped for uncompressed TIFFs, demosaiced for raw Bayer captures
+    psf0 = read_image(psfname)
 
     # background subtract PSF
     # 10/23/2023 for multi-color channels need to background subtract from PSF each channel separately
     if not gray_image:
         #bg = np.mean(psf0[:100, :100])
-        #psf0 = psf0 - bg
-        #img = img - bg
-        bg_channels = np.mean(psf0[:100, :100], axis=(0, 1))
-        psf0 = psf0 - bg_channels
-        img = img - bg_channels
-
+        bg = np.mean(psf0[:100, :100], axis=(0, 1))
     else:
         # gray image
         bg = np.mean(psf0[:100, :100])
-        psf0 = psf0 - bg
-        img = img - bg
-    #downsample images 
+
+    #downsample images by area averaging before the background subtraction, which commutes with it
+    #raw Bayer captures are binned 2x2 instead of demosaiced, like the measurements
     ds = f
-    psf = cv2.resize(psf0, (psf0.shape[1]//ds, psf0.shape[0]//ds))
-    img = cv2.resize(img, (psf0.shape[1]//ds, psf0.shape[0]//ds))
+    size = (psf0.shape[1]//ds, psf0.shape[0]//ds)
+    psf = read_image(psfname, factor=ds, dtype=np.float64) - bg
 
     #normalize images. why does PSF get divided by norm and image get divided by max?
     if not gray_image:
-        img = np.asarray(img / np.max(img, axis=(0,1)))
         psf = np.asarray(psf / np.linalg.norm(psf, axis=(0,1))) # does normalizing each axis do better? seems to reduce haze
     else:
-        img = np.asarray(img / np.max(img))
         psf = np.asarray(psf / np.linalg.norm(psf))
-    
+
     # note that images can't have odd dimensions. otherwise there will be a mismatch error raised
     if not gray_image:
         channels = 3
         psf = psf[:,:,:3] #in case the recorded data has 4 dimensions
-        img = img[:,:,:3] 
     else:
         channels = 1
         if psf.ndim == 2:
             psf = np.expand_dims(psf, axis=2)
-        if img.ndim == 2:
-            img = np.expand_dims(img, axis=2)
     # create mask for operations
     mask = np.asarray(np.ones((psf.shape[0], psf.shape[1], channels)))
-    
+
+    return psf, mask, bg, size
+
+def preprocess_image(imgname, bg, size, gray_image=False):
+    """
+    background subtracts, downsamples and normalizes a measurement with the
+    background and size returned by preprocess_psf()
+    """
+    img = read_image(imgname, shape=(size[1], size[0]), dtype=np.float64) - bg
+
+    if not gray_image:
+        img = np.asarray(img / np.max(img, axis=(0,1)))
+        img = img[:,:,:3]
+    else:
+        img = np.asarray(img / np.max(img))
+        if img.ndim == 2:
+            img = np.expand_dims(img, axis=2)
+    return img
+
+def preprocess(psfname, imgname, f=8, gray_image=False, gray_psf=False):
+    psf, mask, bg, size = preprocess_psf(psfname, f, gray_image)
+    img = preprocess_image(imgname, bg, size, gray_image)
     return psf, img, mask
 
 def preplot(image):
@@ -73,7 +79,22 @@ def preplot(image):
     out_image = np.clip(image/np.max(image), 0,1) #removed np.flipud
     return out_image[:,:,...] # changed last index slicing from : to ...
 
+def save_image(path, image):
+    """
+    saves IMAGE with values in [0, 1] to PATH, same output as plt.imsave.
+    color images are written with PIL directly, 2D images go through matplotlib for the colormap.
+    """
+    if image.ndim == 3 and image.shape[-1] in (3, 4):
+        from PIL import Image
+        rgba = (image * 255).astype(np.uint8)
+        if rgba.shape[-1] == 3:
+            rgba = np.concatenate([rgba, np.full(rgba.shape[:2] + (1,), 255, np.uint8)], axis=2)
+        Image.fromarray(rgba).save(path, dpi=(100, 100))
+    else:
+        from matplotlib.image import imsave
+        imsave(path, image)
+
 def contrast_stretch(img, factor):
-    if factor is not 0:
+    if factor != 0:
         return np.clip(img, 0, np.max(img)*factor)
     return img
\ No newline at end of file
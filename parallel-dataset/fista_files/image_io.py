@@ -0,0 +1,313 @@
+# Image reading shared by preprocessing, undistortion and homography
+import os
+import mmap
+import struct
+import numpy as np
+
+"""
+read_image() returns an image at full or reduced resolution without decoding
+more than it has to:
+- uncompressed TIFFs, as written by pylon, are memory-mapped and area
+  downsampled straight from the mapped uint8/uint16 buffer
+- JPEG and PNG are decoded at 1/2, 1/4 or 1/8 size by OpenCV when possible
+- .npy files are memory-mapped
+- raw Bayer TIFFs (written with a CFA pattern by write_tiff) are binned 2x2 to
+  RGB when the factor is even, one red, the mean of the two greens and one
+  blue per output pixel, and demosaiced by OpenCV otherwise
+- if the capture wrote a downsampled pyramid level (DIR/x4/NAME, DIR/x8/NAME,
+  see capture_pyramid.py), the smallest level that divides the factor is read
+Anything else falls back to a full decode.
+
+At full resolution the image is returned in its stored dtype (a read-only map
+for TIFF and .npy), so no float copy is made unless DTYPE is given. Reduced
+images are block means in DTYPE, float32 by default.
+"""
+
+TIFF_TYPES = {1: 'B', 3: 'H', 4: 'I'} # BYTE, SHORT, LONG
+TIFF_SAMPLES = {(1, 8): 'u1', (1, 16): 'u2', (3, 32): 'f4'} # (SampleFormat, BitsPerSample): dtype
+TIFF_CFA = 32803 # photometric interpretation of a color filter array
+# TIFF/EP CFAPattern of each 2x2 Bayer tile (0 red, 1 green, 2 blue, row major),
+# and the OpenCV conversion for it, OpenCV names patterns by the second row
+BAYER_PATTERNS = {
+    'RG': ((0, 1, 1, 2), 'BayerBG2RGB'),
+    'GR': ((1, 0, 2, 1), 'BayerGB2RGB'),
+    'BG': ((2, 1, 1, 0), 'BayerRG2RGB'),
+    'GB': ((1, 2, 0, 1), 'BayerGR2RGB'),
+}
+REDUCED_FACTORS = (8, 4, 2)
+CHUNK_ROWS = 128 # full resolution rows converted to float at a time when downsampling
+PYRAMID_LEVELS = (8, 4) # downsample factors of the capture pyramid, largest first
+
+def _tiff_tags(buf):
+    """
+    tags of the first IFD of the classic TIFF in BUF as {tag: [values]}, None if not a TIFF
+    """
+    if buf[:4] == b'II*\x00':
+        order = '<'
+    elif buf[:4] == b'MM\x00*':
+        order = '>'
+    else:
+        return None
+    offset = struct.unpack(order + 'I', buf[4:8])[0]
+    num_entries = struct.unpack(order + 'H', buf[offset:offset + 2])[0]
+    tags = {}
+    for i in range(num_entries):
+        entry = offset + 2 + 12*i
+        tag, typ, count = struct.unpack(order + 'HHI', buf[entry:entry + 8])
+        if typ not in TIFF_TYPES:
+            continue
+        fmt = order + TIFF_TYPES[typ]*count
+        size = struct.calcsize(fmt)
+        start = entry + 8 if size <= 4 else struct.unpack(order + 'I', buf[entry + 8:entry + 12])[0]
+        tags[tag] = list(struct.unpack(fmt, buf[start:start + size]))
+    return order, tags
+
+def bayer_pattern(pixel_format):
+    """
+    'RG', 'GR', 'BG' or 'GB' for a pylon Bayer pixel format such as BayerRG12, None otherwise
+    """
+    if pixel_format.startswith('Bayer') and pixel_format[5:7] in BAYER_PATTERNS:
+        return pixel_format[5:7]
+    return None
+
+def _cfa_pattern(tags):
+    """
+    Bayer pattern of a TIFF with the tags TAGS, None if it is not a raw mosaic
+    """
+    if tags.get(262, [None])[0] != TIFF_CFA:
+        return None
+    cfa = tuple(tags.get(33422, []))
+    for pattern, (codes, _) in BAYER_PATTERNS.items():
+        if codes == cfa:
+            return pattern
+    return None
+
+def _map_tiff(path):
+    """
+    map_tiff() and the Bayer pattern of the TIFF, (None, None) if it cannot be mapped
+    """
+    with open(path, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # empty file
+            return None, None
+    parsed = _tiff_tags(buf)
+    if parsed is None:
+        return None, None
+    order, tags = parsed
+    width, height = tags.get(256, [0])[0], tags.get(257, [0])[0]
+    bits = tags.get(258, [8])
+    samples = tags.get(277, [1])[0]
+    offsets, counts = tags.get(273), tags.get(279)
+    sample_format = tags.get(339, [1])[0]
+    if (tags.get(259, [1])[0] != 1 or tags.get(284, [1])[0] != 1 or len(set(bits)) != 1
+            or (sample_format, bits[0]) not in TIFF_SAMPLES or not offsets or not counts):
+        return None, None # compressed, planar, signed or unusual bit depth
+    for start, count, next_start in zip(offsets, counts, offsets[1:]):
+        if start + count != next_start:
+            return None, None # strips are not contiguous
+    dtype = np.dtype(order + TIFF_SAMPLES[(sample_format, bits[0])])
+    shape = (height, width, samples) if samples > 1 else (height, width)
+    if offsets[0] + int(np.prod(shape))*dtype.itemsize > len(buf):
+        return None, None
+    image = np.frombuffer(buf, dtype=dtype, count=int(np.prod(shape)), offset=offsets[0]).reshape(shape)
+    return image, _cfa_pattern(tags) if samples == 1 else None
+
+def map_tiff(path):
+    """
+    (rows, cols[, samples]) view of the pixels of an uncompressed, single strip or
+    contiguous strip TIFF, backed by a read-only memory map. None for other TIFFs.
+    """
+    return _map_tiff(path)[0]
+
+def write_tiff(path, image, cfa=None):
+    """
+    writes the uint8, uint16 or float32 (rows, cols[, samples]) IMAGE as an uncompressed,
+    single strip little endian TIFF, which map_tiff() can map
+    cfa: Bayer pattern ('RG', 'GR', 'BG', 'GB') of a raw (rows, cols) mosaic,
+         stored as TIFF/EP CFA tags so read_image() knows to demosaic it
+    """
+    image = np.ascontiguousarray(image)
+    assert image.dtype in (np.uint8, np.uint16, np.float32), "Only uint8, uint16 and float32 images can be written."
+    height, width = image.shape[:2]
+    samples = image.shape[2] if image.ndim == 3 else 1
+    bits = image.dtype.itemsize * 8
+    sample_format = 3 if image.dtype == np.float32 else 1 # IEEE float or unsigned integer samples
+    entries = [
+        (256, 4, 1, width),
+        (257, 4, 1, height),
+        (258, 3, 1, bits), # same bit depth for every sample
+        (259, 3, 1, 1), # no compression
+        (262, 3, 1, 2 if samples >= 3 else 1), # RGB or BlackIsZero
+        (273, 4, 1, 0), # strip offset, filled in below
+        (277, 3, 1, samples),
+        (278, 4, 1, height),
+        (279, 4, 1, image.nbytes),
+        (284, 3, 1, 1), # chunky
+        (339, 3, 1, sample_format),
+    ]
+    if cfa is not None:
+        assert samples == 1, "A raw mosaic has a single sample per pixel."
+        entries[4] = (262, 3, 1, TIFF_CFA)
+        codes = BAYER_PATTERNS[cfa][0]
+        entries += [
+            (33421, 3, 2, 2 | 2 << 16), # CFARepeatPatternDim 2x2, two SHORTs in the value field
+            (33422, 1, 4, codes[0] | codes[1] << 8 | codes[2] << 16 | codes[3] << 24), # CFAPattern, four BYTEs
+        ]
+    if samples > 1:
+        # one bit depth and sample format per sample, stored after the IFD
+        bits_offset = 8 + 2 + 12*len(entries) + 4
+        entries[2] = (258, 3, samples, bits_offset)
+        entries[10] = (339, 3, samples, bits_offset + 2*samples)
+    data_offset = 8 + 2 + 12*len(entries) + 4 + (4*samples if samples > 1 else 0)
+    entries[5] = (273, 4, 1, data_offset)
+
+    ifd = struct.pack('<H', len(entries))
+    for tag, typ, count, value in entries:
+        # single SHORTs are stored left justified in the value field, anything else as a LONG (or offset
+        # or values packed into it)
+        value = struct.pack('<HH', value, 0) if typ == 3 and count == 1 else struct.pack('<I', value)
+        ifd += struct.pack('<HHI', tag, typ, count) + value
+    ifd += struct.pack('<I', 0) # no next IFD
+    extra = struct.pack('<' + 'H'*2*samples, *[bits]*samples, *[sample_format]*samples) if samples > 1 else b''
+    with open(path, 'wb') as f:
+        f.write(b'II*\x00' + struct.pack('<I', 8) + ifd + extra)
+        f.write(image.astype('<' + image.dtype.str[1:], copy=False).tobytes())
+
+def pyramid_path(path, level):
+    """
+    path of the LEVEL times downsampled copy of the capture at PATH
+    """
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f"x{level}", name)
+
+def bin_bayer(raw, pattern, dtype=np.float32):
+    """
+    2x2 binning of raw Bayer mosaics (..., rows, cols) to RGB (..., rows//2, cols//2, 3)
+    in DTYPE: red and blue are the single samples of each tile, green the mean of
+    both. leading axes are a batch, so a stack of frames is binned in one pass.
+    """
+    codes = BAYER_PATTERNS[pattern][0]
+    h, w = raw.shape[-2]//2*2, raw.shape[-1]//2*2
+    tiles = [np.asarray(raw[..., y:h:2, x:w:2], dtype=dtype) for y, x in ((0, 0), (0, 1), (1, 0), (1, 1))]
+    out = np.empty(tiles[0].shape + (3,), dtype=dtype)
+    greens = [tile for tile, code in zip(tiles, codes) if code == 1]
+    out[..., 0] = tiles[codes.index(0)]
+    np.add(greens[0], greens[1], out=out[..., 1])
+    out[..., 1] *= 0.5
+    out[..., 2] = tiles[codes.index(2)]
+    return out
+
+def demosaic(raw, pattern):
+    """
+    full resolution RGB of a raw Bayer mosaic by OpenCV's bilinear demosaicing, in the stored dtype
+    """
+    import cv2
+    return cv2.cvtColor(np.ascontiguousarray(raw), getattr(cv2, f"COLOR_{BAYER_PATTERNS[pattern][1]}"))
+
+def downsample_area(image, factor, dtype=np.float32):
+    """
+    mean over FACTOR x FACTOR blocks of the first two axes of IMAGE, in DTYPE.
+    the remainder rows and columns are dropped, same as cv2.INTER_AREA for integer factors.
+    IMAGE is converted to float32 CHUNK_ROWS rows at a time, so a mapped frame is
+    never copied as a whole.
+    """
+    if factor == 1:
+        return np.asarray(image, dtype=dtype)
+    h, w = image.shape[0]//factor, image.shape[1]//factor
+    if image.ndim > 3 or (image.ndim == 3 and image.shape[2] > 4):
+        blocks = image[:h*factor, :w*factor].reshape((h, factor, w, factor) + image.shape[2:])
+        return blocks.mean(axis=(1, 3), dtype=dtype)
+
+    import cv2
+    out = np.empty((h, w) + image.shape[2:], dtype=dtype)
+    step = max(1, CHUNK_ROWS // factor)
+    for i in range(0, h, step):
+        rows = min(step, h - i)
+        chunk = np.asarray(image[i*factor:(i + rows)*factor, :w*factor], dtype=np.float32)
+        out[i:i + rows] = cv2.resize(chunk, (w, rows), interpolation=cv2.INTER_AREA).reshape(out[i:i + rows].shape)
+    return out
+
+def _reduced_decode(path, factor, gray):
+    """
+    OpenCV decode at 1/r size for the largest r in REDUCED_FACTORS dividing FACTOR,
+    returns (image in RGB order, remaining factor)
+    """
+    import cv2
+    for r in REDUCED_FACTORS:
+        if factor % r == 0:
+            flag = getattr(cv2, f"IMREAD_REDUCED_{'GRAYSCALE' if gray else 'COLOR'}_{r}")
+            image = cv2.imread(path, flag)
+            break
+    else:
+        r = 1
+        image = cv2.imread(path, cv2.IMREAD_GRAYSCALE if gray else cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise FileNotFoundError(f"Could not read image {path}")
+    if image.ndim == 3:
+        image = image[:, :, [2, 1, 0] + list(range(3, image.shape[2]))] # BGR(A) to RGB(A)
+    return image, factor // r
+
+def image_size(path):
+    """
+    (rows, cols) of the image at PATH, only the header is read
+    """
+    from PIL import Image
+    with Image.open(path) as im:
+        return im.size[1], im.size[0]
+
+def read_image(path, factor=1, shape=None, gray=False, dtype=None):
+    """
+    reads the image at PATH, downsampled by the integer FACTOR or resized to SHAPE (rows, cols).
+    gray: keep only the first channel (TIFF and .npy) or decode as grayscale (JPEG, PNG)
+    dtype: output dtype. None keeps the stored dtype at full resolution and gives
+           float32 for reduced images. full resolution float images are only
+           returned when asked for with DTYPE.
+    """
+    name = path.lower()
+    image, cfa = None, None
+    if name.endswith('.npy'):
+        image = np.load(path, mmap_mode='r')
+    elif name.endswith(('.tif', '.tiff')):
+        image, cfa = _map_tiff(path)
+
+    if shape is not None:
+        # resizing to SHAPE by an integer factor is done by block averaging, anything else by cv2.resize
+        full = image.shape[:2] if image is not None else image_size(path)
+        if full[0] % shape[0] == 0 and full[1] % shape[1] == 0 and full[0] // shape[0] == full[1] // shape[1]:
+            factor, shape = full[0] // shape[0], None
+
+    # smallest pyramid level written at capture time that still divides the factor
+    if shape is None and factor > 1 and name.endswith(('.tif', '.tiff')):
+        for level in PYRAMID_LEVELS:
+            level_image = map_tiff(pyramid_path(path, level)) if factor % level == 0 and os.path.exists(pyramid_path(path, level)) else None
+            if level_image is not None:
+                image, cfa, factor = level_image, None, factor // level
+                break
+
+    if cfa is not None:
+        # raw mosaic: binning is the first factor of 2 of the downsampling
+        if shape is None and factor % 2 == 0:
+            image, factor = bin_bayer(image, cfa, dtype=np.float32 if dtype is None else dtype), factor // 2
+            if factor == 1:
+                return image[:, :, 0] if gray else image
+        else:
+            image = demosaic(image, cfa)
+
+    if image is None:
+        if name.endswith(('.jpg', '.jpeg', '.png')):
+            image, factor = _reduced_decode(path, factor if shape is None else 1, gray)
+        else:
+            from matplotlib.image import imread
+            image = imread(path)
+    if gray and image.ndim == 3:
+        image = image[:, :, 0]
+
+    if shape is not None:
+        import cv2
+        area = shape[0] < image.shape[0]
+        image = cv2.resize(np.asarray(image, dtype=np.float32), (shape[1], shape[0]), interpolation=cv2.INTER_AREA if area else cv2.INTER_LINEAR)
+        return image if dtype is None else image.astype(dtype)
+    if factor == 1:
+        return image if dtype is None else np.asarray(image, dtype=dtype)
+    return downsample_area(image, factor, dtype=np.float32 if dtype is None else dtype)
@@ -0,0 +1,72 @@
+# Code used in WallerLab
+# Backend-generic Haar approximation of the TV prox, replaces tv_approx_haar_np and tv_approx_haar_cp
+import math
+from fista_files.backends import get_backend
+
+def take(ax, start):
+    # every other element along AX, starting at START
+    return (slice(None),)*ax + (slice(start, None, 2),)
+
+def soft_py(x, tau, xp):
+    threshed = xp.nonneg(xp.abs(x)-tau)
+    threshed = threshed*xp.sign(x)
+    return threshed
+
+def ht3(x, ax, shift, thresh, xp):
+    C = 1./math.sqrt(2.)
+    
+    if shift == True:
+        x = xp.roll(x, -1, axis = ax)
+    w1 = C*(x[take(ax, 1)] + x[take(ax, 0)])
+    w2 = soft_py(C*(x[take(ax, 1)] - x[take(ax, 0)]), thresh, xp)
+    return w1, w2
+
+def iht3(w1, w2, ax, shift, shape, xp):
+    
+    C = 1./math.sqrt(2.)
+
+    x1 = C*(w1 - w2); x2 = C*(w1 + w2); 
+    
+    # interleave x1 and x2 along AX
+    y = xp.stack([x1, x2], axis = ax+1).reshape(shape)
+    
+    if shift == True:
+        y = xp.roll(y, 1, axis = ax)
+    return y
+
+def tv3dApproxHaar(x, tau, alpha, xp=None):
+    """
+    Haar approximation of the TV prox of X.
+    the first two axes are spatial, a third axis of 4 or more channels is treated as spectral
+    and thresholded with ALPHA * TAU. XP is the array backend, numpy by default.
+    """
+    if xp is None:
+        xp = get_backend('numpy')
+
+    if len(x.shape) == 2 or x.shape[2]<4:
+        D = 2
+        num_dims = 2
+    else:
+        D = 3
+        num_dims = 3
+        
+    fact = math.sqrt(2)*2
+    thresh = D*tau*fact
+    
+
+    y = xp.zeros_like(x)
+    for ax in range(0,num_dims):
+        if ax ==2:
+            t_scale = alpha
+        else:
+            t_scale = 1;
+
+        w0, w1 = ht3(x, ax, False, thresh*t_scale, xp)
+        w2, w3 = ht3(x, ax, True, thresh*t_scale, xp)
+        
+        t1 = iht3(w0, w1, ax, False, x.shape, xp)
+        t2 = iht3(w2, w3, ax, True, x.shape, xp)
+        y = y + t1 + t2
+        
+    y = y/(2*D)
+    return y
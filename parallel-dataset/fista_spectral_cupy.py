@@ -1,27 +1,87 @@
 # Code used in WallerLab
 
-import sys
-import fista_files.helper_functions as fc
-import numpy as numpy
-import matplotlib.pyplot as plt
-
-global device
-device = ''
-sys.path.append('helper_functions/')
-sys.path.append('fista_files/')
-
-if device == 'GPU':
-    import cupy as np
-    import tv_approx_haar_cp as tv
-    
-    print('device = ', device, ', using GPU and cupy')
-else:
-    import numpy as np
-    import tv_approx_haar_np as tv
-    print('device = ', device, ', using CPU and numpy')
+# Array operations go through a backend (fista_files/backends.py) chosen per solver:
+#   fista_spectral_numpy(h, mask, backend='numpy' | 'torch' | 'cupy')
+import os
+import math
+import numpy as np
+import fista_files.tv_approx_haar as tv
+from fista_files.backends import get_backend
+
+SUPPORT_ENERGY = 0.999 # fraction of the PSF energy kept by padding='support'
+
+def psf_support(h, energy=SUPPORT_ENERGY):
+    """
+    [(first, last) row, (first, last) column] of the PSF H (rows, cols, ...) holding ENERGY
+    of its energy between them, the rest is trimmed equally from both ends
+    """
+    h = np.asarray(h, dtype=np.float64)
+    e = np.sum((h**2).reshape(h.shape[0], h.shape[1], -1), axis=2)
+    tail = (1 - energy)/2
+    support = []
+    for profile in (np.sum(e, axis=1), np.sum(e, axis=0)):
+        c = np.cumsum(profile) / np.sum(profile)
+        support.append((int(np.searchsorted(c, tail, side='right')), int(np.searchsorted(c, 1 - tail, side='left'))))
+    return support
+
+def fast_even_len(n):
+    """
+    smallest FFT friendly even length >= N, the Haar prox works on pairs of pixels
+    """
+    import scipy.fft
+    n = scipy.fft.next_fast_len(n, real=True)
+    while n % 2:
+        n = scipy.fft.next_fast_len(n + 1, real=True)
+    return n
+
+def padding_layout(dims, support=None):
+    """
+    (pads, kernel rows/cols) of every axis for sensor DIMS. without SUPPORT, the PSF is the
+    whole sensor and the solution twice its size. with the PSF SUPPORT (see psf_support), the
+    solution covers the sensor plus every point that reaches it through the support, rounded
+    up to a fast FFT length, so the circular convolution is exact on the sensor
+    """
+    pads, kernel = [], []
+    for axis, n in enumerate(dims):
+        center = n//2 # origin of the PSF, as ifftshift of the padded PSF
+        if support is None:
+            pads.append((n//2, n - n//2))
+            kernel.append((0, n - 1))
+            continue
+        first, last = min(support[axis][0], center), max(support[axis][1], center)
+        before, after = last - center, center - first # reach of the PSF towards either side
+        size = fast_even_len(n + before + after)
+        start = before + (size - n - before - after)//2
+        pads.append((start, size - n - start))
+        kernel.append((first, last))
+    return pads, kernel
 
 class fista_spectral_numpy():
-    def __init__(self, h, mask, gray=False):
+    def __init__(self, h, mask, gray=False, backend='numpy', num_threads=None, lipschitz='power', verify_lipschitz=False,
+                 padding='full', support_energy=SUPPORT_ENERGY):
+        """
+        backend: 'numpy', 'torch' (multithreaded CPU, num_threads) or 'cupy', or a backend instance
+        num_threads: FFT workers or threads, None is the backend default. with more than one
+                     channel, None gives numpy one worker per core, so the channels run in parallel
+        lipschitz: 'power' (default) uses the power iteration estimate (x100) that FISTA_PARAMS is tuned for,
+                   'analytic' computes the step size from the PSF spectrum, deterministic but a larger
+                   step and TV threshold tv_lambda/L, so tv_lambda needs retuning
+        verify_lipschitz: also estimate ||A||^2 with power iteration and check it against L
+        padding: 'full' pads the solution to twice the sensor size, 'support' only by the extent
+                 of the PSF holding support_energy of its energy, rounded up to fast FFT sizes
+        """
+        if num_threads is None and backend == 'numpy' and not gray and np.ndim(mask) == 3 and np.shape(mask)[-1] > 1:
+            num_threads = os.cpu_count()
+        self.xp = get_backend(backend, num_threads=num_threads)
+        xp = self.xp
+        if padding == 'full':
+            support = None
+        elif padding == 'support':
+            support = psf_support(h, support_energy)
+        else:
+            raise ValueError(f"Unknown padding {padding}, options: 'full', 'support'")
+        h = xp.asarray(h)
+        mask = xp.asarray(mask)
         
         ## Initialize constants 
         self.DIMS0 = h.shape[0]  # Image Dimensions
@@ -31,19 +91,28 @@ class fista_spectral_numpy():
         if gray is True:
             self.spectral_channels =1  # Number of spectral channels 
         
-        self.py = int((self.DIMS0)//2)    # Pad size
-        self.px = int((self.DIMS1)//2)    # Pad size
+        # Pad sizes (before, after) of both axes, and the rows and cols of the PSF kept in the kernel
+        self.pads, self.kernel = padding_layout((self.DIMS0, self.DIMS1), support)
         
-        # FFT of point spread function 
-        self.H = np.fft.fft2((np.fft.ifftshift(self.pad(h), axes = (0,1))), axes = (0,1))
+        # Real FFT of point spread function, one per channel
+        self.padded_shape = tuple(n + a + b for n, (a, b) in zip((self.DIMS0, self.DIMS1), self.pads))
+        self.x_shape = self.padded_shape + (self.spectral_channels,) # shape of the solution
+        self.H = xp.rfft2(self.psf_kernel(h), axes = (0,1))
             
-        self.Hconj = np.conj(self.H)  
+        self.Hconj = xp.conj(self.H)  
         
         self.mask = mask
        
-        # Calculate the eigenvalue to set the step size 
-        maxeig = self.power_iteration(self.Hpower, (self.DIMS0*2, self.DIMS1*2), 10)
-        self.L =  maxeig*100 #*100#*20
+        # Calculate the Lipschitz constant to set the step size 
+        if lipschitz == 'analytic':
+            self.L = self.lipschitz_bound()
+        elif lipschitz == 'power':
+            maxeig = self.power_iteration(self.Hpower, self.padded_shape + tuple(h.shape[2:]), 10)
+            self.L =  maxeig*100 #*100#*20
+        else:
+            raise ValueError(f"Unknown lipschitz option {lipschitz}, options: 'analytic', 'power'")
+        if verify_lipschitz:
+            self.verify_lipschitz()
         
         
         self.prox_method = 'tv'  # options: 'non-neg', 'tv', 'native'
@@ -62,86 +131,120 @@ class fista_spectral_numpy():
         self.l_data = []
         self.l_tv = []
         
+    # For A x = mask * crop(h * x), each channel is a circular convolution followed by
+    # a crop and a mask, so ||A||^2 <= max |H|^2 * max |mask|^2, taken over channels
+    def lipschitz_bound(self):
+        xp = self.xp
+        H2 = xp.max(xp.abs(self.H)**2, axis = (0,1))
+        mask2 = xp.max(xp.abs(self.mask), axis = (0,1))**2
+        return float(xp.max(H2*mask2))
+
+    # Power iteration on A^T A, checks that L bounds ||A||^2
+    def verify_lipschitz(self, num_iters=20):
+        xp = self.xp
+        bk = xp.randn(self.x_shape)
+        for i in range(0, num_iters):
+            bk = self.Hadj(self.Hfor(bk))
+            eig = xp.norm(bk)
+            bk = bk/eig
+        eig = float(eig)
+        print(f'Lipschitz: L = {self.L}, power iteration ||A||^2 = {eig}, ratio = {eig/self.L}')
+        assert eig <= self.L*(1 + 1e-4), "Lipschitz constant does not bound ||A||^2."
+        return eig
+
     # Power iteration to calculate eigenvalue 
     def power_iteration(self, A, sample_vect_shape, num_iters):
         print('power_iteration', sample_vect_shape)
         
-        bk = np.random.randn(sample_vect_shape[0], sample_vect_shape[1])
+        xp = self.xp
+        bk = xp.randn(sample_vect_shape)
         for i in range(0, num_iters):
             bk1 = A(bk) # A is Hpower
-            bk1_norm = np.linalg.norm(bk1)
+            bk1_norm = xp.norm(bk1)
 
             bk = bk1/bk1_norm
         Mx = A(bk)
-        xx = np.transpose(np.dot(bk.ravel(), bk.ravel()))
-        eig_b = np.transpose(bk.ravel()).dot(Mx.ravel())/xx
+        xx = xp.sum(bk*bk)
+        eig_b = xp.sum(bk*Mx)/xx
 
-        return eig_b
+        return float(eig_b)
             
     # Helper functions for forward model 
     def crop(self,x):
-        return x[self.py:-self.py, self.px:-self.px]
+        (py, _), (px, _) = self.pads
+        return x[py:py + self.DIMS0, px:px + self.DIMS1]
     
     def pad(self,x):
-        if len(x.shape) == 2: 
-            out = np.pad(x, ([self.py, self.py], [self.px,self.px]), mode = 'constant')
-        elif len(x.shape) == 3:
-            out = np.pad(x, ([self.py, self.py], [self.px,self.px], [0, 0]), mode = 'constant')
-        return out
+        return self.xp.pad(x, list(self.pads) + [(0, 0)]*(len(x.shape) - 2))
     
+    # The PSF support in a zero array of the padded shape, its origin (the sensor center) moved
+    # to the corner. With full padding this is ifftshift(pad(h))
+    def psf_kernel(self, h):
+        xp = self.xp
+        (r0, r1), (c0, c1) = self.kernel
+        h = h[r0:r1 + 1, c0:c1 + 1]
+        k = xp.pad(h, [(0, self.padded_shape[0] - h.shape[0]), (0, self.padded_shape[1] - h.shape[1])] + [(0, 0)]*(len(h.shape) - 2))
+        k = xp.roll(k, -(self.DIMS0//2 - r0), axis = 0)
+        return xp.roll(k, -(self.DIMS1//2 - c0), axis = 1)
+    
+    # Channels are independent, so power iteration on all of them at once
+    # converges to the largest eigenvalue over channels
     def Hpower(self, x):
-        #x = np.fft.ifft2(self.H* np.fft.fft2(np.expand_dims(x,-1), axes = (0,1)), axes = (0,1))
-        x = np.fft.ifft2(np.multiply(self.H, np.fft.fft2(np.expand_dims(x,-1), axes = (0,1))), axes = (0,1))
-        x = np.sum(self.mask* self.crop(np.real(x)), 2)
+        x = self.Hfor(x)
         x = self.pad(x)
         return x
     
+    # FFTs are batched over the channel axis
     def Hfor(self, x):
-        x = np.fft.ifft2(self.H* np.fft.fft2(x, axes = (0,1)), axes = (0,1))
-        x = self.mask* self.crop(np.real(x))
+        xp = self.xp
+        x = xp.irfft2(self.H* xp.rfft2(x, axes = (0,1)), s = self.padded_shape, axes = (0,1))
+        x = self.mask* self.crop(x)
         return x
 
     def Hadj(self, x):
-        #x = np.expand_dims(x,-1)
+        xp = self.xp
         x = x*self.mask
         x = self.pad(x)
 
-        x = np.fft.fft2(x, axes = (0,1))
-        x = np.fft.ifft2(self.Hconj*x, axes = (0,1))
-        x = np.real(x)
+        x = xp.rfft2(x, axes = (0,1))
+        x = xp.irfft2(self.Hconj*x, s = self.padded_shape, axes = (0,1))
         return x
     
     def soft_thresh(self, x, tau):
-        out = np.maximum(np.abs(x)- tau, 0)
-        out = out*np.sign(x)
+        out = self.xp.nonneg(self.xp.abs(x)- tau)
+        out = out*self.xp.sign(x)
         return out 
     
     def prox(self,x):
+        xp = self.xp
         if self.prox_method == 'tv':
-            x = .5*(np.maximum(x,0) + tv.tv3dApproxHaar(x, self.tv_lambda/self.L, self.tv_lambdaw))
+            x = .5*(xp.nonneg(x) + tv.tv3dApproxHaar(x, self.tv_lambda/self.L, self.tv_lambdaw, xp))
         if self.prox_method == 'native':
-            x = np.maximum(x,0) + self.soft_thresh(x, self.tau)
+            x = xp.nonneg(x) + self.soft_thresh(x, self.tau)
         if self.prox_method == 'non-neg':
-            x = np.maximum(x,0) 
+            x = xp.nonneg(x) 
         return x
         
     def tv(self, x):
-        d = np.zeros_like(x)
+        d = self.xp.zeros_like(x)
         d[0:-1,:] = (x[0:-1,:] - x[1:, :])**2
         d[:,0:-1] = d[:,0:-1] + (x[:,0:-1] - x[:,1:])**2
-        return np.sum(np.sqrt(d))
+        return self.xp.sum(self.xp.sqrt(d))
         
     def loss(self,x,err):
+        xp = self.xp
         if self.prox_method == 'tv':
-            self.l_data.append(np.linalg.norm(err)**2)
-            self.l_tv.append(2*self.tv_lambda/self.L * self.tv(x))
+            l_data = xp.norm(err)**2
+            l_tv = 2*self.tv_lambda/self.L * self.tv(x)
+            self.l_data.append(float(l_data))
+            self.l_tv.append(float(l_tv))
             
-            l = np.linalg.norm(err)**2 + 2*self.tv_lambda/self.L * self.tv(x)
+            l = l_data + l_tv
         if self.prox_method == 'native':
-            l = np.linalg.norm(err)**2 + 2*self.tv_lambda/self.L * np.linalg.norm(x.ravel(), 1)
+            l = xp.norm(err)**2 + 2*self.tv_lambda/self.L * xp.sum(xp.abs(x))
         if self.prox_method == 'non-neg':
-            l = np.linalg.norm(err)**2
-        return l
+            l = xp.norm(err)**2
+        return float(l)
         
     # Main FISTA update 
     def fista_update(self, vk, tk, xk, inputs):
@@ -150,21 +253,29 @@ class fista_spectral_numpy():
         grads = self.Hadj(error)
         
         xup = self.prox(vk - 1/self.L * grads)
-        tup = 1 + np.sqrt(1 + 4*tk**2)/2
+        tup = 1 + math.sqrt(1 + 4*tk**2)/2
         vup = xup + (tk-1)/tup * (xup-xk)
             
         return vup, tup, xup, self.loss(xup, error)
 
 
-    # Run FISTA 
-    def run(self, inputs):   
+    # Run FISTA, x0 is an optional starting point of the padded size
+    def run(self, inputs, x0=None):   
+
+        xp = self.xp
+        inputs = xp.asarray(inputs)
 
-        # Initialize variables to zero 
-        xk = np.zeros((self.DIMS0*2, self.DIMS1*2, self.spectral_channels))
-        vk = np.zeros((self.DIMS0*2, self.DIMS1*2, self.spectral_channels))
+        # Initialize variables to zero or the starting point
+        if x0 is None:
+            xk = xp.zeros(self.x_shape)
+        else:
+            xk = xp.copy(xp.asarray(x0))
+        vk = xp.copy(xk)
         tk = 1.0
         
         llist = []
+        self.l_data = []
+        self.l_tv = []
 
         # Start FISTA loop 
         for i in range(0,self.iters):
@@ -175,19 +286,205 @@ class fista_spectral_numpy():
         
             # Print out the intermediate results and the loss 
             if self.show_recon_progress==True and i%self.print_every == 0:
+                import matplotlib.pyplot as plt # only needed for progress plots
                 print('iteration: ', i, ' loss: ', l)
-                if device == 'GPU':
-                    out_img = np.asnumpy(self.crop(xk))
-                else:
-                    out_img = self.crop(xk).squeeze()
-                    uncropped_out = np.copy(xk).squeeze()
+                out_img = xp.to_numpy(self.crop(xk)).squeeze()
+                uncropped_out = xp.to_numpy(xk).squeeze()
                 
                 plt.figure(figsize = (13,3))
-                plt.subplot(1,3,1), plt.imshow(np.clip((out_img/numpy.max(out_img)),0,1)); plt.title('Reconstruction')
+                plt.subplot(1,3,1), plt.imshow(np.clip((out_img/np.max(out_img)),0,1)); plt.title('Reconstruction')
                 plt.subplot(1,3,2), plt.imshow(np.clip((uncropped_out/np.max(uncropped_out)),0,1)); plt.title('Uncropped Reconstruction')
                 plt.subplot(1,3,3), plt.plot(llist); plt.title('Loss') # plt.ylim(0, 250)
                 plt.show()
                 self.out_img = out_img
-        xout = self.crop(xk) 
-        xnocrop = np.copy(xk)
-        return [xout, xnocrop], llist
\ No newline at end of file
+        xout = xp.to_numpy(self.crop(xk))
+        xnocrop = xp.to_numpy(xk).copy()
+        return [xout, xnocrop], llist
+
+# Solver parameters that apply to every level of fista_multires
+LEVEL_PARAMS = ('prox_method', 'tau', 'tv_lambda', 'tv_lambdaw', 'show_recon_progress', 'print_every')
+
+def level_shape(shape, factor):
+    """
+    (rows, cols) of SHAPE downsampled by FACTOR, rounded down to even sizes for the padding
+    """
+    if factor == 1:
+        return tuple(shape[:2])
+    return (2*(shape[0]//(2*factor)), 2*(shape[1]//(2*factor)))
+
+def resize_channels(x, shape, area=True):
+    """
+    resizes the first two axes of the (rows, cols, channels) array X to SHAPE,
+    area averaging for downsampling, bilinear for upsampling
+    """
+    import cv2
+    out = cv2.resize(np.asarray(x), (shape[1], shape[0]), interpolation=cv2.INTER_AREA if area else cv2.INTER_LINEAR)
+    return out.reshape(tuple(shape) + x.shape[2:])
+
+def repad(x, src, dst):
+    """
+    the padded solution X of solver SRC, upsampled to the padded shape of solver DST with
+    the sensor regions of both aligned. regions outside the padding of SRC stay zero
+    """
+    scale = (dst.DIMS0 / src.DIMS0, dst.DIMS1 / src.DIMS1)
+    x = resize_channels(x, tuple(round(n*f) for n, f in zip(x.shape[:2], scale)), area=False)
+    out = np.zeros(dst.padded_shape + x.shape[2:], dtype=x.dtype)
+    src_rows, dst_rows = [], []
+    for axis, f in enumerate(scale):
+        offset = dst.pads[axis][0] - round(src.pads[axis][0]*f) # position of x in out
+        start, stop = max(offset, 0), min(offset + x.shape[axis], dst.padded_shape[axis])
+        dst_rows.append(slice(start, stop))
+        src_rows.append(slice(start - offset, stop - offset))
+    out[tuple(dst_rows)] = x[tuple(src_rows)]
+    return out
+
+class fista_multires():
+    def __init__(self, h, mask, gray=False, levels=(4, 2, 1), iters=(100, 50, 50), **kwargs):
+        """
+        Coarse-to-fine FISTA. The problem is solved at each downsample factor in LEVELS
+        (relative to h, coarsest first) for the matching number of ITERS, and every
+        solution is upsampled as the starting point of the next level.
+        A solver, with its PSF spectrum and L, is built once per level.
+        kwargs are passed to every fista_spectral_numpy level (backend, num_threads, lipschitz, padding).
+        """
+        h = np.asarray(h)
+        mask = np.asarray(mask)
+        object.__setattr__(self, 'levels', tuple(levels))
+        object.__setattr__(self, 'iters', tuple(iters))
+        assert len(self.levels) == len(self.iters), "Need one iteration count per level."
+
+        solvers = []
+        for factor in self.levels:
+            shape = level_shape(h.shape, factor)
+            if factor == 1:
+                hl, ml = h, mask
+            else:
+                # downsampled PSFs are normalized per channel like preprocess()
+                hl = resize_channels(h, shape)
+                hl = hl / np.linalg.norm(hl, axis=(0,1))
+                ml = resize_channels(mask, shape)
+            solvers.append(fista_spectral_numpy(hl, ml, gray=gray, **kwargs))
+        object.__setattr__(self, 'solvers', solvers)
+        object.__setattr__(self, 'llists', [])
+
+    # parameters set on the pyramid, e.g. tv_lambda, are set on every level
+    def __setattr__(self, name, value):
+        if name in LEVEL_PARAMS:
+            for solver in self.solvers:
+                setattr(solver, name, value)
+        object.__setattr__(self, name, value)
+
+    # Least squares scale of the upsampled start, downsampling changes the scale of the solution
+    def rescale(self, solver, x0, inputs):
+        xp = solver.xp
+        Ax = solver.Hfor(xp.asarray(x0))
+        inputs = xp.asarray(inputs)
+        scale = float(xp.sum(Ax*inputs)) / max(float(xp.sum(Ax*Ax)), 1e-30)
+        return x0 * scale if scale > 0 else x0
+
+    # Run the pyramid, same return values as fista_spectral_numpy.run for the finest level
+    def run(self, inputs):
+        inputs = np.asarray(inputs)
+        self.llists = []
+        x0, previous = None, None
+        for factor, iters, solver in zip(self.levels, self.iters, self.solvers):
+            shape = (solver.DIMS0, solver.DIMS1)
+            level_inputs = inputs if factor == 1 else resize_channels(inputs, shape)
+            if x0 is not None:
+                x0 = repad(x0, previous, solver)
+                x0 = self.rescale(solver, x0, level_inputs)
+            solver.iters = iters
+            out, llist = solver.run(level_inputs, x0=x0)
+            x0, previous = out[1], solver
+            self.llists.append(llist)
+        return out, llist
+
+class fista_batch(fista_spectral_numpy):
+    def __init__(self, h, mask, gray=False, **kwargs):
+        """
+        FISTA for a batch of problems that share the PSF, along a fourth axis:
+        x is (rows, cols, channels, batch). Every batch element can have its own
+        measurement, tv_lambda and tv_lambdaw, so a parameter sweep is one run with
+        one PSF spectrum and one L. prox_method is shared by the batch.
+        kwargs are passed to fista_spectral_numpy (backend, num_threads, lipschitz).
+        """
+        super().__init__(h, mask, gray=gray, **kwargs)
+        xp = self.xp
+        # a trailing batch axis on everything that broadcasts against x
+        self.H = xp.expand_dims(self.H, 3)
+        self.Hconj = xp.expand_dims(self.Hconj, 3)
+        self.mask = xp.expand_dims(self.mask, 3)
+
+    # The loss of the whole batch is not meaningful, and skipping it saves a TV pass per iteration
+    def loss(self, x, err):
+        return 0.0
+
+    # Run FISTA on the batch, INPUTS is (rows, cols, channels, batch), TV_LAMBDA and TV_LAMBDAW
+    # have one value per batch element. returns {iterations: cropped x} for each of CHECKPOINTS
+    def run(self, inputs, tv_lambda, tv_lambdaw, checkpoints):
+        xp = self.xp
+        inputs = xp.asarray(inputs)
+        self.tv_lambda = xp.asarray(np.asarray(tv_lambda, dtype=np.float64))
+        self.tv_lambdaw = xp.asarray(np.asarray(tv_lambdaw, dtype=np.float64))
+        batch = inputs.shape[3]
+
+        xk = xp.zeros(self.padded_shape + (max(self.spectral_channels, inputs.shape[2]), batch))
+        vk = xp.copy(xk)
+        tk = 1.0
+
+        outputs = {}
+        for i in range(0, max(checkpoints)):
+            vk, tk, xk, _ = self.fista_update(vk, tk, xk, inputs)
+            if i + 1 in checkpoints:
+                outputs[i + 1] = xp.to_numpy(self.crop(xk)).copy()
+        return outputs
+
+class fista_multipsf(fista_spectral_numpy):
+    def __init__(self, h, mask, gray=False, plane_chunk=None, **kwargs):
+        """
+        FISTA against a stack of K depth or field dependent PSFs, h is (rows, cols, channels, K).
+        The measurement is the sum of the K planes of x (rows, cols, channels, K), each convolved
+        with its PSF, so the reconstruction has one image per plane. The K spectra are computed
+        once, and the FFTs of all planes are batched: Hfor takes K forward and one inverse FFT,
+        Hadj one forward and K inverse. All K spectra stay in memory; plane_chunk only bounds the
+        FFT temporaries of Hfor and Hadj to that many planes at a time. kwargs are passed to
+        fista_spectral_numpy (backend, num_threads).
+        """
+        if kwargs.setdefault('lipschitz', 'analytic') != 'analytic':
+            raise ValueError("fista_multipsf only supports lipschitz='analytic'")
+        verify_lipschitz = kwargs.pop('verify_lipschitz', False) # needs the planes set up
+        super().__init__(h, mask, gray=gray, **kwargs)
+        self.planes = h.shape[3]
+        self.plane_chunk = plane_chunk or self.planes
+        self.x_shape = self.padded_shape + (self.spectral_channels, self.planes)
+        if verify_lipschitz:
+            self.verify_lipschitz()
+
+    # The spectrum of A^T A is mask^2 times sum_k |H_k|^2 at every frequency
+    def lipschitz_bound(self):
+        xp = self.xp
+        H2 = xp.max(xp.sum(xp.abs(self.H)**2, axis = 3), axis = (0,1))
+        mask2 = xp.max(xp.abs(self.mask), axis = (0,1))**2
+        return float(xp.max(H2*mask2))
+
+    def chunks(self):
+        return [slice(k, k + self.plane_chunk) for k in range(0, self.planes, self.plane_chunk)]
+
+    # Planes are summed in the Fourier domain, so there is one inverse FFT
+    def Hfor(self, x):
+        xp = self.xp
+        y = 0
+        for k in self.chunks():
+            y = y + xp.sum(self.H[..., k]* xp.rfft2(x[..., k], axes = (0,1)), axis = 3)
+        y = xp.irfft2(y, s = self.padded_shape, axes = (0,1))
+        return self.mask* self.crop(y)
+
+    def Hadj(self, x):
+        xp = self.xp
+        x = xp.expand_dims(xp.rfft2(self.pad(x*self.mask), axes = (0,1)), 3)
+        if self.plane_chunk >= self.planes:
+            return xp.irfft2(self.Hconj*x, s = self.padded_shape, axes = (0,1))
+        out = xp.zeros(self.x_shape)
+        for k in self.chunks():
+            out[..., k] = xp.irfft2(self.Hconj[..., k]*x, s = self.padded_shape, axes = (0,1))
+        return out
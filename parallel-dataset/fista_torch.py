@@ -0,0 +1,139 @@
+import math
+import numpy as np
+import torch
+import fista_files.tv_approx_haar as tv
+from fista_files.backends import get_backend
+
+"""
+Differentiable FISTA for training pipelines.
+
+forward_model is the lensless forward model of fista_spectral_numpy (Hfor /
+Hadj with crop / pad) as a torch.nn.Module, and fista_unrolled runs a fixed
+number of FISTA iterations with the Haar TV prox through it. Both take batches
+of (batch, channels, rows, cols) tensors, run on torch's CPU thread pool (or
+any torch device) and support autograd, so a model or a data loading worker
+can compute physics-based initializations on the fly:
+
+    fista = fista_unrolled(psf, mask, iters=20, tv_lambda=1e-2, tv_lambdaw=0.01)
+    x = fista(meas)   # (B, C, rows, cols)
+
+The PSF spectrum and the step size are computed once when the module is built
+and move with it between devices. The momentum is the standard FISTA update,
+t' = (1 + sqrt(1 + 4 t^2))/2. fista_spectral_numpy uses 1 + sqrt(1 + 4 t^2)/2
+instead; legacy_momentum=True reproduces it, and then with the same parameters
+and lipschitz='analytic' the result matches the NumPy solver up to float32
+precision. With learnable=True the TV weight and step size of every iteration
+are trained as parameters.
+"""
+
+class forward_model(torch.nn.Module):
+    def __init__(self, h, mask, gray=False, dtype=torch.float32):
+        """
+        h, mask: (rows, cols[, channels]) PSF and mask, as for fista_spectral_numpy
+        """
+        super().__init__()
+        h = torch.as_tensor(np.asarray(h), dtype=dtype)
+        mask = torch.as_tensor(np.asarray(mask), dtype=dtype)
+        h = h[..., None] if h.ndim == 2 else h
+        mask = mask[..., None] if mask.ndim == 2 else mask
+
+        self.DIMS0 = h.shape[0]
+        self.DIMS1 = h.shape[1]
+        self.spectral_channels = 1 if gray else mask.shape[-1]
+        self.py = int(self.DIMS0//2)
+        self.px = int(self.DIMS1//2)
+        self.padded_shape = (self.DIMS0*2, self.DIMS1*2)
+
+        # (channels, rows, cols), broadcast against (batch, channels, rows, cols)
+        h = h.permute(2, 0, 1)
+        self.register_buffer('H', torch.fft.rfft2(torch.fft.ifftshift(self.pad(h), dim=(-2, -1))))
+        self.register_buffer('mask', mask.permute(2, 0, 1).contiguous())
+
+    def lipschitz_bound(self):
+        """
+        max |H|^2 * max |mask|^2 over channels, as fista_spectral_numpy.lipschitz_bound
+        """
+        H2 = torch.amax(torch.abs(self.H)**2, dim=(-2, -1))
+        mask2 = torch.amax(torch.abs(self.mask), dim=(-2, -1))**2
+        return float(torch.max(H2*mask2))
+
+    def crop(self, x):
+        return x[..., self.py:-self.py, self.px:-self.px]
+
+    def pad(self, x):
+        return torch.nn.functional.pad(x, (self.px, self.px, self.py, self.py))
+
+    def Hfor(self, x):
+        x = torch.fft.irfft2(self.H*torch.fft.rfft2(x), s=self.padded_shape)
+        return self.mask*self.crop(x)
+
+    def Hadj(self, x):
+        x = self.pad(x*self.mask)
+        return torch.fft.irfft2(torch.conj(self.H)*torch.fft.rfft2(x), s=self.padded_shape)
+
+    def forward(self, x):
+        return self.Hfor(x)
+
+class fista_unrolled(torch.nn.Module):
+    def __init__(self, h, mask, gray=False, iters=20, prox_method='tv', tv_lambda=1e-2, tv_lambdaw=0.01,
+                 learnable=False, legacy_momentum=False, num_threads=None, dtype=torch.float32):
+        """
+        ITERS iterations of FISTA for measurements (batch, channels, rows, cols).
+        prox_method: 'tv' (Haar approximation) or 'non-neg'
+        tv_lambda, tv_lambdaw: floats, or one value per batch element
+        learnable: train a TV weight and a step size scale per iteration, starting from
+                   TV_LAMBDA and 1/L
+        legacy_momentum: the momentum update of fista_spectral_numpy, for parity with it
+        num_threads: intra-op threads, None keeps torch's default
+        """
+        super().__init__()
+        self.A = forward_model(h, mask, gray=gray, dtype=dtype)
+        self.iters = iters
+        self.prox_method = prox_method
+        self.legacy_momentum = legacy_momentum
+        self.L = self.A.lipschitz_bound()
+        self.xp = get_backend('torch', num_threads=num_threads)
+
+        lam = torch.as_tensor(np.asarray(tv_lambda), dtype=dtype)
+        lamw = torch.as_tensor(np.asarray(tv_lambdaw), dtype=dtype)
+        if learnable:
+            # log scale keeps the weights and steps positive
+            self.log_tv_lambda = torch.nn.Parameter(torch.log(lam).expand(iters, *lam.shape).clone())
+            self.log_step = torch.nn.Parameter(torch.zeros(iters, dtype=dtype))
+        else:
+            self.register_buffer('log_tv_lambda', torch.log(lam).expand(iters, *lam.shape).clone())
+            self.register_buffer('log_step', torch.zeros(iters, dtype=dtype))
+        self.register_buffer('tv_lambdaw', lamw)
+
+    def prox(self, x, tau):
+        if self.prox_method == 'tv':
+            # tv3dApproxHaar takes (rows, cols, channels, batch), per batch values broadcast on the last axis
+            haar = tv.tv3dApproxHaar(x.permute(2, 3, 1, 0), tau, self.tv_lambdaw, self.xp).permute(3, 2, 0, 1)
+            return .5*(torch.relu(x) + haar)
+        if self.prox_method == 'non-neg':
+            return torch.relu(x)
+        raise ValueError(f"Unknown prox_method {self.prox_method}, options: 'tv', 'non-neg'")
+
+    def forward(self, inputs, x0=None, crop=True):
+        """
+        reconstructions of INPUTS (batch, channels, rows, cols), cropped to the input size
+        unless CROP is False. x0 is an optional padded starting point
+        """
+        if x0 is None:
+            channels = max(self.A.spectral_channels, inputs.shape[1])
+            xk = inputs.new_zeros((inputs.shape[0], channels) + self.A.padded_shape)
+        else:
+            xk = x0
+        vk = xk
+        tk = 1.0
+        for i in range(self.iters):
+            step = torch.exp(self.log_step[i]) / self.L
+            grads = self.A.Hadj(self.A.Hfor(vk) - inputs)
+            xup = self.prox(vk - step*grads, torch.exp(self.log_tv_lambda[i]) / self.L)
+            if self.legacy_momentum:
+                tup = 1 + math.sqrt(1 + 4*tk**2)/2 # as fista_spectral_numpy.fista_update
+            else:
+                tup = (1 + math.sqrt(1 + 4*tk**2))/2
+            vk = xup + (tk - 1)/tup*(xup - xk)
+            xk, tk = xup, tup
+        return self.A.crop(xk) if crop else xk
@@ -1,19 +1,141 @@
 import os
-from typing import List
+import sys
 import glob
-import kornia as K
-import matplotlib.pyplot as plt
-import numpy as np
-import torch
-import kornia.geometry.transform as transform
-from kornia.geometry import resize
-from natsort import natsorted
-from kornia.augmentation import CenterCrop
-from skimage.transform import rescale, resize
+import pickle
+import zipfile
 import argparse
-import skimage.io as skio
+import collections
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fista_files.image_io import read_image
+
+# torch, kornia, cv2, matplotlib and natsort are imported where they are used
+# so importing this module stays cheap.
+
+"""
+Homographies are applied with HomographyWarp, which computes the remap tables
+of a matrix once per (input size, output size) and warps NumPy images with
+cv2.remap. It follows kornia's warp_perspective (bilinear, align_corners=True,
+zeros outside the input), so torch is not needed to resample. The kornia path
+is kept as --backend kornia for comparison.
+
+The calibration files in calib_files/ are torch.save() archives of a (1, 3, 3)
+float32 tensor despite their .npy extension. load_homography() reads them
+without torch.
+"""
+
+# numpy dtype of the torch storage classes found in torch.save() archives
+TORCH_STORAGE_DTYPES = {
+    "FloatStorage": np.float32,
+    "DoubleStorage": np.float64,
+    "HalfStorage": np.float16,
+    "LongStorage": np.int64,
+    "IntStorage": np.int32,
+}
+CV2_MAX_CHANNELS = 4 # cv2.remap handles at most 4 channels per call
+
+class _TorchArchiveUnpickler(pickle.Unpickler):
+    """
+    unpickles the data.pkl of a torch.save() archive into NumPy arrays
+    """
+    def __init__(self, file, archive, prefix, byteorder):
+        super().__init__(file)
+        self.archive = archive
+        self.prefix = prefix
+        self.byteorder = byteorder
+
+    def find_class(self, module, name):
+        if (module, name) == ("torch._utils", "_rebuild_tensor_v2"):
+            return _rebuild_tensor
+        if module == "torch" and name in TORCH_STORAGE_DTYPES:
+            return np.dtype(TORCH_STORAGE_DTYPES[name]).newbyteorder(self.byteorder)
+        if (module, name) == ("collections", "OrderedDict"):
+            return collections.OrderedDict
+        raise pickle.UnpicklingError(f"Unsupported object in torch archive: {module}.{name}")
+
+    def persistent_load(self, pid):
+        _, dtype, key, _, _ = pid # ('storage', storage type, key, location, numel)
+        return np.frombuffer(self.archive.read(f"{self.prefix}/data/{key}"), dtype=dtype)
+
+def _rebuild_tensor(storage, offset, size, stride, *args):
+    itemsize = storage.dtype.itemsize
+    return np.lib.stride_tricks.as_strided(storage[offset:], size, [s*itemsize for s in stride]).astype(storage.dtype.newbyteorder('='))
+
+def load_torch_archive(path):
+    """
+    tensor saved with torch.save() at PATH as a NumPy array, without importing torch
+    """
+    with zipfile.ZipFile(path) as archive:
+        pkl = next(name for name in archive.namelist() if name.endswith("/data.pkl"))
+        prefix = pkl[:-len("/data.pkl")]
+        byteorder = "<"
+        if f"{prefix}/byteorder" in archive.namelist():
+            byteorder = "<" if archive.read(f"{prefix}/byteorder") == b"little" else ">"
+        with archive.open(pkl) as f:
+            return _TorchArchiveUnpickler(f, archive, prefix, byteorder).load()
+
+def load_homography(path):
+    """
+    3x3 float64 homography from a .npy file or a torch.save() archive
+    """
+    M = load_torch_archive(path) if zipfile.is_zipfile(path) else np.load(path)
+    return np.asarray(M, dtype=np.float64).reshape(3, 3)
+
+class HomographyWarp():
+    """
+    warps images with the homography M (3x3, mapping input to output pixel coordinates).
+    remap tables are computed on first use for every (input size, output size) and reused
+    """
+    def __init__(self, M):
+        self.M = np.asarray(M, dtype=np.float64).reshape(3, 3)
+        self.maps = {}
+
+    def remap_tables(self, in_shape, out_shape):
+        """
+        fixed point tables sampling an IN_SHAPE (h, w) image at M^-1 of every OUT_SHAPE pixel
+        """
+        import cv2
+        key = (tuple(in_shape), tuple(out_shape))
+        if key not in self.maps:
+            h, w = out_shape
+            ys, xs = np.mgrid[0:h, 0:w]
+            src = np.linalg.inv(self.M) @ np.stack([xs.ravel(), ys.ravel(), np.ones(h*w)])
+            map_x = (src[0] / src[2]).reshape(h, w).astype(np.float32)
+            map_y = (src[1] / src[2]).reshape(h, w).astype(np.float32)
+            self.maps[key] = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+        return self.maps[key]
+
+    def __call__(self, img, out_shape=None):
+        """
+        warped IMG (h, w) or (h, w, c), uint8 or float32, of OUT_SHAPE (h, w), the input size by default
+        """
+        import cv2
+        out_shape = img.shape[:2] if out_shape is None else out_shape
+        maps = self.remap_tables(img.shape[:2], out_shape)
+        if img.ndim == 3 and img.shape[2] > CV2_MAX_CHANNELS:
+            return np.concatenate([self(img[..., c:c + CV2_MAX_CHANNELS], out_shape)
+                                   for c in range(0, img.shape[2], CV2_MAX_CHANNELS)], axis=2)
+        warped = cv2.remap(img, *maps, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        return warped.reshape(tuple(out_shape) + img.shape[2:]) # cv2 drops a single channel axis
+
+def warp_kornia(img, M, out_shape=None):
+    """
+    IMG (h, w) or (h, w, c) warped by kornia's warp_perspective, the reference for HomographyWarp
+    """
+    import torch
+    import kornia.geometry.transform as transform
+    out_shape = img.shape[:2] if out_shape is None else out_shape
+    x = torch.from_numpy(np.ascontiguousarray(img, dtype=np.float32))
+    x = x.permute(2, 0, 1)[None] if x.ndim == 3 else x[None, None]
+    M = torch.from_numpy(np.asarray(M, dtype=np.float32).reshape(1, 3, 3))
+    warped = transform.warp_perspective(x, M, dsize=tuple(out_shape))[0]
+    return (warped.permute(1, 2, 0) if img.ndim == 3 else warped[0]).numpy()
 
 def load_images(path='./results', gray=True, output_shape=(150, 240)):
+    import torch
+    from natsort import natsorted
+
     images = [img for img in os.listdir(path) if img.endswith('.jpg') or img.endswith('.png') or img.endswith('.tiff')]
     images = natsorted(images)
     
@@ -25,16 +147,16 @@ def load_images(path='./results', gray=True, output_shape=(150, 240)):
         if 'jpg' and 'png' and 'tiff' not in img:
             continue
             
+        # read at reduced resolution when OUTPUT_SHAPE allows it
+        shape = output_shape if output_shape != (0, 0) else None
+        img = read_image(os.path.join(path, img), shape=shape, dtype=np.float32)
         if gray:
-            img = skio.imread(os.path.join(path, img))[:, :, 0]
+            img = img[:, :, 0]
         else:
-            img = skio.imread(os.path.join(path, img))[:, :, 0:3]
+            img = img[:, :, 0:3]
 
         img = img / np.max(img)  # normalize to 1
 
-        if output_shape != (0, 0):
-            img = resize(img, output_shape, anti_aliasing=True)
-
         # Convert to tensor
         img = torch.from_numpy(img).to(torch.float32)
 
@@ -62,6 +184,7 @@ def main():
         --matrix_path (str): Path to the .npy file containing the transformation matrix.
         --output_dir (str): Path to the directory where the warped images will be saved.
         --gray (str): True if recons are grayscale.
+        --backend (str): cv2 (default) or kornia.
     
     Example (if terminal in source directory):
         python parallel-dataset/homography/apply_homography.py \
@@ -75,10 +198,15 @@ def main():
     parser.add_argument("--matrix_path", type=str, required=True, help="Path to the transformation matrix (.npy file).")
     parser.add_argument("--output_dir", type=str, required=True, help="Directory to save the warped images.")
     parser.add_argument("--gray", type=str, required=True, help="True if grayscale images.")
+    parser.add_argument("--backend", type=str, default="cv2", choices=["cv2", "kornia"], help="Warp with cached cv2 remap tables or with kornia.")
     args = parser.parse_args()
 
+    from matplotlib.image import imsave
+    from natsort import natsorted
+
     # Load transformation matrix
-    M = torch.load(args.matrix_path).to(torch.float32)
+    M = load_homography(args.matrix_path)
+    warp = HomographyWarp(M) if args.backend == "cv2" else lambda img: warp_kornia(img, M)
 
     gray = True if args.gray == 'True' else False
 
@@ -92,41 +220,18 @@ def main():
     num_imgs = 0
     for image_path in images:
         # Load and process single image
-        img = plt.imread(image_path)
-
         # MAKE SURE YOU UPDATE DOWNSAMPLING TO MATCH DESIRED LEVELS. X4 BY DEFAULT
-        if img.shape != (300, 480):
-            img = resize(img, (300, 480), anti_aliasing=True)
-        
-        # Convert to tensor and ensure C-contiguous
-        img = np.ascontiguousarray(img)
-        img = torch.from_numpy(img).to(torch.float32)
-        img = img.contiguous() # Ensure tensor is contiguous
-        
-        if len(img.shape) == 3:  # If image has channels
-            img = img.permute(2, 0, 1)  # Change from (H,W,C) to (C,H,W)
-            img = img.contiguous() # Ensure contiguous after permute
-            img = img[None, ...]  # Add batch dimension
-        else:
-            img = img[None, None, ...]  # Add batch and channel dimensions
-            
-        # Apply homography transform
-        warped_img = transform.warp_perspective(img.float(), M.float(), 
-                                              dsize=(img.shape[2], img.shape[3])).squeeze().detach().cpu()
-        
-        if not gray:
-            warped_img = warped_img.permute(1, 2, 0)  # switch to (H, W, C)
-            warped_img = warped_img.contiguous() # Ensure contiguous after permute
+        img = read_image(image_path, shape=(300, 480), dtype=np.float32)
+
+        # Apply homography transform, (H, W) or (H, W, C)
+        warped_img = warp(img)
 
         # Normalize to 0-1
-        warped_img = warped_img / torch.max(warped_img)
+        warped_img_np = np.ascontiguousarray(warped_img / np.max(warped_img))
 
-        # Convert to numpy array and ensure C-contiguous before saving
-        warped_img_np = np.ascontiguousarray(warped_img.detach().numpy())
-        
         # Save warped image
         output_path = os.path.join(args.output_dir, f"warped_{os.path.basename(image_path)}")
-        plt.imsave(output_path, warped_img_np, cmap=None if not gray else 'gray')
+        imsave(output_path, warped_img_np, cmap=None if not gray else 'gray')
         
         num_imgs += 1
         if num_imgs % 1000 == 0:
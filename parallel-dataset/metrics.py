@@ -0,0 +1,73 @@
+import numpy as np
+
+"""
+Image quality metrics on batches of images, (batch, rows, cols[, channels])
+arrays with values in [0, DATA_RANGE]. Every function returns one value per
+image, computed in a few array passes over the whole batch.
+
+ssim() follows the usual definition (Wang et al. 2004) with an 11x11 gaussian
+window of sigma 1.5, like skimage's structural_similarity with
+gaussian_weights=True, averaged over channels. backend='torch' computes it
+with separable convolutions on torch's CPU thread pool.
+"""
+
+SSIM_SIGMA = 1.5
+SSIM_TRUNCATE = 3.5 # window radius in sigmas, 3.5 * 1.5 rounds to a radius of 5, an 11x11 window
+SSIM_K = (0.01, 0.03)
+
+def _batch(x):
+    x = np.asarray(x, dtype=np.float32)
+    return x[..., None] if x.ndim == 3 else x
+
+def normalize_max(x):
+    """
+    scales every image of the batch X to a maximum of 1
+    """
+    x = _batch(x)
+    return x / np.maximum(x.max(axis=(1, 2, 3), keepdims=True), 1e-12)
+
+def mse(x, ref):
+    x, ref = _batch(x), _batch(ref)
+    return np.mean((x - ref)**2, axis=(1, 2, 3))
+
+def psnr(x, ref, data_range=1.0):
+    return 10*np.log10(data_range**2 / np.maximum(mse(x, ref), 1e-12))
+
+def _ssim_torch(x, ref, c1, c2, r):
+    import torch
+    batch = x.shape[0]
+    # (batch, rows, cols, channels) to (batch*channels, 1, rows, cols)
+    to_planes = lambda a: torch.from_numpy(np.ascontiguousarray(np.moveaxis(a, 3, 1))).reshape(-1, 1, *a.shape[1:3])
+    x, ref = to_planes(x), to_planes(ref)
+    g = np.exp(-0.5*(np.arange(-r, r + 1)/SSIM_SIGMA)**2)
+    g = torch.from_numpy((g/g.sum()).astype(np.float32))
+    # only the valid part is computed, the same pixels the numpy version keeps
+    blur = lambda a: torch.nn.functional.conv2d(torch.nn.functional.conv2d(a, g.view(1, 1, -1, 1)), g.view(1, 1, 1, -1))
+
+    mu_x, mu_r = blur(x), blur(ref)
+    var_x = blur(x*x) - mu_x*mu_x
+    var_r = blur(ref*ref) - mu_r*mu_r
+    cov = blur(x*ref) - mu_x*mu_r
+    s = ((2*mu_x*mu_r + c1)*(2*cov + c2)) / ((mu_x**2 + mu_r**2 + c1)*(var_x + var_r + c2))
+    return s.reshape(batch, -1).mean(dim=1).numpy()
+
+def ssim(x, ref, data_range=1.0, backend='numpy'):
+    import scipy.ndimage
+    x, ref = _batch(x), _batch(ref)
+    c1, c2 = (SSIM_K[0]*data_range)**2, (SSIM_K[1]*data_range)**2
+    # the window does not fit at the border, those pixels are left out of the mean
+    r = int(SSIM_TRUNCATE*SSIM_SIGMA + 0.5)
+    if backend == 'torch':
+        return _ssim_torch(x, ref, c1, c2, r)
+
+    sigma = (0, SSIM_SIGMA, SSIM_SIGMA, 0)
+    blur = lambda a: scipy.ndimage.gaussian_filter(a, sigma, truncate=SSIM_TRUNCATE)
+
+    mu_x, mu_r = blur(x), blur(ref)
+    var_x = blur(x*x) - mu_x*mu_x
+    var_r = blur(ref*ref) - mu_r*mu_r
+    cov = blur(x*ref) - mu_x*mu_r
+    s = ((2*mu_x*mu_r + c1)*(2*cov + c2)) / ((mu_x**2 + mu_r**2 + c1)*(var_x + var_r + c2))
+    return s[:, r:-r, r:-r].mean(axis=(1, 2, 3))
+
+METRICS = {"mse": mse, "psnr": psnr, "ssim": ssim}
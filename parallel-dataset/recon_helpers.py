@@ -0,0 +1,115 @@
+import os
+import numpy as np
+from fista_files.helper_functions import preprocess_psf, preprocess_image, preplot, save_image
+import fista_spectral_cupy as FSC
+from admm_spectral import admm_spectral
+
+"""
+Helpers shared by reconstruction.py and reconstruction_online.py.
+"""
+
+# FISTA parameters used for every dataset reconstruction
+FISTA_PARAMS = {
+    "iters": 200, # Default: 200
+    # Default: tv, Options: 'native' for native sparsity, 'non-neg' for enforcing non-negativity only
+    "prox_method": 'tv',
+    "tv_lambda": 1e-2, #1e-3, 1e-2, 1e-1
+    "tv_lambdaw": 0.01,
+    "print_every": 20,
+}
+
+# ADMM parameters, see compare_solvers.py
+ADMM_PARAMS = {
+    "iters": 100,
+    "mu1": 1e-3, # starting penalties, relative to the mean of |H|^2
+    "mu2": 1e-2,
+    "mu3": 4e-2,
+    "tau": 3e-3,
+    "print_every": 20,
+}
+
+def check_imgname(img_name):
+    if img_name[0] == '.':
+        return False
+    if 'psf' in img_name or not ('.tiff' in img_name):
+        return False
+    return True
+
+def check_psfname(psf_name):
+    if psf_name[0] == '.':
+        return False
+    if 'psf' in psf_name:
+        return True
+    return False
+
+def find_psf(psf_path, cam_path, ind):
+    """
+    PSF for the imager with index IND (cam_{context}) in PSF_PATH,
+    falls back to psf.tiff in the imager's directory
+    """
+    psf_list = [f for f in os.listdir(psf_path) if check_psfname(f) and f'{ind}' in f] if os.path.isdir(psf_path) else []
+    return f'{psf_path}/{psf_list[0]}' if len(psf_list) > 0 else f'{cam_path}/psf.tiff'
+
+def result_name(img_path):
+    """
+    {imager directory}/results/reconned_{image name}
+    """
+    cam_path, f_img = os.path.split(img_path)
+    return f'{cam_path}/results/reconned_{f_img}'
+
+class WarmReconstructor():
+    """
+    FISTA or ADMM reconstructions for one lensless imager. The PSF is preprocessed and
+    its spectrum and step size computed once, then reused for every measurement.
+    Not thread safe, use one per worker.
+    """
+    def __init__(self, psf_name, f=8, grayscale=False, color=False, backend='numpy', num_threads=None, params=None, pyramid=None, solver='fista', padding='full'):
+        """
+        color: reconstruct all color channels in one solve instead of only green
+        backend, num_threads: array backend, see fista_files/backends.py
+        params: solver parameters, FISTA_PARAMS or ADMM_PARAMS by default
+        pyramid: None for FISTA at factor f, or {'levels': ..., 'iters': ...} for
+                 coarse-to-fine FISTA (fista_multires), which replaces params['iters']
+        solver: 'fista' or 'admm'
+        padding: FISTA padding, 'full' or 'support' (see fista_spectral_numpy)
+        """
+        self.psf_name = psf_name
+        self.grayscale = grayscale
+        psf, mask, self.bg, self.size = preprocess_psf(psf_name, f, gray_image=grayscale)
+        channels = slice(None) if color or grayscale else slice(1, 2)
+        kwargs = dict(gray=grayscale, backend=backend, num_threads=num_threads)
+        if solver == 'admm':
+            params = ADMM_PARAMS if params is None else params
+            self.solver = admm_spectral(psf[:,:,channels], mask[:,:,channels], **kwargs)
+        elif solver == 'fista':
+            params = FISTA_PARAMS if params is None else params
+            kwargs['padding'] = padding
+            if pyramid is None:
+                self.solver = FSC.fista_spectral_numpy(psf[:,:,channels], mask[:,:,channels], **kwargs)
+            else:
+                self.solver = FSC.fista_multires(psf[:,:,channels], mask[:,:,channels], **kwargs, **pyramid)
+                params = {key: value for key, value in params.items() if key != 'iters'}
+        else:
+            raise ValueError(f"Unknown solver {solver}, options: 'fista', 'admm'")
+        for key, value in params.items():
+            setattr(self.solver, key, value)
+
+    def reconstruct(self, img_path):
+        """
+        returns the reconstruction of the measurement at IMG_PATH, scaled to [0, 1]
+        """
+        img = preprocess_image(img_path, self.bg, self.size, gray_image=self.grayscale)
+        out_img = self.solver.run(img)
+        return preplot(out_img[0][0])
+
+    def reconstruct_and_save(self, img_path, npy_save=False):
+        """
+        reconstructs IMG_PATH and saves it to result_name(IMG_PATH), returns the saved path
+        """
+        name = result_name(img_path)
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+        plotted_img = self.reconstruct(img_path)
+        save_image(name, plotted_img)
+        if npy_save:
+            np.save(f'{name}.npy', plotted_img)
+        return name
@@ -0,0 +1,161 @@
+import os
+import time
+import sqlite3
+
+"""
+Durable reconstruction work queue in a SQLite database, for
+reconstruction_distributed.py.
+
+The database lives on storage shared by every node, next to the capture, and
+relies on SQLite's file locking, so no service has to run. Every state change
+is one short write transaction:
+- enqueue() adds measurements, measurements already in the queue are kept as they are
+- lease() hands a worker pending tasks, and tasks whose lease ran out because their
+  worker died, for LEASE_SECONDS
+- renew() extends the leases of a live worker, ack() and fail() finish a task
+A task is retried MAX_ATTEMPTS times before it is marked failed.
+
+Rollback journaling is used instead of WAL, which needs shared memory and does
+not work on network file systems.
+"""
+
+LEASE_SECONDS = 300.0 # a task is given to another worker if its lease is not renewed in time
+MAX_ATTEMPTS = 3
+BUSY_TIMEOUT = 60.0   # seconds to wait for another node's transaction
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    path TEXT PRIMARY KEY,
+    camera INTEGER NOT NULL,
+    psf TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending', -- pending, leased, done, failed
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    seconds REAL
+);
+CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, lease_until);
+"""
+
+class ReconQueue():
+    """
+    connection to the queue database at PATH, one per process
+    """
+    def __init__(self, path, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # autocommit, transactions are opened explicitly with BEGIN IMMEDIATE
+        self.db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=DELETE")
+        self.db.executescript(SCHEMA)
+
+    def _write(self, fn):
+        """
+        runs FN(cursor) in a write transaction, BEGIN IMMEDIATE takes the file lock up
+        front so two workers can never lease the same task
+        """
+        cur = self.db.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            out = fn(cur)
+            cur.execute("COMMIT")
+            return out
+        except BaseException:
+            cur.execute("ROLLBACK")
+            raise
+
+    def enqueue(self, tasks):
+        """
+        adds TASKS, (path, camera context, PSF path) tuples. returns the number of new tasks.
+        """
+        def insert(cur):
+            before = self.db.total_changes
+            cur.executemany("INSERT OR IGNORE INTO tasks (path, camera, psf) VALUES (?, ?, ?)", tasks)
+            return self.db.total_changes - before
+        return self._write(insert)
+
+    def lease(self, worker, n=1, cameras=()):
+        """
+        leases up to N tasks to WORKER, tasks of CAMERAS first (imagers the worker already
+        has warm PSF state for). expired leases are reclaimed. returns [(path, camera, psf)].
+        """
+        def take(cur):
+            now = time.time()
+            # tasks whose last allowed attempt died with its worker
+            cur.execute(
+                "UPDATE tasks SET state = 'failed', error = COALESCE(error, 'lease expired') WHERE state = 'leased' AND lease_until < ? AND attempts >= ?",
+                (now, self.max_attempts))
+            preferred = ",".join(str(int(c)) for c in cameras) or "NULL"
+            rows = cur.execute(
+                f"""SELECT path, camera, psf FROM tasks
+                    WHERE (state = 'pending' OR (state = 'leased' AND lease_until < ?)) AND attempts < ?
+                    ORDER BY camera IN ({preferred}) DESC, camera, path LIMIT ?""",
+                (now, self.max_attempts, n)).fetchall()
+            cur.executemany(
+                "UPDATE tasks SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 WHERE path = ?",
+                [(worker, now + self.lease_seconds, path) for path, _, _ in rows])
+            return rows
+        return self._write(take)
+
+    def renew(self, worker):
+        """
+        extends every lease WORKER holds, returns the number of leases
+        """
+        def extend(cur):
+            cur.execute("UPDATE tasks SET lease_until = ? WHERE state = 'leased' AND worker = ?",
+                        (time.time() + self.lease_seconds, worker))
+            return cur.rowcount
+        return self._write(extend)
+
+    def ack(self, path, worker, result, seconds=None):
+        """
+        marks PATH done. a worker whose lease was reclaimed in the meantime still completes
+        the task, the result file is the same whichever worker writes it.
+        """
+        self._write(lambda cur: cur.execute(
+            "UPDATE tasks SET state = 'done', worker = ?, lease_until = NULL, result = ?, seconds = ?, error = NULL WHERE path = ? AND state != 'done'",
+            (worker, result, seconds, path)))
+
+    def fail(self, path, worker, error):
+        """
+        returns PATH to the queue, or marks it failed after MAX_ATTEMPTS attempts
+        """
+        self._write(lambda cur: cur.execute(
+            "UPDATE tasks SET state = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, lease_until = NULL, error = ? WHERE path = ? AND worker = ? AND state = 'leased'",
+            (self.max_attempts, f"{worker}: {error}", path, worker)))
+
+    def reset_failed(self):
+        """
+        gives failed tasks another MAX_ATTEMPTS attempts, returns their number
+        """
+        def reset(cur):
+            cur.execute("UPDATE tasks SET state = 'pending', attempts = 0 WHERE state = 'failed'")
+            return cur.rowcount
+        return self._write(reset)
+
+    def counts(self):
+        """
+        {state: number of tasks}, expired leases are counted as pending
+        """
+        rows = self.db.execute(
+            "SELECT CASE WHEN state = 'leased' AND lease_until < ? THEN 'pending' ELSE state END, COUNT(*) FROM tasks GROUP BY 1",
+            (time.time(),)).fetchall()
+        counts = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+        counts.update(dict(rows))
+        return counts
+
+    def workers(self):
+        """
+        {worker: (tasks done, mean seconds per task)}
+        """
+        rows = self.db.execute("SELECT worker, COUNT(*), AVG(seconds) FROM tasks WHERE state = 'done' GROUP BY worker").fetchall()
+        return {worker: (done, seconds) for worker, done, seconds in rows}
+
+    def close(self):
+        self.db.close()
+
+def queue_path(sub_dir):
+    return os.path.join(sub_dir, "recon_queue.sqlite")
@@ -1,8 +1,6 @@
-import numpy as np
-import matplotlib.pyplot as plt
 import os
-from fista_files.helper_functions import *
-import fista_spectral_cupy as FSC
+from recon_helpers import WarmReconstructor, check_imgname, find_psf
+from rig_config import load_rig, lensless_cameras
 import sys
 
 
@@ -16,65 +14,35 @@ DESTINATION = ARGS[1]
 SUB_DIR = DESTINATION + ARGS[2]
 
 ## This section can be tailored to your system
-RML_PATH = f"{SUB_DIR}/rml"
-DC_PATH = f"{SUB_DIR}/diffuser"
+# lensless imager directories and PSF indices are read from the rig file
+RIG = load_rig()
 PSF_PATH = f"{DESTINATION}/psf"
-PATH_ARR = [DC_PATH, RML_PATH]
-INDEX_ARR = ["cam_0", "cam_1"]
+PATH_ARR = [f"{SUB_DIR}/{cam['path']}" for _, cam in lensless_cameras(RIG)]
+INDEX_ARR = [f"cam_{idx}" for idx, _ in lensless_cameras(RIG)]
 
 grayscale = False 
+color = False # reconstruct all color channels in one solve instead of only green
 npy_save = False
+solver = 'fista' # 'fista' or 'admm', see compare_solvers.py
+backend = 'numpy' # solver array backend: 'numpy', 'torch' (multithreaded CPU) or 'cupy' (GPU)
+# coarse-to-fine FISTA: solve at f*levels, coarsest first, warm starting each finer level
+# e.g. {'levels': (4, 2, 1), 'iters': (100, 50, 50)}, None for 200 iterations at f
+pyramid = None
+padding = 'full' # FISTA padding: 'full' (2x the sensor) or 'support' (PSF extent, faster), see compare_solvers.py
+num_threads = None # FFT workers (numpy) or threads (torch), None uses the backend default
 
 f = 8 # downsample factor
 
-def check_imgname(img_name):
-    if img_name[0] == '.':
-        return False
-    if 'psf' in img_name or not ('.tiff' in img_name):
-        return False
-    return True
-
-def check_psfname(psf_name):
-    if psf_name[0] == '.':
-        return False
-    if 'psf' in psf_name:
-        return True
-    return False
-
 ## PROCESSING LOOP
 print("Reconstructing captured images from: ", SUB_DIR)
 for cam, ind in list(zip(PATH_ARR, INDEX_ARR)):
     data_capture = [img for img in os.listdir(cam) if check_imgname(img)]
-    psf_list = [f for f in os.listdir(PSF_PATH) if check_psfname(f) and f'{ind}' in f]
-    psf_name = f'{PSF_PATH}/{psf_list[0]}' if len(psf_list) > 0 else f'{cam}/psf.tiff'
+    psf_name = find_psf(PSF_PATH, cam, ind)
     
     print("Using PSF: ", psf_name)
+    # PSF preprocessing and solver set-up are shared by every image of this imager
+    recon = WarmReconstructor(psf_name, f, grayscale=grayscale, color=color, backend=backend, num_threads=num_threads, pyramid=pyramid, solver=solver, padding=padding)
     for f_img in data_capture:
-        img_path = f"{cam}/{f_img}"
-        result_path = f'{cam}/results'
-        result_name = f'{result_path}/reconned_{f_img}'
-
-        if not os.path.exists(result_path):
-            os.mkdir(f'{cam}/results')
-
         print("Starting recon for: ", f_img)
-        psf, img, mask = preprocess(psf_name, img_path, f, gray_image=grayscale)
-        fista = FSC.fista_spectral_numpy(psf[:,:,1:2], mask[:,:,1:2], gray=grayscale)
-        
-        # set FISTA parameters
-        fista.iters = 200 # Default: 200
-        # Default: tv, Options: 'native' for native sparsity, 'non-neg' for enforcing non-negativity only
-        fista.prox_method = 'tv'  
-        fista.tv_lambda  = 1e-2  #1e-3, 1e-2, 1e-1
-        fista.tv_lambdaw = 0.01 
-        fista.print_every = 20
-
-        out_img = fista.run(img)
-        plotted_img = preplot(out_img[0][0])
-
-        plt.imsave(result_name, plotted_img)
-        if npy_save:
-            np.save(f'{result_path}/reconned_{f_img}.npy', plotted_img)
-        # plt.imshow(plotted_img, cmap='gray')
-        # plt.title(f'FISTA after {fista.iters} iterations')
-        print("Completed and saved recon for: ", f_img)
\ No newline at end of file
+        recon.reconstruct_and_save(f"{cam}/{f_img}", npy_save=npy_save)
+        print("Completed and saved recon for: ", f_img)
@@ -0,0 +1,180 @@
+import os
+import sys
+import json
+import time
+import socket
+import threading
+from recon_helpers import WarmReconstructor, check_imgname, find_psf
+from recon_queue import ReconQueue, queue_path
+from rig_config import RIG_FILE, load_rig, lensless_cameras
+
+"""
+Reconstruction of a capture on several nodes through a shared work queue.
+
+The coordinator enqueues every lensless measurement of SUB_DIR into
+SUB_DIR/recon_queue.sqlite (see recon_queue.py), from the imager directories
+or, with ENQUEUE_FROM = 'journal', from the capture journal. Workers can be
+started on any node that mounts DESTINATION, before or after the coordinator
+and at any point during the run. Each worker leases one task at a time,
+reconstructs it with warm PSF state (one WarmReconstructor per imager, tasks
+of imagers it already has set up are leased first), writes the same
+{imager}/results/reconned_* file as reconstruction.py and acknowledges the
+task. A heartbeat thread renews the worker's lease, so a task is only handed
+to another worker when its worker died. Workers exit once no task is pending
+or leased, or wait for more with FOLLOW.
+
+Measurement and result paths are stored relative to SUB_DIR, and PSF paths
+relative to DESTINATION. Every worker resolves them against the DESTINATION
+it was started with, so nodes may mount the capture at different paths.
+
+Start one worker per node per NUM_THREADS cores:
+
+USAGE:
+    python3 reconstruction_distributed.py enqueue DESTINATION SUB_DIR [RIG]
+    python3 reconstruction_distributed.py work DESTINATION SUB_DIR
+    python3 reconstruction_distributed.py status DESTINATION SUB_DIR
+    python3 reconstruction_distributed.py retry DESTINATION SUB_DIR   # requeue failed tasks
+"""
+
+ENQUEUE_FROM = 'directories' # 'directories' or 'journal'
+FOLLOW = False        # workers wait for new tasks instead of exiting when the queue is empty
+POLL_INTERVAL = 5.0   # seconds between checks of an empty queue
+HEARTBEAT = 60.0      # seconds between lease renewals, well below recon_queue.LEASE_SECONDS
+
+## RECONSTRUCTION
+grayscale = False
+color = False # reconstruct all color channels in one solve instead of only green
+npy_save = False
+solver = 'fista' # 'fista' or 'admm', see compare_solvers.py
+backend = 'numpy' # solver array backend: 'numpy', 'torch' (multithreaded CPU) or 'cupy' (GPU)
+# coarse-to-fine FISTA: solve at f*levels, coarsest first, warm starting each finer level
+# e.g. {'levels': (4, 2, 1), 'iters': (100, 50, 50)}, None for 200 iterations at f
+pyramid = None
+padding = 'full' # FISTA padding: 'full' (2x the sensor) or 'support' (PSF extent, faster), see compare_solvers.py
+num_threads = None # FFT workers (numpy) or threads (torch), None uses the backend default
+f = 8 # downsample factor
+
+def measurements(sub_dir, rig, destination, enqueue_from=ENQUEUE_FROM):
+    """
+    (path relative to SUB_DIR, camera context, PSF path relative to DESTINATION) of every
+    lensless measurement in SUB_DIR
+    """
+    cams = dict(lensless_cameras(rig))
+    psf_names = {idx: os.path.relpath(find_psf(f"{destination}/psf", f"{sub_dir}/{cam['path']}", f"cam_{idx}"), destination)
+                 for idx, cam in cams.items()}
+    tasks = []
+    if enqueue_from == 'journal':
+        with open(f"{sub_dir}/journal.jsonl") as journal:
+            for line in journal:
+                entry = json.loads(line)
+                if entry["camera"] in cams:
+                    # the journal holds the paths of the capture machine, only the file name is kept
+                    name = os.path.basename(entry["file"])
+                    tasks.append((f"{cams[entry['camera']]['path']}/{name}", entry["camera"], psf_names[entry["camera"]]))
+    else:
+        for idx, cam in cams.items():
+            tasks += [(f"{cam['path']}/{img}", idx, psf_names[idx]) for img in sorted(os.listdir(f"{sub_dir}/{cam['path']}")) if check_imgname(img)]
+    return tasks
+
+class Heartbeat(threading.Thread):
+    """
+    renews the leases of WORKER every HEARTBEAT seconds, with its own connection
+    """
+    def __init__(self, db_path, worker, interval=HEARTBEAT):
+        super().__init__(daemon=True)
+        self.db_path = db_path
+        self.worker = worker
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.start()
+
+    def run(self):
+        queue = ReconQueue(self.db_path)
+        while not self.stopped.wait(self.interval):
+            try:
+                queue.renew(self.worker)
+            except Exception as e:
+                print(f"Lease renewal failed: {e}")
+        queue.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def work(db_path, destination, sub_dir, follow=FOLLOW):
+    """
+    leases, reconstructs and acknowledges tasks until the queue is empty.
+    task paths are resolved against SUB_DIR and PSF paths against DESTINATION
+    """
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    queue = ReconQueue(db_path)
+    heartbeat = Heartbeat(db_path, worker)
+    recons = {} # warm state, one reconstructor per imager
+    done = 0
+    start = time.time()
+    print(f"Worker {worker} on queue {db_path}")
+    try:
+        while True:
+            leased = queue.lease(worker, 1, cameras=recons.keys())
+            if not leased:
+                counts = queue.counts()
+                if counts["pending"] == 0 and counts["leased"] == 0 and not follow:
+                    break
+                time.sleep(POLL_INTERVAL) # tasks leased by other workers may still come back
+                continue
+            path, ctx, psf_name = leased[0]
+            task_start = time.time()
+            try:
+                if ctx not in recons:
+                    psf_name = os.path.join(destination, psf_name)
+                    print(f"Using PSF for cam {ctx}: ", psf_name)
+                    recons[ctx] = WarmReconstructor(psf_name, f, grayscale=grayscale, color=color, backend=backend, num_threads=num_threads, pyramid=pyramid, solver=solver, padding=padding)
+                result = recons[ctx].reconstruct_and_save(os.path.join(sub_dir, path), npy_save=npy_save)
+                queue.ack(path, worker, os.path.relpath(result, sub_dir), time.time() - task_start)
+                done += 1
+                print(f"Reconstructed {result} ({time.time() - task_start:.1f}s)")
+            except Exception as e:
+                print(f"Failed recon for {path}: {e}")
+                queue.fail(path, worker, repr(e))
+    except KeyboardInterrupt:
+        print("Stopping, leased tasks are returned to the queue when their lease expires")
+    finally:
+        heartbeat.stop()
+        queue.close()
+    duration = time.time() - start
+    print(f"Worker {worker} reconstructed {done} measurements in {duration:.1f}s")
+
+def status(db_path):
+    queue = ReconQueue(db_path)
+    counts = queue.counts()
+    print(", ".join(f"{state}: {n}" for state, n in counts.items()))
+    for worker, (done, seconds) in sorted(queue.workers().items()):
+        print(f"  {worker}: {done} done, {seconds:.1f}s per measurement")
+    queue.close()
+    return counts
+
+def main(args):
+    command, DESTINATION = args[1], args[2]
+    SUB_DIR = DESTINATION + args[3]
+    db_path = queue_path(SUB_DIR)
+
+    if command == 'enqueue':
+        RIG = load_rig(args[4] if len(args) > 4 else RIG_FILE)
+        queue = ReconQueue(db_path)
+        tasks = measurements(SUB_DIR, RIG, DESTINATION)
+        added = queue.enqueue(tasks)
+        print(f"Enqueued {added} new of {len(tasks)} measurements to {db_path}")
+        queue.close()
+    elif command == 'work':
+        work(db_path, DESTINATION, SUB_DIR)
+    elif command == 'status':
+        status(db_path)
+    elif command == 'retry':
+        queue = ReconQueue(db_path)
+        print(f"Requeued {queue.reset_failed()} failed measurements")
+        queue.close()
+    else:
+        raise ValueError(f"Unknown command {command}, options: enqueue, work, status, retry")
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,246 @@
+import os
+import sys
+import json
+import time
+import queue
+import threading
+from recon_helpers import WarmReconstructor, check_imgname, find_psf
+from rig_config import RIG_FILE, load_rig, lensless_cameras
+
+"""
+Streaming reconstruction that follows a running capture.
+
+New lensless measurements in SUB_DIR are reconstructed while capture_display.py
+is still grabbing, so a wrong PSF or a misaligned imager shows up after a few
+images instead of after the whole dataset. Measurements are found by tailing
+SUB_DIR/journal.jsonl (written by the capture QA stage) or, without a journal,
+by polling the lensless imager directories. Results are written to the same
+{imager}/results/reconned_* files as reconstruction.py.
+
+PSF preprocessing and the solver set-up are done once per imager and worker.
+The work queue is bounded: with KEEP_UP the oldest waiting measurement is
+dropped when the queue is full, so reconstructions stay close to acquisition
+(run reconstruction.py afterwards for the skipped ones), otherwise the
+watcher waits for a free slot. The process lowers its priority and keeps off
+the first ACQUISITION_CPUS cores, which are left to the capture process.
+
+Stops once the capture has written metadata.json and every measurement is done.
+
+USAGE:
+    python3 reconstruction_online.py DESTINATION SUB_DIR [RIG]
+    python3 reconstruction_online.py DESTINATION latest [RIG]   # newest capture in DESTINATION
+"""
+
+## FOLLOWING
+FOLLOW = 'auto'       # 'journal', 'directories', or 'auto': the journal once it exists, directories until then
+POLL_INTERVAL = 0.5   # seconds between checks for new measurements
+FILE_SETTLE = 1.0     # directory polling only: seconds a file must be unchanged before it is read
+
+## WORK QUEUE
+QUEUE_SIZE = 2        # per worker backlog, bounds how far reconstructions lag behind with KEEP_UP
+KEEP_UP = True        # drop the oldest waiting measurement instead of falling behind
+NUM_WORKERS = 1
+
+## STAYING OUT OF THE WAY OF ACQUISITION
+NICE = 10             # added to the process niceness
+ACQUISITION_CPUS = 2  # cores 0..ACQUISITION_CPUS-1 are left to capture_display.py, 0 to use all
+
+## RECONSTRUCTION
+grayscale = False
+color = False # reconstruct all color channels in one solve instead of only green
+solver = 'fista' # 'fista' or 'admm', see compare_solvers.py
+backend = 'numpy' # solver array backend: 'numpy', 'torch' (multithreaded CPU) or 'cupy' (GPU)
+# coarse-to-fine FISTA: solve at f*levels, coarsest first, warm starting each finer level
+# e.g. {'levels': (4, 2, 1), 'iters': (100, 50, 50)}, None for 200 iterations at f
+pyramid = None
+padding = 'full' # FISTA padding: 'full' (2x the sensor) or 'support' (PSF extent, faster), see compare_solvers.py
+f = 8 # downsample factor
+
+def lower_priority(nice=NICE, acquisition_cpus=ACQUISITION_CPUS):
+    """
+    lowers the priority of this process and pins it off the acquisition cores.
+    must run before any worker or FFT thread is started, since threads inherit both.
+    returns the cores used for reconstruction.
+    """
+    if nice:
+        os.nice(nice)
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    if acquisition_cpus and len(cpus) > acquisition_cpus:
+        cpus = cpus[acquisition_cpus:]
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpus)
+    return cpus
+
+def latest_capture(destination):
+    """
+    newest capture directory in DESTINATION, waits until there is one
+    """
+    while True:
+        dirs = [e for e in os.scandir(destination) if e.is_dir() and e.name != 'psf'] if os.path.isdir(destination) else []
+        if dirs:
+            return max(dirs, key=lambda e: e.stat().st_mtime).path
+        time.sleep(POLL_INTERVAL)
+
+class JournalFollower():
+    """
+    poll() returns (camera context, path) of the frames added to the capture journal since the last poll
+    """
+    def __init__(self, journal_path, contexts):
+        self.journal_path = journal_path
+        self.contexts = contexts
+        self.offset = 0
+
+    def poll(self):
+        if not os.path.exists(self.journal_path):
+            return []
+        new = []
+        with open(self.journal_path) as f:
+            f.seek(self.offset)
+            for line in iter(f.readline, ''):
+                if not line.endswith('\n'):
+                    break # partially written entry, read again next poll
+                self.offset = f.tell()
+                entry = json.loads(line)
+                if entry["camera"] in self.contexts:
+                    new.append((entry["camera"], entry["file"]))
+        return new
+
+class DirectoryFollower():
+    """
+    poll() returns (camera context, path) of the new measurements in the imager directories,
+    oldest first. a file is only reported once it has not been modified for FILE_SETTLE seconds,
+    poll(settle=0) reports every file, e.g. once the capture has finished writing
+    """
+    def __init__(self, cam_paths, settle=FILE_SETTLE):
+        self.cam_paths = cam_paths # {camera context: directory}
+        self.settle = settle
+        self.seen = set()
+
+    def poll(self, settle=None):
+        settle = self.settle if settle is None else settle
+        now = time.time()
+        new = []
+        for ctx, cam_path in self.cam_paths.items():
+            if not os.path.isdir(cam_path):
+                continue
+            for entry in os.scandir(cam_path):
+                if entry.path in self.seen or not entry.is_file() or not check_imgname(entry.name):
+                    continue
+                st = entry.stat()
+                if now - st.st_mtime < settle:
+                    continue
+                self.seen.add(entry.path)
+                new.append((st.st_mtime, ctx, entry.path))
+        return [(ctx, path) for _, ctx, path in sorted(new)]
+
+class OnlineReconstruction():
+    """
+    bounded work queue feeding NUM_WORKERS reconstruction threads
+    """
+    def __init__(self, psf_names, num_workers=NUM_WORKERS, queue_size=QUEUE_SIZE, keep_up=KEEP_UP, num_threads=None):
+        self.psf_names = psf_names # {camera context: PSF path}
+        self.queue = queue.Queue(maxsize=queue_size * num_workers)
+        self.keep_up = keep_up
+        self.num_threads = num_threads
+        self.skipped = []
+        self.done = 0
+        self.latencies = []
+        self._lock = threading.Lock()
+        self.workers = [threading.Thread(target=self.work, daemon=True) for _ in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, ctx, path):
+        while True:
+            try:
+                self.queue.put((ctx, path), block=not self.keep_up)
+                return
+            except queue.Full:
+                try:
+                    _, dropped = self.queue.get_nowait()
+                    self.queue.task_done()
+                    self.skipped.append(dropped)
+                    print("Behind acquisition, skipped: ", dropped)
+                except queue.Empty:
+                    pass
+
+    def work(self):
+        recons = {} # warm state of this worker, one reconstructor per imager
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            ctx, path = item
+            try:
+                if ctx not in recons:
+                    print(f"Using PSF for cam {ctx}: ", self.psf_names[ctx])
+                    recons[ctx] = WarmReconstructor(self.psf_names[ctx], f, grayscale=grayscale, color=color, backend=backend, num_threads=self.num_threads, pyramid=pyramid, solver=solver, padding=padding)
+                result = recons[ctx].reconstruct_and_save(path)
+                latency = time.time() - os.path.getmtime(path)
+                with self._lock:
+                    self.done += 1
+                    self.latencies.append(latency)
+                print(f"Reconstructed {result} ({latency:.1f}s after capture)")
+            except Exception as e:
+                print(f"Failed recon for {path}: {e}")
+            finally:
+                self.queue.task_done()
+
+    def close(self):
+        """
+        waits for the queued measurements and stops the workers
+        """
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+def main(args):
+    DESTINATION = args[1]
+    SUB_DIR = latest_capture(DESTINATION) if args[2] == 'latest' else DESTINATION + args[2]
+    RIG = load_rig(args[3] if len(args) > 3 else RIG_FILE)
+    PSF_PATH = f"{DESTINATION}/psf"
+
+    cpus = lower_priority()
+    num_threads = max(1, len(cpus) // NUM_WORKERS)
+    print(f"Reconstructing on cores {cpus} with {NUM_WORKERS} worker(s), {num_threads} thread(s) each")
+
+    cam_paths = {idx: f"{SUB_DIR}/{cam['path']}" for idx, cam in lensless_cameras(RIG)}
+    psf_names = {idx: find_psf(PSF_PATH, cam_paths[idx], f"cam_{idx}") for idx in cam_paths}
+
+    journal = JournalFollower(f"{SUB_DIR}/journal.jsonl", set(cam_paths))
+    directories = DirectoryFollower(cam_paths)
+    online = OnlineReconstruction(psf_names, num_threads=num_threads)
+
+    print("Following capture: ", SUB_DIR)
+    start = time.time()
+    submitted = set()
+    try:
+        while True:
+            capture_done = os.path.exists(f"{SUB_DIR}/metadata.json")
+            use_journal = FOLLOW == 'journal' or (FOLLOW == 'auto' and os.path.exists(journal.journal_path))
+            # metadata.json is written after the last frame, so no file is still being written
+            new = journal.poll() if use_journal else directories.poll(settle=0 if capture_done else None)
+            # frames found by polling before the journal appeared are not queued twice
+            new = [(ctx, path) for ctx, path in new if path not in submitted]
+            for ctx, path in new:
+                submitted.add(path)
+                online.submit(ctx, path)
+            if capture_done and not new:
+                break
+            time.sleep(POLL_INTERVAL)
+    except KeyboardInterrupt:
+        print("Stopping, finishing queued measurements")
+    online.close()
+
+    duration = time.time() - start
+    print(f"Reconstructed {online.done} of {len(submitted)} measurements in {duration:.1f}s")
+    if online.latencies:
+        lat = sorted(online.latencies)
+        print(f"Latency after capture: median {lat[len(lat)//2]:.1f}s, max {lat[-1]:.1f}s")
+    if online.skipped:
+        print(f"Skipped {len(online.skipped)} measurements to keep up, run reconstruction.py to complete the dataset")
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,51 @@
+import os
+import json
+
+"""
+Camera rig configuration.
+
+A rig file lists the display layout and every camera in the rig. The position
+of a camera in the list is its camera context, which is used in filenames
+(img_{i}_cam_{context}.tiff) and PSF names (cam_{context}). Each camera has:
+- name: key used in metadata.json
+- role: "lensless" or "ground_truth"
+- serial: camera serial number
+- exposure: exposure time in microseconds
+- path: output sub directory in DESTINATION
+- display_pos, display_crop: lensless only. position (x, y) on the crop surface and
+  crop (x, y, w, h) of the source image shown to this imager
+- crop_view: ground truth only, optional. (x, y, w, h) of the crop surface in its
+  frames, the whole frame by default (see capture_burst.py)
+The display section can set fiducial_pos (x, y), the position of the burst
+fiducial on the crop surface, which is otherwise placed in a free corner.
+"""
+
+RIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rig.json")
+ROLES = ("lensless", "ground_truth")
+
+def load_rig(path=RIG_FILE):
+    """
+    loads and checks a rig file
+    """
+    with open(path) as f:
+        rig = json.load(f)
+
+    serials = [cam["serial"] for cam in rig["cameras"]]
+    assert len(set(serials)) == len(serials), "Camera serial numbers must be unique."
+    for cam in rig["cameras"]:
+        assert cam["role"] in ROLES, f"Unknown role {cam['role']} for camera {cam['name']}."
+        if cam["role"] == "lensless":
+            assert "display_pos" in cam and "display_crop" in cam, f"Lensless camera {cam['name']} needs a display region."
+    return rig
+
+def display_regions(rig):
+    """
+    (pos, dim) of every lensless imager's image on the crop surface
+    """
+    return [(tuple(cam["display_pos"]), tuple(cam["display_crop"])) for cam in rig["cameras"] if cam["role"] == "lensless"]
+
+def lensless_cameras(rig):
+    """
+    (camera context, camera) for every lensless imager
+    """
+    return [(idx, cam) for idx, cam in enumerate(rig["cameras"]) if cam["role"] == "lensless"]
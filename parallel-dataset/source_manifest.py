@@ -0,0 +1,188 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Manifest of a ground truth source dataset for capture_display.py.
+
+Indexing a source directory once writes SOURCE/.manifest.json with one row
+per image: stable index, filename, size, modification time, dimensions,
+orientation and the SHA-1 of its content. capture_display.py then loads the
+image order from the manifest instead of listing, filtering and sorting the
+directory on every launch, and reads dimensions without decoding.
+
+Indices never change once assigned. Updating the manifest keeps every known
+file at its index, appends new files in natural order and marks removed files
+as missing (capture_display.py skips them), so an interrupted capture can be
+resumed with START even after the source changed.
+
+On load, changes are detected with a single stat of the directory, whose
+modification time changes when files are added, removed or renamed, and
+every displayed file is checked against its size and modification time.
+
+USAGE:
+    python3 source_manifest.py SOURCE [--update] [--verify] [--output MANIFEST]
+"""
+
+MANIFEST_NAME = ".manifest.json"
+FORMAT_LST = ['.tiff', '.jpg', '.png']
+COLUMNS = ["filename", "bytes", "mtime_ns", "width", "height", "vertical", "sha1"]
+NUM_READERS = 8   # hashing is I/O bound on network storage
+HASH_CHUNK = 2**20
+
+def manifest_path(source):
+    return os.path.join(source, MANIFEST_NAME)
+
+def is_image(filename):
+    return any(fmt in filename for fmt in FORMAT_LST) and not filename.startswith('.')
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def describe(path):
+    """
+    row of COLUMNS for the image at PATH. only the header is decoded for the dimensions
+    """
+    from PIL import Image
+    st = os.stat(path)
+    with Image.open(path) as img:
+        width, height = img.size
+    # vertical images are flipped on the display, see compose_display_frame()
+    return [os.path.basename(path), st.st_size, st.st_mtime_ns, width, height, width < height, file_hash(path)]
+
+class SourceManifest():
+    """
+    image order and metadata of SOURCE, read from its manifest
+    """
+    def __init__(self, source, path=None):
+        self.source = source
+        self.path = path or manifest_path(source)
+        with open(self.path) as f:
+            manifest = json.load(f)
+        self.dir_mtime_ns = manifest["dir_mtime_ns"]
+        self.rows = [dict(zip(manifest["columns"], row)) for row in manifest["images"]]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def filenames(self):
+        """
+        filename of every index, None for files removed since they were indexed
+        """
+        return [row["filename"] if row["bytes"] is not None else None for row in self.rows]
+
+    def __getitem__(self, index):
+        return self.rows[index]
+
+    def check(self):
+        """
+        {"added": [...], "removed": [...]} filenames since the manifest was written.
+        the directory is only listed when its modification time changed
+        """
+        if os.stat(self.source).st_mtime_ns == self.dir_mtime_ns:
+            return {"added": [], "removed": []}
+        present = {p for p in os.listdir(self.source) if is_image(p)}
+        known = {row["filename"] for row in self.rows if row["bytes"] is not None}
+        return {"added": sorted(present - known), "removed": sorted(known - present)}
+
+    def changed(self, index):
+        """
+        True if the file of INDEX differs in size or modification time from the manifest
+        """
+        row = self.rows[index]
+        try:
+            st = os.stat(os.path.join(self.source, row["filename"]))
+        except FileNotFoundError:
+            return True
+        return st.st_size != row["bytes"] or st.st_mtime_ns != row["mtime_ns"]
+
+def build_manifest(source, previous=None, num_readers=NUM_READERS):
+    """
+    manifest dict of SOURCE. with PREVIOUS rows (a SourceManifest's), known files keep their
+    index and are only hashed again when their size or modification time changed
+    """
+    from natsort import natsorted
+    present = {p for p in os.listdir(source) if is_image(p)}
+    rows = [dict(row) for row in previous.rows] if previous is not None else []
+    known = {row["filename"]: k for k, row in enumerate(rows)}
+    new = natsorted(present - set(known))
+
+    todo = []
+    for k, row in enumerate(rows):
+        if row["filename"] not in present:
+            row.update(bytes=None, mtime_ns=None) # missing, the index stays reserved
+        elif previous.changed(k):
+            todo.append(k)
+    rows += [{"filename": name} for name in new]
+    todo += range(len(rows) - len(new), len(rows))
+
+    start = time.time()
+    with ThreadPoolExecutor(num_readers) as pool:
+        for done, (k, values) in enumerate(zip(todo, pool.map(lambda k: describe(os.path.join(source, rows[k]["filename"])), todo)), 1):
+            rows[k] = dict(zip(COLUMNS, values))
+            if done % 1000 == 0:
+                print(f"Indexed {done}/{len(todo)} images ({done / (time.time() - start):.0f} images/s)")
+    return {
+        "source": os.path.abspath(source),
+        "dir_mtime_ns": os.stat(source).st_mtime_ns,
+        "created": time.strftime('%d-%m-%Y_%H.%M.%S'),
+        "columns": COLUMNS,
+        "images": [[row.get(c) for c in COLUMNS] for row in rows],
+    }, len(todo)
+
+def load_manifest(source):
+    """
+    SourceManifest of SOURCE, None if it was not indexed
+    """
+    return SourceManifest(source) if os.path.exists(manifest_path(source)) else None
+
+def write_manifest(manifest, path):
+    with open(path + ".tmp", 'w') as f:
+        json.dump(manifest, f, separators=(',', ':'))
+    os.replace(path + ".tmp", path)
+    # the rename changed the modification time of SOURCE if the manifest is in it. rewriting
+    # the file in place does not, so the time recorded by the second write stays current
+    source_mtime_ns = os.stat(manifest["source"]).st_mtime_ns
+    if source_mtime_ns != manifest["dir_mtime_ns"]:
+        manifest["dir_mtime_ns"] = source_mtime_ns
+        with open(path, 'w') as f:
+            json.dump(manifest, f, separators=(',', ':'))
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Index a ground truth source dataset.")
+    parser.add_argument("source", type=str, help="Directory of source images.")
+    parser.add_argument("--update", action='store_true', help="Keep the indices of an existing manifest, index new and changed files.")
+    parser.add_argument("--verify", action='store_true', help="Hash every file again and report those whose content changed.")
+    parser.add_argument("--output", type=str, default=None, help=f"Manifest path, SOURCE/{MANIFEST_NAME} by default.")
+    args = parser.parse_args(args[1:])
+    path = args.output or manifest_path(args.source)
+
+    if args.verify:
+        manifest = SourceManifest(args.source, path)
+        rows = [(k, row) for k, row in enumerate(manifest.rows) if row["bytes"] is not None]
+        paths = [os.path.join(args.source, row["filename"]) for _, row in rows]
+        with ThreadPoolExecutor(NUM_READERS) as pool:
+            hashes = pool.map(lambda p: file_hash(p) if os.path.exists(p) else None, paths)
+            changed = [(k, row["filename"]) for (k, row), h in zip(rows, hashes) if h != row["sha1"]]
+        for k, filename in changed:
+            print(f"Changed: {k} {filename}")
+        print(f"{len(changed)} of {len(rows)} images changed since they were indexed")
+        return
+
+    previous = SourceManifest(args.source, path) if args.update and os.path.exists(path) else None
+    start = time.time()
+    manifest, indexed = build_manifest(args.source, previous)
+    write_manifest(manifest, path)
+    missing = sum(row[1] is None for row in manifest["images"])
+    print(f"Indexed {indexed} images in {time.time() - start:.1f}s, {len(manifest['images'])} in {path} ({missing} missing)")
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,160 @@
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import itertools
+import numpy as np
+from fista_files.helper_functions import preprocess_psf, preprocess_image
+from fista_files.image_io import read_image
+import fista_spectral_cupy as FSC
+import metrics
+from evaluation import image_index, parse_crop
+
+"""
+FISTA hyperparameter sweep over a sample of measurements.
+
+Every combination of GRID is scored against the warped ground truth of each
+measurement, within CROP if given. The PSF is preprocessed and its spectrum
+and L computed once, and the measurements are preprocessed once. All
+(tv_lambda, tv_lambdaw, measurement) combinations of a prox_method are
+stacked along the batch axis of a single fista_batch run, up to MAX_BATCH at
+a time. The iteration counts are snapshots of that run, so the longest one
+sets the cost.
+
+Ground truth images are matched to measurements by their index (img_{i}_...),
+e.g. the output of apply_homography.py for the ground truth camera warped to
+the lensless imager, and resized to the reconstruction if needed. Single
+channel reconstructions are compared to the green channel.
+
+Writes one row per setting and measurement to OUTPUT and prints the settings
+ranked by mean PSNR.
+
+USAGE:
+    python3 sweep.py --psf PSF --measurements DIR_OR_FILES --gt_dir GT_DIR [--num_samples 8] [--crop ROWS,COLS] [--grid GRID_JSON]
+"""
+
+# parameter grid, every combination is run. GRID_JSON replaces any of these keys
+GRID = {
+    "prox_method": ['tv'],
+    "tv_lambda": [1e-3, 3e-3, 1e-2, 3e-2, 1e-1],
+    "tv_lambdaw": [0.01],
+    "iters": [50, 100, 200],
+}
+MAX_BATCH = 16 # batch elements per run, bounds memory at about 10 padded images per element
+
+f = 8 # downsample factor
+grayscale = False
+color = False
+backend = 'numpy'
+num_threads = None
+
+def sample_measurements(paths, num_samples, seed=0):
+    """
+    NUM_SAMPLES measurements of PATHS (a directory or a list of files), the same every run
+    """
+    if len(paths) == 1 and os.path.isdir(paths[0]):
+        paths = [os.path.join(paths[0], p) for p in sorted(os.listdir(paths[0])) if p.endswith('.tiff') and 'psf' not in p]
+    paths = sorted(paths)
+    if num_samples and num_samples < len(paths):
+        rng = np.random.default_rng(seed)
+        paths = [paths[i] for i in sorted(rng.choice(len(paths), num_samples, replace=False))]
+    return paths
+
+def ground_truth(gt_dir, paths, shape, channels):
+    """
+    (batch, rows, cols, channels) ground truth of PATHS, not normalized: crop it first
+    """
+    by_index = {image_index(p): os.path.join(gt_dir, p) for p in os.listdir(gt_dir) if image_index(p) is not None}
+    gts = []
+    for path in paths:
+        index = image_index(path)
+        if index not in by_index:
+            raise FileNotFoundError(f"No ground truth for {path} (index {index}) in {gt_dir}")
+        gt = read_image(by_index[index], shape=shape, dtype=np.float32)
+        gt = gt[..., None] if gt.ndim == 2 else gt[..., :3]
+        if channels == 1 and gt.shape[2] == 3:
+            gt = gt[..., 1:2]
+        gts.append(gt)
+    return np.stack(gts)
+
+def settings(grid):
+    """
+    [(prox_method, [(tv_lambda, tv_lambdaw)])], the batched settings of each prox_method
+    """
+    pairs = list(itertools.product(grid["tv_lambda"], grid["tv_lambdaw"]))
+    return [(method, pairs) for method in grid["prox_method"]]
+
+def run_sweep(solver, inputs, grid, max_batch=MAX_BATCH):
+    """
+    reconstructs every measurement of INPUTS (rows, cols, channels, measurements) for every
+    setting of GRID. yields (setting dict, measurement index, reconstruction) in batches.
+    """
+    num = inputs.shape[3]
+    for method, pairs in settings(grid):
+        solver.prox_method = method
+        jobs = [(pair, m) for pair in pairs for m in range(num)]
+        for start in range(0, len(jobs), max_batch):
+            chunk = jobs[start:start + max_batch]
+            batch_inputs = np.stack([inputs[..., m] for _, m in chunk], axis=3)
+            outputs = solver.run(batch_inputs, [p[0] for p, _ in chunk], [p[1] for p, _ in chunk], grid["iters"])
+            for iters, out in outputs.items():
+                for b, ((lam, lamw), m) in enumerate(chunk):
+                    setting = {"prox_method": method, "tv_lambda": lam, "tv_lambdaw": lamw, "iters": iters}
+                    yield setting, m, out[..., b]
+
+def main(args):
+    parser = argparse.ArgumentParser(description="FISTA hyperparameter sweep.")
+    parser.add_argument("--psf", type=str, required=True, help="PSF of the lensless imager.")
+    parser.add_argument("--measurements", type=str, nargs='+', required=True, help="Directory of measurements or measurement files.")
+    parser.add_argument("--gt_dir", type=str, required=True, help="Directory of ground truth images warped to the imager.")
+    parser.add_argument("--num_samples", type=int, default=8, help="Measurements in the sample, 0 for all.")
+    parser.add_argument("--crop", type=str, default=None, help="rows,cols slices scored, e.g. 25:127,63:165.")
+    parser.add_argument("--grid", type=str, default=None, help="JSON object or file replacing keys of GRID.")
+    parser.add_argument("--output", type=str, default="sweep_results.csv", help="Per setting and measurement results.")
+    args = parser.parse_args(args[1:])
+
+    grid = dict(GRID)
+    if args.grid:
+        grid.update(json.load(open(args.grid)) if os.path.exists(args.grid) else json.loads(args.grid))
+
+    psf, mask, bg, size = preprocess_psf(args.psf, f, gray_image=grayscale)
+    channels = slice(None) if color or grayscale else slice(1, 2)
+    solver = FSC.fista_batch(psf[:,:,channels], mask[:,:,channels], gray=grayscale, backend=backend, num_threads=num_threads)
+
+    paths = sample_measurements(args.measurements, args.num_samples)
+    inputs = np.stack([preprocess_image(p, bg, size, gray_image=grayscale)[:,:,channels] for p in paths], axis=3)
+    crop = parse_crop(args.crop)
+    # cropped, then normalized, as the reconstructions and as evaluation.evaluate
+    gts = metrics.normalize_max(ground_truth(args.gt_dir, paths, inputs.shape[:2], inputs.shape[2])[(slice(None),) + crop])
+    num_settings = len(grid["prox_method"])*len(grid["tv_lambda"])*len(grid["tv_lambdaw"])*len(grid["iters"])
+    print(f"Sweeping {num_settings} settings over {len(paths)} measurements")
+
+    start = time.time()
+    rows = []
+    for setting, m, recon in run_sweep(solver, inputs, grid):
+        recon = metrics.normalize_max(np.maximum(recon, 0)[crop][None])
+        scores = {name: float(fn(recon, gts[m:m+1])[0]) for name, fn in metrics.METRICS.items()}
+        rows.append(dict(setting, measurement=paths[m], **scores))
+    duration = time.time() - start
+
+    with open(args.output, 'w', newline='') as out:
+        writer = csv.DictWriter(out, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    # aggregate over the sample, best first
+    keys = ("prox_method", "tv_lambda", "tv_lambdaw", "iters")
+    table = {}
+    for row in rows:
+        table.setdefault(tuple(row[k] for k in keys), []).append(row)
+    ranked = sorted(table.items(), key=lambda item: -np.mean([r["psnr"] for r in item[1]]))
+    print(f"{'prox':8}{'tv_lambda':>11}{'tv_lambdaw':>12}{'iters':>7}{'MSE':>10}{'PSNR':>8}{'SSIM':>8}")
+    for (method, lam, lamw, iters), group in ranked:
+        mean = {name: np.mean([r[name] for r in group]) for name in metrics.METRICS}
+        print(f"{method:8}{lam:11.1e}{lamw:12.1e}{iters:7d}{mean['mse']:10.5f}{mean['psnr']:8.2f}{mean['ssim']:8.3f}")
+    print(f"{len(rows)} reconstructions in {duration:.1f}s, results in {args.output}")
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -2,47 +2,73 @@ import cv2
 import numpy as np
 import glob
 import os
-import matplotlib.pyplot as plt
-import numpy as np
+import sys
 import argparse
 import gc
 import skimage.io as skio
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fista_files.image_io import read_image
+
 """
 This script takes in three arguments:
 python3 undistort.py --images [PATH TO IMAGES] --calibration_path [PATH TO CALIBRATION FILE] --root_path [ROOT DIRECTORY]
+
+optionally --downsample F to undistort and save at 1/F resolution, which reads
+the captures at reduced resolution and scales the camera matrix to match.
 """
 
-def undistort_image(image_path, camera_matrix, dist_coeffs, root_path='./'):
+def scale_camera_matrix(camera_matrix, factor):
+    """
+    camera matrix for images downsampled by FACTOR (pixel centers stay aligned)
+    """
+    scaled = np.array(camera_matrix, dtype=np.float64)
+    scaled[0, 0] /= factor
+    scaled[1, 1] /= factor
+    scaled[:2, 2] = (scaled[:2, 2] + 0.5) / factor - 0.5
+    return scaled
+
+def undistort_maps(camera_matrix, dist_coeffs, size):
+    """
+    remap tables for images of SIZE (w, h), same result as cv2.undistort
+    """
+    w, h = size
+    # Obtain the new optimal camera matrix (free of distortion)
+    # setting alpha = 0 helped reduce the fringing on the edges
+    new_camera_matrix, roi = cv2.getOptimalNewCameraMatrix(camera_matrix, dist_coeffs, (w, h), 0, (w, h))
+    return cv2.initUndistortRectifyMap(camera_matrix, dist_coeffs, None, new_camera_matrix, (w, h), cv2.CV_16SC2)
+
+def undistort_image(image_path, camera_matrix, dist_coeffs, root_path='./', factor=1, maps=None):
     """
     Undistort an image using the camera matrix and distortion coefficients.
     Saves at ROOT_PATH/undistorted_images/
 
     :param image_path: Path to the image to be undistorted
-    :param camera_matrix: The camera matrix
+    :param camera_matrix: The camera matrix, for the full resolution image
     :param dist_coeffs: The distortion coefficients
     :param root_path: The root path to save the undistorted images
+    :param factor: Downsample factor, the image is read and undistorted at 1/factor resolution
+    :param maps: Optional cache {image size: remap tables}, shared across images
 
     :return: The undistorted image
 
-    NOTE: This function flips the image horizontally, then converts from BGR to RGB.
+    NOTE: This function flips the image horizontally. Images are read in RGB order.
     """
-    # Load the distorted image
-    img = cv2.imread(image_path)
+    # Load the distorted image, memory-mapped or at reduced resolution
+    img = read_image(image_path, factor)
+    if factor != 1:
+        img = np.clip(np.rint(img), 0, 255).astype(np.uint8)
 
     # Get the image size
     h, w = img.shape[:2]
 
-    # Obtain the new optimal camera matrix (free of distortion)
-    # setting alpha = 0 helped reduce the fringing on the edges
-    new_camera_matrix, roi = cv2.getOptimalNewCameraMatrix(camera_matrix, dist_coeffs, (w, h), 0, (w, h))
-
-    # Undistort the image
-    undistorted_img = cv2.undistort(img, camera_matrix, dist_coeffs, None, new_camera_matrix)
+    # Undistort the image with remap tables computed once per image size
+    maps = {} if maps is None else maps
+    if (w, h) not in maps:
+        maps[(w, h)] = undistort_maps(scale_camera_matrix(camera_matrix, factor), dist_coeffs, (w, h))
+    undistorted_img = cv2.remap(img, *maps[(w, h)], cv2.INTER_LINEAR)
 
     undistorted_img = cv2.flip(undistorted_img, 1)
-    # Convert from BGR to RGB
-    undistorted_img = cv2.cvtColor(undistorted_img, cv2.COLOR_BGR2RGB)
 
     # Normalize 0-1, convert to float32 -- UNCOMMENT IF USING PLT
     # undistorted_img = undistorted_img.astype(np.float32) / 255.0
@@ -65,7 +91,7 @@ def undistort_image(image_path, camera_matrix, dist_coeffs, root_path='./'):
 
     return
 
-def undistort_images(images, calibration_path, root_path='./'):
+def undistort_images(images, calibration_path, root_path='./', factor=1):
     """
     Undistort a list of images using the camera matrix and distortion coefficients.
     Saves at ROOT_PATH/undistorted_images/
@@ -74,6 +100,7 @@ def undistort_images(images, calibration_path, root_path='./'):
     :param camera_matrix: The camera matrix
     :param dist_coeffs: The distortion coefficients
     :param root_path: The root path to save the undistorted images
+    :param factor: Downsample factor
 
     :return: Number of undistorted images
     """
@@ -82,9 +109,10 @@ def undistort_images(images, calibration_path, root_path='./'):
     camera_matrix = calibration_data['camera_matrix']
     dist_coeffs = calibration_data['dist_coeffs']
     
+    maps = {}
     num_imgs = 0
     for image in images:
-        undistort_image(image, camera_matrix, dist_coeffs, root_path)
+        undistort_image(image, camera_matrix, dist_coeffs, root_path, factor, maps)
         num_imgs += 1
         
         if num_imgs % 1000 == 0:
@@ -98,11 +126,12 @@ def main():
     parser.add_argument("--images", type=str, help="Path to the folder containing images to undistort.")
     parser.add_argument("--calibration_path", type=str, help="Path to the .npz file containing camera calibration data.")
     parser.add_argument("--root_path", type=str, default="./", help="Root path to save the undistorted images.")
+    parser.add_argument("--downsample", type=int, default=1, help="Undistort and save at 1/downsample resolution.")
 
     args = parser.parse_args()
 
     print("Beginning undistortion...")
-    undistorted_images = undistort_images(args.images, args.calibration_path, args.root_path)
+    undistorted_images = undistort_images(args.images, args.calibration_path, args.root_path, args.downsample)
     print(f"Undistorted {undistorted_images} images and saved to {args.root_path}/undistorted_images/")
 if __name__ == "__main__":
     main()
\ No newline at end of file